@@ -1,7 +1,7 @@
 from src.client import Client
 
 if __name__ == "__main__":
-    c = Client("Bar")
+    c = Client("Bar", codec="binary")
     c.connect()
     
     c.loop()
\ No newline at end of file
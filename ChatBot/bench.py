@@ -0,0 +1,171 @@
+"""Load generator and latency benchmark for the chat server.
+
+Opens many simulated clients against a running server, splits them over
+channels and makes a few of them publish at a fixed rate. Every message
+carries its send time in microseconds in the TextMessage ts field, which the
+server forwards untouched, so receivers measure end-to-end delivery latency.
+"""
+import argparse
+import asyncio
+import json
+import resource
+import sys
+import time
+
+from src.protocol import CDProto, CDProtoDecoder, TextMessage
+
+
+def now_us() -> int:
+    return time.time_ns() // 1000
+
+
+def percentile(samples, p):
+    if not samples:
+        return float("nan")
+    return samples[min(int(len(samples) * p), len(samples) - 1)]
+
+
+class SimClient:
+    """A Client-compatible connection driven by asyncio."""
+
+    def __init__(self, name, channel, codec, stats, compress=None):
+        self.name = name
+        self.channel = channel
+        self.codec = codec
+        self.compress = compress
+        self.stats = stats
+        self.decoder = CDProtoDecoder()
+        self.reader = self.writer = None
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        codec = None if self.codec == "json" else self.codec
+        self.writer.write(CDProto.encode(CDProto.register(self.name, codec, compress=self.compress)))
+        self.writer.write(CDProto.encode(CDProto.join(self.channel), self.codec, compress=self.compress))
+        await self.writer.drain()
+
+    async def receive(self):
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+            self.decoder.feed(data)
+            self.stats["wire_bytes"] += len(data)
+            now = now_us()
+            for msg in self.decoder.messages():
+                if msg is not None and msg.command == "message" and msg.channel == self.channel:
+                    self.stats["latencies"].append(now - msg.ts)
+                    self.stats["bytes"] += len(msg.message)
+
+    async def publish(self, rate, duration, text):
+        interval = 1 / rate
+        deadline = time.monotonic() + duration
+        next_send = time.monotonic()
+        while next_send < deadline:
+            msg = TextMessage(text, self.channel, now_us())
+            self.writer.write(CDProto.encode(msg, self.codec, compress=self.compress))
+            self.stats["sent"] += 1
+            next_send += interval
+            await asyncio.sleep(max(next_send - time.monotonic(), 0))
+        await self.writer.drain()
+
+    def close(self):
+        self.writer.close()
+
+
+async def run(args):
+    stats = {"latencies": [], "sent": 0, "bytes": 0, "wire_bytes": 0}
+    members = args.clients // args.channels
+    clients = [
+        SimClient(f"bench{i}", f"#bench{i % args.channels}", args.codec, stats, args.compress)
+        for i in range(members * args.channels)
+    ]
+
+    connecting = asyncio.Semaphore(args.connect_concurrency)
+
+    async def connect(client):
+        async with connecting:
+            await client.connect(args.host, args.port)
+
+    start = time.monotonic()
+    await asyncio.gather(*(connect(c) for c in clients))
+    print(f"{len(clients)} clients connected in {time.monotonic() - start:.2f}s "
+          f"({args.channels} channels x {members} members)", file=sys.stderr)
+
+    receivers = [asyncio.create_task(c.receive()) for c in clients]
+    await asyncio.sleep(args.warmup)
+
+    words = "o servidor de chat entrega as mensagens a todos os membros do canal".split()
+    text = " ".join(words[i % len(words)] for i in range(args.size))[:args.size]  # Texto com alguma repetição
+    publishers = clients[: args.senders * args.channels]  # Os primeiros de cada canal
+    start = time.monotonic()
+    await asyncio.gather(*(c.publish(args.rate, args.duration, text) for c in publishers))
+    await asyncio.sleep(args.drain)
+    elapsed = time.monotonic() - start
+
+    for c in clients:
+        c.close()
+    for task in receivers:
+        task.cancel()
+
+    latencies = sorted(stats["latencies"])
+    expected = stats["sent"] * (members - 1)
+    return {
+        "clients": len(clients),
+        "channels": args.channels,
+        "sent": stats["sent"],
+        "delivered": len(latencies),
+        "expected": expected,
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) / 1000,
+        "p99_ms": percentile(latencies, 0.99) / 1000,
+        "p999_ms": percentile(latencies, 0.999) / 1000,
+        "max_ms": (latencies[-1] / 1000) if latencies else float("nan"),
+        "wire_bytes_per_msg": stats["wire_bytes"] / len(latencies) if latencies else float("nan"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6666)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--senders", type=int, default=1, help="publishers per channel")
+    parser.add_argument("--rate", type=float, default=20, help="messages per second per publisher")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of publishing")
+    parser.add_argument("--size", type=int, default=64, help="message length")
+    parser.add_argument("--codec", choices=CDProto.CODECS, default="json")
+    parser.add_argument("--compress", choices=CDProto.COMPRESSIONS, help="negotiate frame compression")
+    parser.add_argument("--warmup", type=float, default=1)
+    parser.add_argument("--drain", type=float, default=1, help="seconds to wait for late deliveries")
+    parser.add_argument("--connect-concurrency", type=int, default=100)
+    parser.add_argument("--json", default=False, action="store_true", help="print the report as JSON")
+    parser.add_argument("--max-p99-ms", type=float, help="exit with an error if p99 latency is above this")
+    args = parser.parse_args()
+
+    # Cada cliente simulado é um descritor de ficheiro
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    report = asyncio.run(run(args))
+
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print(f"clients     {report['clients']} in {report['channels']} channels")
+        print(f"sent        {report['sent']}")
+        print(f"delivered   {report['delivered']} / {report['expected']}")
+        print(f"throughput  {report['throughput']:.0f} msg/s")
+        print(f"latency     p50 {report['p50_ms']:.3f} ms  p99 {report['p99_ms']:.3f} ms  "
+              f"p999 {report['p999_ms']:.3f} ms  max {report['max_ms']:.3f} ms")
+        print(f"wire        {report['wire_bytes_per_msg']:.1f} bytes per delivered message")
+
+    if args.max_p99_ms is not None and not report["p99_ms"] <= args.max_p99_ms:
+        sys.exit(f"p99 latency {report['p99_ms']:.3f} ms above {args.max_p99_ms} ms")
+    if report["delivered"] < report["expected"]:
+        sys.exit(f"{report['expected'] - report['delivered']} messages were not delivered")
+
+
+if __name__ == "__main__":
+    main()
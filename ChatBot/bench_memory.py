@@ -0,0 +1,116 @@
+"""Memory benchmark of the chat server sessions.
+
+Registers many in-process sessions in a Server, each one joined to a few
+channels, and measures with tracemalloc the bytes kept per connection and per
+message object. Small samples are also built in the older layouts, for
+comparison: the baseline server, which kept only a dict with the user and a
+set of channels per connection, and the dict and set layout used right before
+sessions had __slots__, with and without the 64 KiB read buffer each decoder
+owned after user-004 (now shared by all the decoders of a server).
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tracemalloc
+from collections import deque
+
+from src.protocol import CDProto, CDProtoDecoder, TextMessage
+from src.server import Server
+
+
+class Conn:
+    """Stand-in for a client socket, only used as a key of the server state."""
+
+    __slots__ = ()
+
+
+def measure(build):
+    """Bytes allocated by build() that are still alive when it returns, and the result."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, result
+
+
+def sessions(server, conns, channels, joins):
+    """Register every connection and join it to joins channels."""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for i, conn in enumerate(conns):
+            server.open(conn)
+            server.handle(conn, CDProto.register(f"user{i}"))
+            for j in range(joins):
+                server.handle(conn, CDProto.join(f"#channel{(i + j) % channels}"))
+
+
+def baseline_sessions(conns, channels, joins):
+    """The same sessions as the baseline server kept them: a dict with the user and a set of channels."""
+    state = {}
+    for i, conn in enumerate(conns):
+        names = {"None"} | {f"#channel{(i + j) % channels}" for j in range(joins)}
+        state[conn] = {"user": f"user{i}", "channels": names}
+    return state
+
+
+def legacy_sessions(conns, channels, joins, chunk=None):
+    """The same sessions in the layout before __slots__: dicts, sets, a queue and a decoder.
+
+    Without a shared chunk every decoder owns its read buffer, as after user-004.
+    """
+    state = {}
+    for i, conn in enumerate(conns):
+        names = {"None"} | {f"#channel{(i + j) % channels}" for j in range(joins)}
+        state[conn] = ({"user": f"user{i}", "channels": names, "wire": ("json", 2), "streams": {}},
+                       deque(), CDProtoDecoder(chunk=chunk))
+    return state
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=100000)
+    parser.add_argument("--channels", type=int, default=100)
+    parser.add_argument("--joins", type=int, default=2, help="channels joined by each session")
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--baseline", type=int, default=1000, help="sessions built in each older layout")
+    parser.add_argument("--json", default=False, action="store_true", help="print the report as JSON")
+    parser.add_argument("--max-session-bytes", type=int, help="exit with an error if a session takes more")
+    args = parser.parse_args()
+
+    server = Server(port=0, history=(0, 0))
+    conns = [Conn() for _ in range(args.sessions)]
+    size, _ = measure(lambda: sessions(server, conns, args.channels, args.joins))
+    message_size, _ = measure(lambda: [TextMessage(f"message {i}", "#channel0", i) for i in range(args.messages)])
+    baseline = [Conn() for _ in range(args.baseline)]
+    baseline_size, _ = measure(lambda: baseline_sessions(baseline, args.channels, args.joins))
+    legacy_size, _ = measure(lambda: legacy_sessions(baseline, args.channels, args.joins, server.chunk))
+    buffers_size, _ = measure(lambda: legacy_sessions(baseline, args.channels, args.joins))
+    server.s.close()
+
+    report = {
+        "sessions": args.sessions,
+        "session_bytes": size / args.sessions,
+        "total_mb": size / 2**20,
+        "message_bytes": message_size / args.messages,
+        "baseline_session_bytes": baseline_size / max(args.baseline, 1),
+        "legacy_session_bytes": legacy_size / max(args.baseline, 1),
+        "legacy_buffer_session_bytes": buffers_size / max(args.baseline, 1),
+    }
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print(f"sessions        {report['sessions']} in {args.channels} channels, {args.joins} joins each")
+        print(f"per session     {report['session_bytes']:.0f} bytes ({report['total_mb']:.1f} MiB total)")
+        print(f"per message     {report['message_bytes']:.0f} bytes")
+        print(f"baseline        {report['baseline_session_bytes']:.0f} bytes per session")
+        print(f"before slots    {report['legacy_session_bytes']:.0f} bytes per session, "
+              f"{report['legacy_buffer_session_bytes']:.0f} with a decoder buffer each (after user-004)")
+
+    if args.max_session_bytes is not None and report["session_bytes"] > args.max_session_bytes:
+        sys.exit(f"{report['session_bytes']:.0f} bytes per session above {args.max_session_bytes}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+import argparse
+
+from src.client import Client
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--name", default="Foo")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6666)
+    parser.add_argument("--codec", choices=["json", "binary"], default="json")
+    parser.add_argument("--framing", type=int, choices=[1, 2], default=2, help="1: 2 byte frames, 2: 4 byte frames")
+    parser.add_argument("--compress", choices=["zlib"])
+    parser.add_argument("--channel", help="join this channel before reading stdin")
+    parser.add_argument("--headless", default=False, action="store_true",
+                        help="no prompt: send every stdin line at full speed and write only the received messages")
+    args = parser.parse_args()
+
+    c = Client(args.name, args.codec, args.framing, args.compress, headless=args.headless)
+    c.connect(args.host, args.port)
+    if args.channel:
+        c.handle(f"/join {args.channel}")
+
+    c.loop()
@@ -1,6 +1,68 @@
+import argparse
+import logging
+
 from src.server import Server
 
+
+def address(text):
+    """Parse a host:port command line argument."""
+    host, _, port = text.rpartition(":")
+    return host or "localhost", int(port)
+
+
 if __name__ == "__main__":
-    s = Server()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=6666)
+    parser.add_argument("--engine", choices=["selector", "asyncio"], default="selector")
+    parser.add_argument("--uvloop", default=False, action="store_true")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--admin-port", type=int, help="serve the metrics over HTTP on this port (worker i uses port + i)")
+    parser.add_argument("--log-every", type=int, default=1000, help="log one in every N messages")
+    parser.add_argument("--user-limit", type=float, nargs=2, metavar=("RATE", "BURST"),
+                        help="messages per second and burst each user may publish")
+    parser.add_argument("--channel-limit", type=float, nargs=2, metavar=("RATE", "BURST"),
+                        help="messages per second and burst published in each channel (per worker)")
+    parser.add_argument("--log-dir", help="keep a persistent log of every channel in this directory")
+    parser.add_argument("--keepalive", type=float, nargs=2, metavar=("INTERVAL", "TIMEOUT"),
+                        help="ping connections idle for INTERVAL seconds and close them after TIMEOUT without reply")
+    parser.add_argument("--trunk", type=address, metavar="HOST:PORT", help="accept peer servers on this address")
+    parser.add_argument("--peer", type=address, action="append", default=[], metavar="HOST:PORT",
+                        help="link to the peer server listening on this trunk address (repeatable)")
+    args = parser.parse_args()
+    federated = args.trunk is not None or args.peer
+    if (args.log_dir or federated) and (args.workers > 1 or args.engine != "selector"):
+        parser.error("--log-dir, --trunk and --peer need the selector engine with a single worker")
+    if args.keepalive and args.engine != "selector":
+        parser.error("--keepalive needs the selector engine")
+    if args.log_dir and federated:
+        parser.error("--log-dir cannot be used in a federation")
+
+    logging.basicConfig(filename="server.log", level=logging.INFO,
+                        format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    options = {"port": args.port, "admin_port": args.admin_port, "log_every": args.log_every,
+               "user_limit": args.user_limit, "channel_limit": args.channel_limit}
+    if args.log_dir:
+        options["log_dir"] = args.log_dir
+    if args.keepalive:
+        options["keepalive"] = args.keepalive
+
+    if args.engine == "asyncio":
+        from src.async_server import AsyncServer
+
+        if args.uvloop:
+            import uvloop
+
+            uvloop.install()
+        s = AsyncServer(**options)
+    elif args.workers > 1:
+        from src.cluster import Cluster
+
+        s = Cluster(args.workers, **options)
+    elif federated:
+        from src.federation import Federation
+
+        s = Server(bus=Federation(args.trunk, args.peer), **options)
+    else:
+        s = Server(**options)
 
     s.loop()
@@ -0,0 +1,120 @@
+"""CD Chat server program running on asyncio."""
+import asyncio
+
+from .metrics import http_response
+from .protocol import CDProtoBadFormat, CDProtoDecoder
+from .server import Server
+
+
+class ChatProtocol(asyncio.Protocol):
+    """asyncio protocol of one client connection."""
+
+    __slots__ = ("server", "decoder", "transport")
+
+    def __init__(self, server):
+        self.server = server
+        self.decoder = CDProtoDecoder(chunk_size=0)  # Os dados chegam por feed, sem recv_into
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.connections.add(self)
+
+    def data_received(self, data):
+        self.decoder.feed(data)
+        try:
+            for msg in self.decoder.messages():
+                if msg:
+                    self.server.handle(self, msg)
+        except CDProtoBadFormat:
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        if self in self.server.infUsers:
+            print(f">> {self.server.infUsers[self].user} desconectou-se")
+        self.server.forget(self)
+        self.server.connections.discard(self)
+
+
+class AsyncServer(Server):
+    """Chat Server process built on an asyncio event loop.
+
+    Speaks the same CDProto wire format and register/join/message semantics
+    as Server. Each connection is buffered by its asyncio transport.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 6666,
+                 high_water: int = 1 << 20, slow_consumer: str = "disconnect",
+                 history: tuple = (100, 1 << 16), admin_port: int = None, log_every: int = 1000,
+                 user_limit: tuple = None, channel_limit: tuple = None):
+        """Initialize the server.
+
+        Parameters:
+            host, port: address to listen on
+            high_water: maximum bytes buffered by a transport before it is a slow consumer
+            slow_consumer: "drop" discards new frames for slow consumers, "disconnect" closes them
+            history: (messages, bytes) kept per channel for replay on join
+            admin_port: localhost port serving the metrics as JSON over HTTP
+            log_every: log one in every log_every messages
+            user_limit: (messages per second, burst) each user may publish, None for no limit
+            channel_limit: (messages per second, burst) published in each channel, None for no limit
+        """
+        self.setup(high_water, slow_consumer, history, log_every, user_limit, channel_limit)
+        self.host = host
+        self.port = port
+        self.admin_port = admin_port
+        self.connections = set()
+
+    def send(self, conn, frame):
+        """Write a frame to a connection through its transport."""
+        transport = conn.transport
+        if transport.is_closing():
+            return
+        if transport.get_write_buffer_size() + len(frame) > self.high_water:
+            if self.slow_consumer == "disconnect":
+                print(f">> {self.name(conn)} não acompanha o ritmo e foi desconectado")
+                self.disconnect(conn)
+            else:
+                self.metrics.dropped += 1
+            return
+        transport.write(frame)
+        self.metrics.bytes_out += len(frame)
+
+    def decoder(self, conn):
+        """Decoder of the frames received from a connection."""
+        return conn.decoder
+
+    def queue_depths(self):
+        """Bytes waiting in the write buffer of each transport."""
+        return (conn.transport.get_write_buffer_size() for conn in self.connections)
+
+    async def answer_admin(self, reader, writer):
+        """Reply to a request on the admin port with the metrics report."""
+        await reader.read(4096)
+        writer.write(http_response(self.stats()))
+        await writer.drain()
+        writer.close()
+
+    def disconnect(self, conn):
+        """Forget a connection and close it."""
+        self.forget(conn)
+        conn.transport.abort()  # Descarta o que ainda estiver no buffer
+
+    async def start(self) -> asyncio.AbstractServer:
+        """Start listening for connections."""
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: ChatProtocol(self), self.host, self.port, reuse_address=True)
+        if self.admin_port is not None:
+            await asyncio.start_server(self.answer_admin, "localhost", self.admin_port, reuse_address=True)
+        print("Server started")
+        return server
+
+    async def serve(self):
+        """Accept connections until cancelled."""
+        server = await self.start()
+        async with server:
+            await server.serve_forever()
+
+    def loop(self):
+        """Loop indefinetely."""
+        asyncio.run(self.serve())
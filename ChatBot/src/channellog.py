@@ -0,0 +1,244 @@
+"""Persistent log of the messages broadcast in each channel."""
+import mmap
+import os
+import time
+from array import array
+from collections import OrderedDict
+from urllib.parse import quote
+
+from .protocol import CDProto
+
+
+HEADER = CDProto.CANONICAL[1]
+
+
+class Segment:
+    """One file of a channel log, holding the frames of consecutive sequence numbers.
+
+    Frames are stored exactly as sent to clients in the CANONICAL format and
+    read back through a memory map, so they can be replayed without copies.
+    """
+
+    __slots__ = ("path", "first", "offsets", "size", "fd", "map")
+
+    def __init__(self, path: str, first: int):
+        self.path = path
+        self.first = first  # seq da primeira frame
+        self.offsets = array("Q")  # Posição de cada frame no ficheiro
+        self.map = None
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = os.fstat(self.fd).st_size
+        self.recover()
+
+    def recover(self):
+        """Index the frames already in the file, cutting a partially written one at the end."""
+        pos = 0
+        if self.size:
+            with memoryview(mmap.mmap(self.fd, self.size, prot=mmap.PROT_READ)) as view:
+                while pos + HEADER <= self.size:
+                    end = pos + HEADER + int.from_bytes(view[pos:pos + HEADER], "big")
+                    if end > self.size:
+                        break
+                    self.offsets.append(pos)
+                    pos = end
+        if pos < self.size:
+            os.ftruncate(self.fd, pos)
+            self.size = pos
+
+    @property
+    def next(self) -> int:
+        """seq of the next frame appended."""
+        return self.first + len(self.offsets)
+
+    def append(self, frame):
+        self.offsets.append(self.size)
+        view = memoryview(frame)
+        while view:
+            view = view[os.write(self.fd, view):]
+        self.size += len(frame)
+
+    def view(self, start: int, end: int) -> memoryview:
+        """Bytes [start, end) of the file, read through its memory map."""
+        if self.map is None or len(self.map) < end:
+            # Um novo mapa; o anterior é libertado quando deixar de haver frames a apontar para ele
+            self.map = mmap.mmap(self.fd, self.size, prot=mmap.PROT_READ)
+        return memoryview(self.map)[start:end]
+
+    def read(self, seq: int, until: int, limit: int, split: bool) -> tuple:
+        """Frames from seq to until, up to limit bytes but at least one, and the seq of the last one.
+
+        The frames are a single contiguous view, or one view per frame if split.
+        """
+        index = stop = seq - self.first
+        start = end = self.offsets[index]
+        while stop < min(len(self.offsets), until - self.first + 1):
+            following = self.offsets[stop + 1] if stop + 1 < len(self.offsets) else self.size
+            if stop > index and following - start > limit:
+                break
+            end = following
+            stop += 1
+        if split:
+            bounds = list(self.offsets[index:stop]) + [end]
+            frames = [self.view(a, b) for a, b in zip(bounds, bounds[1:])]
+        else:
+            frames = [self.view(start, end)]
+        return frames, self.first + stop - 1
+
+    def sync(self):
+        os.fsync(self.fd)
+
+    def seal(self):
+        """Stop appending to the segment: sync it, map it whole and release its file descriptor."""
+        self.sync()
+        if self.size:
+            self.view(0, self.size)
+        os.close(self.fd)
+        self.fd = None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.map = None
+
+
+class ChannelLog:
+    """Append-only log of a channel, split in segment files named after their first seq."""
+
+    def __init__(self, path: str, segment_bytes: int):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        os.makedirs(path, exist_ok=True)
+        names = sorted(name for name in os.listdir(path) if name.endswith(".log"))
+        self.segments = [Segment(os.path.join(path, name), int(name[:-4])) for name in names]
+        for segment in self.segments[:-1]:
+            segment.seal()
+        if not self.segments:
+            self.segments.append(self.segment(1))
+
+    def segment(self, first: int) -> Segment:
+        return Segment(os.path.join(self.path, f"{first:020d}.log"), first)
+
+    @property
+    def next(self) -> int:
+        """seq of the next message of the channel."""
+        return self.segments[-1].next
+
+    def append(self, frame):
+        """Append the frame with the next seq, starting a new segment when the active one is full."""
+        active = self.segments[-1]
+        if active.size and active.size + len(frame) > self.segment_bytes:
+            active.seal()
+            active = self.segment(active.next)
+            self.segments.append(active)
+        active.append(frame)
+
+    def read(self, since: int, until: int, limit: int, split: bool = False) -> tuple:
+        """Frames with a seq greater than since and up to until, about limit bytes at most.
+
+        Returns the frames and the seq of the last one.
+        """
+        frames = []
+        last = seq = since + 1
+        for segment in self.segments:
+            if seq >= segment.next:
+                continue
+            if limit <= 0 or seq > until or segment.first > until:
+                break
+            views, last = segment.read(max(seq, segment.first), until, limit, split)
+            limit -= sum(len(view) for view in views)
+            frames += views
+            seq = last + 1
+        return frames, last if frames else since
+
+    def sync(self):
+        self.segments[-1].sync()
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+
+class MessageLog:
+    """Logs of every channel kept under a directory, fsynced in batches.
+
+    Appends reach the page cache at once and are synced when sync_every of
+    them are pending or sync_interval seconds after the first one. At most
+    max_open channel logs are kept open, the least recently used one is
+    closed to open another and recovered from disk when used again.
+    """
+
+    def __init__(self, path: str, segment_bytes: int = 1 << 24, sync_every: int = 1000,
+                 sync_interval: float = 0.05, max_open: int = 256):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.max_open = max_open
+        self.logs = OrderedDict()  # Canal -> ChannelLog, do menos para o mais recentemente usado
+        self.unsynced = set()  # Canais com mensagens ainda sem fsync
+        self.pending = 0
+        self.deadline = None
+
+    def channel(self, channel: str) -> ChannelLog:
+        """Log of a channel, recovered from disk the first time it is used."""
+        log = self.logs.get(channel)
+        if log is None:
+            if len(self.logs) >= self.max_open:
+                self.evict()
+            # O prefixo evita os nomes ".", ".." e "" e os ficheiros escondidos
+            path = os.path.join(self.path, "c" + quote(channel, safe=""))
+            log = self.logs[channel] = ChannelLog(path, self.segment_bytes)
+        else:
+            self.logs.move_to_end(channel)
+        return log
+
+    def evict(self):
+        """Close the least recently used channel log, releasing its file descriptors."""
+        channel, log = self.logs.popitem(last=False)
+        if channel in self.unsynced:
+            log.sync()
+            self.unsynced.discard(channel)
+        log.close()
+
+    def next(self, channel: str) -> int:
+        """seq of the next message of a channel."""
+        return self.channel(channel).next
+
+    def append(self, channel: str, frame):
+        """Log the CANONICAL frame of the next message of a channel."""
+        self.channel(channel).append(frame)
+        self.unsynced.add(channel)
+        self.pending += 1
+        if self.pending >= self.sync_every:
+            self.sync()
+        elif self.deadline is None:
+            self.deadline = time.monotonic() + self.sync_interval
+
+    def read(self, channel: str, since: int, until: int, limit: int, split: bool = False) -> tuple:
+        """Frames of a channel with a seq in (since, until], about limit bytes at most, and the seq of the last one."""
+        return self.channel(channel).read(since, until, limit, split)
+
+    def timeout(self):
+        """Seconds until the pending messages must be synced, or None if there are none."""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0)
+
+    def tick(self):
+        """Sync the pending messages if their deadline passed."""
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.sync()
+
+    def sync(self):
+        for channel in self.unsynced:
+            self.logs[channel].sync()
+        self.unsynced.clear()
+        self.pending = 0
+        self.deadline = None
+
+    def close(self):
+        self.sync()
+        for log in self.logs.values():
+            log.close()
+        self.logs.clear()
@@ -6,63 +6,179 @@ import selectors
 import fcntl
 import os
 
-from .protocol import CDProto, CDProtoBadFormat
+from .protocol import CDProto, CDProtoBadFormat, CDProtoDecoder
 
 logging.basicConfig(filename=f"{sys.argv[0]}.log", level=logging.DEBUG)
 
 class Client:
-    def __init__(self, name: str = "Foo"):
+    CHUNK_THRESHOLD = 60000  # Mensagens maiores (em bytes) são enviadas aos pedaços
+    CHUNK_SIZE = 16384
+    STDIN_CHUNK = 65536
+
+    def __init__(self, name: str = "Foo", codec: str = "json", framing: int = 2, compress: str = None,
+                 headless: bool = False):
+        """Initialize the client.
+
+        In headless mode there is no prompt, every line read from stdin is
+        sent as fast as it arrives and only the received messages go to
+        stdout, so the client can be scripted or used as a load generator.
+        """
         self.name = name
+        self.codec = codec  # Codec usado nas mensagens trocadas com o servidor
+        self.compress = compress  # Compressão das frames, p.ex. "zlib" em ligações lentas
+        self.framing = framing
+        self.header = CDProto.HEADERS[framing]
+        self.headless = headless
+        self.streams = {}  # Pedaços recebidos das mensagens longas ainda incompletas
+        self.offsets = {}  # Último seq recebido em cada canal, para recuperar as mensagens perdidas
+        self.sent_streams = 0
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.selector = selectors.DefaultSelector()
-        self.channel = "None"  
+        # O epoll não aceita ficheiros regulares, que em modo headless podem ser o stdin
+        self.selector = selectors.SelectSelector() if headless else selectors.DefaultSelector()
+        self.channel = "None"
         self.CDP = CDProto()
-
-    def connect(self):
-        self.s.connect(('127.0.0.1',6666))
+        self.decoder = CDProtoDecoder()
+        self.output = []  # Linhas a escrever no stdout no fim de cada iteração do loop
+        self.redraw = True  # O prompt tem de ser escrito de novo
+        self.outgoing = None  # Frames por enviar enquanto se processa um bloco de input
+        self.partial = b""  # Linha do stdin ainda sem quebra de linha
+
+    def connect(self, host: str = "127.0.0.1", port: int = 6666):
+        self.s.connect((host, port))
+        # O socket fica bloqueante para o sendall de mensagens longas; só se lê quando o selector indica dados
         self.selector.register(self.s, selectors.EVENT_READ, self.read)
-        self.s.setblocking(False)
-        # Registro no servidor
-        registerMessage = self.CDP.register(self.name)
+        # Registro no servidor, sempre com o framing original
+        registerMessage = self.CDP.register(self.name, None if self.codec == "json" else self.codec,
+                                            None if self.framing == 1 else self.framing, self.compress)
         self.CDP.send_msg(self.s, registerMessage)
+        # O servidor só nos envia frames depois de processar o registo, já no framing negociado
+        self.decoder.header = self.header
+
+    def send(self, msg):
+        """Sends a Message object with the negotiated codec and framing."""
+        if self.outgoing is not None:
+            self.outgoing.append(self.CDP.encode(msg, self.codec, self.header, self.compress))
+        else:
+            self.CDP.send_msg(self.s, msg, self.codec, self.header, self.compress)
+
+    def flush(self):
+        """Sends in a single write the frames queued while processing a block of input."""
+        if self.outgoing:
+            self.s.sendall(b"".join(self.outgoing))
+        self.outgoing = None
+
+    def show(self, text: str):
+        """Queues a line for stdout, written by render."""
+        self.output.append(text)
+
+    def notice(self, text: str):
+        """Shows a client notice, kept out of stdout in headless mode."""
+        if self.headless:
+            sys.stderr.write(text + "\n")
+        else:
+            self.show(text)
+
+    def render(self):
+        """Writes the queued lines and the prompt with a single buffered write."""
+        if not self.output and not self.redraw:
+            return
+        text = "".join(line + "\n" for line in self.output)
+        if not self.headless:
+            text += f'({self.channel})> '
+        self.output.clear()
+        self.redraw = False
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+    def quit(self, reason: str):
+        """Writes what is left, closes the connection and exits."""
+        self.flush()
+        self.render()
+        self.s.close()
+        sys.exit(reason)
 
     def read(self, sock, mask):
-        msg = self.CDP.recv_msg(self.s)
-        if msg.command == "message":
-            print(f"{msg.message}")
+        # Lê tudo o que o socket já tem, para processar todas as frames de uma vez
+        connected = self.decoder.drain(self.s)
+        try:
+            for msg in self.decoder.messages():
+                if msg and msg.command == "message":
+                    if msg.seq is not None:
+                        self.offsets[msg.channel] = max(msg.seq, self.offsets.get(msg.channel, 0))
+                    self.show(f"{msg.message}")
+                elif msg and msg.command == "ping":
+                    self.send(self.CDP.pong(msg.ts))  # Mantém a ligação viva
+                elif msg and msg.command == "chunk":
+                    self.streams.setdefault(msg.stream, []).append(msg.data)
+                    if not msg.more:
+                        self.show("".join(self.streams.pop(msg.stream)))
+        except CDProtoBadFormat:
+            # Depois de uma frame inválida o resto do stream já não se consegue separar
+            self.quit(">> O servidor enviou uma mensagem inválida.")
+        if not connected:
+            self.quit(">> O servidor terminou a ligação.")
 
     def getInputFromKeyboard(self, stdin, mask):
-
-        msg = stdin.readline().strip()  # Remover espaços e quebras de linha
-
+        try:
+            data = os.read(stdin.fileno(), self.STDIN_CHUNK)
+        except BlockingIOError:
+            return
+        lines = (self.partial + data).split(b"\n")
+        # A última parte ainda não tem quebra de linha, exceto no fim do stdin
+        self.partial = lines.pop() if data else b""
+        # Todas as linhas lidas seguem para o servidor numa só escrita
+        self.outgoing = []
+        for line in lines:
+            self.handle(line.decode("utf-8", "replace").strip())  # Remover espaços e quebras de linha
+        self.flush()
+        self.redraw = True
+        if not data:
+            self.quit(f">> {self.name} saiu do chat.")
+
+    def handle(self, msg: str):
+        """Processes one line of input: a command or a message for the current channel."""
         if msg != "":
 
             if msg == "exit":
                 # Fecha a conexão do socket deste cliente específico
-                self.s.close()
-                sys.exit(f">> {self.name} saiu do chat.")
+                self.quit(f">> {self.name} saiu do chat.")
 
             elif msg.startswith("/join "):
                 commands = msg.split(' ')
 
-                if len(commands) != 2:
-                    print(">> Nome do Canal Inválido. Use /join <nome_do_canal>")
+                if len(commands) not in (2, 3) or (len(commands) == 3 and not commands[2].lstrip("+").isdigit()):
+                    self.notice(">> Nome do Canal Inválido. Use /join <nome_do_canal> [n_mensagens_anteriores | +seq]")
 
                 else:
                     self.channel = commands[1]
-                    joinMessage = self.CDP.join(self.channel)
-                    self.CDP.send_msg(self.s, joinMessage)
-
-                    print(f">> {self.name} entrou no canal {self.channel}.")
-
+                    replay = since = None
+                    if len(commands) == 3 and commands[2].startswith("+"):
+                        since = int(commands[2][1:])  # Todas as mensagens depois de seq
+                    elif len(commands) == 3:
+                        replay = int(commands[2])
+                    elif self.channel in self.offsets:
+                        since = self.offsets[self.channel]  # Recupera o que perdeu desde a última mensagem
+                    joinMessage = self.CDP.join(self.channel, replay, since)
+                    self.send(joinMessage)
+
+                    self.notice(f">> {self.name} entrou no canal {self.channel}.")
+
+
+            elif len(msg.encode("utf-8")) > self.CHUNK_THRESHOLD:
+                if self.header == 2:
+                    self.notice(">> Mensagem demasiado longa.")
+                else:
+                    self.sent_streams += 1
+                    for chunk in self.CDP.chunks(str(self.sent_streams), msg, self.channel, self.CHUNK_SIZE):
+                        self.send(chunk)
 
             else:
-                
+
                 sendMessage = self.CDP.message(msg, self.channel)
-                self.CDP.send_msg(self.s, sendMessage)
+                self.send(sendMessage)
 
-        else:
-            print("Mensagem Vazia")
+        elif not self.headless:
+            self.notice("Mensagem Vazia")
 
 
 
@@ -74,8 +190,8 @@ class Client:
         self.selector.register(sys.stdin, selectors.EVENT_READ, self.getInputFromKeyboard)
 
         while True:
-            sys.stdout.write(f'({self.channel})> ')
-            sys.stdout.flush()
+            # O prompt e as mensagens recebidas só são escritos uma vez por iteração
+            self.render()
             for k, mask in self.selector.select():
                 callback = k.data
                 callback(k.fileobj, mask)
@@ -0,0 +1,224 @@
+"""Multi-process CD Chat server sharing one port."""
+import errno
+import logging
+import multiprocessing
+import os
+import selectors
+import socket
+
+from .server import OutboundQueue, Server
+
+logger = logging.getLogger("Cluster")
+
+class ChannelBus:
+    """Carries channel broadcasts between the worker processes of a cluster.
+
+    Workers are connected pairwise by Unix SOCK_SEQPACKET sockets. Every
+    worker announces the channels it has members in, and a broadcast is only
+    forwarded to the workers interested in its channel. Records larger than
+    MAX_RECORD, which may not fit in the socket buffer, are sent in FRAGMENT
+    pieces ending with a LAST one and rebuilt by the receiver. Broadcasts
+    for a worker with more than high_water bytes queued are discarded, as
+    the link cannot be redialed; interest announcements are always queued.
+    """
+
+    SUBSCRIBE = 0
+    UNSUBSCRIBE = 1
+    PUBLISH = 2
+    FRAGMENT = 3
+    LAST = 4
+    MAX_RECORD = 1 << 16  # Bem abaixo do buffer de um socket Unix (cerca de 208 KiB)
+
+    def __init__(self, peers, high_water: int = 1 << 26):
+        """Initialize the bus with the sockets connected to the other workers.
+
+        Parameters:
+            peers: sockets connected to the other workers
+            high_water: bytes queued for a worker above which broadcasts to it are discarded
+        """
+        self.peers = list(peers)
+        self.high_water = high_water
+        self.interest = {}  # canal -> workers (sockets) com membros nesse canal
+        self.outbound = {peer: OutboundQueue() for peer in self.peers}
+        self.partial = {}  # Pedaços recebidos de um registo longo de cada worker
+        self.server = None
+
+    def attach(self, server):
+        """Register the bus sockets in the selector of a server."""
+        self.server = server
+        for peer in self.peers:
+            peer.setblocking(False)
+            server.selector.register(peer, selectors.EVENT_READ, self.service)
+
+    @staticmethod
+    def record(kind: int, channel: str, payload=b"") -> bytes:
+        """Build a bus record: kind, channel length, channel and payload."""
+        name = channel.encode("utf-8")
+        return bytes([kind]) + len(name).to_bytes(2, "big") + name + payload
+
+    def subscribe(self, channel):
+        """Tell the other workers that this worker has members in channel."""
+        record = self.record(self.SUBSCRIBE, channel)
+        for peer in self.peers:
+            self.send(peer, record)
+
+    def unsubscribe(self, channel):
+        """Tell the other workers that this worker has no members left in channel."""
+        record = self.record(self.UNSUBSCRIBE, channel)
+        for peer in self.peers:
+            self.send(peer, record)
+
+    def publish(self, channel, frame, header=0):
+        """Forward a broadcast frame to the workers with members in channel.
+
+        header limits the delivery to members using that framing, 0 means everyone.
+        """
+        peers = self.interest.get(channel)
+        if peers:
+            record = self.record(self.PUBLISH, channel, bytes([header]) + frame)
+            for peer in peers:
+                self.send(peer, record)
+
+    def timeout(self):
+        """The bus has no deadlines of its own."""
+        return None
+
+    def tick(self):
+        pass
+
+    def send(self, peer, record):
+        """Queue a record for a worker without blocking."""
+        queue = self.outbound.get(peer)
+        if queue is None:
+            return
+        if record[0] == self.PUBLISH and queue.size + len(record) > self.high_water:
+            # O worker não acompanha o ritmo: perde a mensagem, mas continua no bus
+            self.server.metrics.dropped += 1
+            return
+        was_idle = queue.size == 0
+        if len(record) <= self.MAX_RECORD:
+            queue.append(record)
+        else:
+            step = self.MAX_RECORD - 1
+            for start in range(0, len(record), step):
+                kind = self.FRAGMENT if start + step < len(record) else self.LAST
+                queue.append(bytes([kind]) + record[start:start + step])
+        if was_idle:
+            self.write(peer)
+
+    def write(self, peer):
+        """Flush the records queued for a worker."""
+        queue = self.outbound[peer]
+        while True:
+            try:
+                done = queue.write(peer)
+                break
+            except OSError as e:
+                if e.errno != errno.EMSGSIZE:
+                    self.drop(peer)
+                    return
+                # Registo maior do que o buffer do socket: é descartado, o worker continua vivo
+                logger.warning("Bus record of %d bytes too large for the socket", len(queue.frames[0]))
+                queue.size -= len(queue.frames.popleft())
+        if queue.writing == done:
+            queue.writing = not done
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if queue.writing else selectors.EVENT_READ
+            self.server.selector.modify(peer, events, self.service)
+
+    def service(self, peer, mask):
+        """Dispatch selector events of a bus socket."""
+        if mask & selectors.EVENT_WRITE:
+            self.write(peer)
+        if mask & selectors.EVENT_READ and peer in self.outbound:
+            self.read(peer)
+
+    def read(self, peer):
+        """Process every record received from a worker."""
+        while True:
+            try:
+                record = peer.recv(self.MAX_RECORD)
+            except BlockingIOError:
+                return
+            except OSError:
+                record = b""
+            if not record:  # O worker terminou
+                self.drop(peer)
+                return
+            if record[0] in (self.FRAGMENT, self.LAST):
+                partial = self.partial.setdefault(peer, bytearray())
+                partial += memoryview(record)[1:]
+                if record[0] == self.FRAGMENT:
+                    continue
+                record = bytes(self.partial.pop(peer))
+            size = int.from_bytes(record[1:3], "big")
+            channel = record[3:3 + size].decode("utf-8")
+            if record[0] == self.SUBSCRIBE:
+                self.interest.setdefault(channel, set()).add(peer)
+            elif record[0] == self.UNSUBSCRIBE:
+                peers = self.interest.get(channel)
+                if peers is not None:
+                    peers.discard(peer)
+                    if not peers:
+                        del self.interest[channel]
+            elif record[0] == self.PUBLISH:
+                self.server.deliver(channel, memoryview(record)[4 + size:], record[3 + size])
+
+    def drop(self, peer):
+        """Forget a worker that went away."""
+        for channel in list(self.interest):
+            self.interest[channel].discard(peer)
+            if not self.interest[channel]:
+                del self.interest[channel]
+        self.outbound.pop(peer, None)
+        self.partial.pop(peer, None)
+        self.peers.remove(peer)
+        self.server.selector.unregister(peer)
+        peer.close()
+
+
+class Cluster:
+    """Runs several Server workers that share the chat port through SO_REUSEPORT."""
+
+    def __init__(self, workers: int = os.cpu_count(), **options):
+        """Initialize the cluster.
+
+        Parameters:
+            workers: number of worker processes
+            options: keyword arguments of every worker Server
+        """
+        if options.get("log_dir") is not None:
+            # Cada worker numeraria as mensagens de um canal de forma independente
+            raise ValueError("The message log needs a single worker")
+        self.workers = workers
+        self.options = options
+
+    def work(self, index, ends):
+        """Run one worker with its ends of the bus sockets."""
+        for i, sockets in enumerate(ends):
+            if i != index:
+                for sock in sockets:
+                    sock.close()  # Pertencem a outros workers
+        options = dict(self.options)
+        if options.get("admin_port") is not None:
+            options["admin_port"] += index  # Cada worker tem a sua porta de administração
+        s = Server(reuse_port=True, bus=ChannelBus(ends[index]), **options)
+        s.loop()
+
+    def loop(self):
+        """Start the workers and wait for them."""
+        ends = [[] for _ in range(self.workers)]
+        for i in range(self.workers):
+            for j in range(i + 1, self.workers):
+                a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+                ends[i].append(a)
+                ends[j].append(b)
+
+        context = multiprocessing.get_context("fork")  # Os workers herdam os sockets do barramento
+        processes = [context.Process(target=self.work, args=(i, ends)) for i in range(self.workers)]
+        for process in processes:
+            process.start()
+        for sockets in ends:
+            for sock in sockets:
+                sock.close()
+        for process in processes:
+            process.join()
@@ -0,0 +1,324 @@
+"""Federation of CD Chat servers linked by trunk connections."""
+import errno
+import os
+import selectors
+import socket
+import time
+from collections import OrderedDict, deque
+
+from .protocol import BinaryCodec, CDProtoDecoder
+from .server import OutboundQueue
+
+
+class Trunk:
+    """A connection to a peer server."""
+
+    __slots__ = ("sock", "address", "peer", "outbound", "decoder")
+
+    def __init__(self, sock, address=None):
+        self.sock = sock
+        self.address = address  # Endereço a que nos ligamos, None se foi o outro servidor
+        self.peer = None  # Id do outro servidor, conhecido pelo seu HELLO
+        self.outbound = OutboundQueue()
+        self.decoder = CDProtoDecoder(header=4)
+
+
+class Federation:
+    """Carries channel broadcasts between chat servers, used as the bus of a Server.
+
+    Servers are linked by TCP trunks in any topology. Every server floods the
+    channels it has members in, numbered by a per-server sequence so that
+    repeated and stale announcements are ignored; each server remembers
+    through which trunk it first heard of every interested server. A
+    broadcast only follows those trunks, carries its origin, id and the
+    servers it went through, and is delivered once thanks to a window of
+    the last ids seen. Servers that leave a channel are forgotten, only a
+    window of the last departures is kept to ignore their stale
+    announcements. A trunk whose queue outgrows high_water is dropped, and
+    redialed if this server dialed it.
+
+    Records are frames with a 4 byte length and a kind byte, fields encoded
+    as in BinaryCodec:
+        HELLO: server id
+        SUBSCRIBE, UNSUBSCRIBE: origin, seq, channel
+        PUBLISH: origin, message id, header, path, channel, CANONICAL frame
+    """
+
+    HELLO = 0
+    SUBSCRIBE = 1
+    UNSUBSCRIBE = 2
+    PUBLISH = 3
+    RETRY = 2.0  # Segundos até voltar a tentar uma ligação
+    SEEN = 1 << 16  # Mensagens lembradas para descartar repetidas
+
+    def __init__(self, listen: tuple = None, peers=(), server_id: str = None, high_water: int = 1 << 26):
+        """Initialize the federation.
+
+        Parameters:
+            listen: (host, port) where peer servers connect, None to only dial
+            peers: (host, port) of the servers to link to, redialed when the link drops
+            server_id: unique id of this server, random by default
+            high_water: bytes queued for a peer server before its trunk is dropped
+        """
+        self.id = server_id or os.urandom(8).hex()
+        self.listen = listen
+        self.trunks = {}  # socket -> Trunk
+        self.interest = {}  # canal -> {origem: [seq, trunks por onde a conhecemos]}
+        self.left = OrderedDict()  # (canal, origem) -> seq com que saiu, das últimas saídas
+        self.high_water = high_water
+        self.seq = 0  # Anúncios de interesse deste servidor
+        self.published = 0  # Mensagens originadas neste servidor
+        self.seen = set()
+        self.seen_order = deque()
+        self.retry = {tuple(address): 0 for address in peers}  # Endereço -> instante da próxima tentativa
+        self.server = None
+
+    def attach(self, server):
+        """Start listening and dialing with the selector of a server."""
+        self.server = server
+        if self.listen is not None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind(self.listen)
+            self.sock.listen()
+            self.sock.setblocking(False)
+            server.selector.register(self.sock, selectors.EVENT_READ, self.accept)
+        self.tick()
+
+    def accept(self, sock, mask):
+        """Accept a trunk from a peer server."""
+        conn, addr = sock.accept()
+        self.open(Trunk(conn))
+
+    def dial(self, address):
+        """Start a non-blocking connection to a peer server."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        err = sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS):
+            sock.close()
+            self.retry[address] = time.monotonic() + self.RETRY
+            return
+        trunk = Trunk(sock, address)
+        self.trunks[sock] = trunk
+        self.server.selector.register(sock, selectors.EVENT_WRITE, self.connected)
+
+    def connected(self, sock, mask):
+        """Finish a connection started by dial."""
+        trunk = self.trunks.get(sock)
+        if trunk is None:  # Descartado por um evento anterior do mesmo select
+            return
+        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+            self.drop(trunk)
+            return
+        self.server.selector.unregister(sock)
+        self.open(trunk)
+
+    def open(self, trunk):
+        """Start using a trunk: introduce this server and summarize the interest known here."""
+        trunk.sock.setblocking(False)
+        self.trunks[trunk.sock] = trunk
+        self.server.selector.register(trunk.sock, selectors.EVENT_READ, self.service)
+        self.send(trunk, self.record(self.HELLO, self.id))
+        for channel, origins in self.interest.items():
+            for origin, (seq, trunks) in origins.items():
+                self.send(trunk, self.record(self.SUBSCRIBE, origin, seq, channel))
+
+    @staticmethod
+    def record(kind: int, *fields, payload=b"") -> bytes:
+        """Build a trunk record. Fields are str, int or a list of str."""
+        out = bytearray(4)
+        out.append(kind)
+        for field in fields:
+            if isinstance(field, str):
+                BinaryCodec.put_str(out, field)
+            elif isinstance(field, int):
+                BinaryCodec.put_varint(out, field)
+            else:
+                BinaryCodec.put_varint(out, len(field))
+                for item in field:
+                    BinaryCodec.put_str(out, item)
+        out += payload
+        out[:4] = (len(out) - 4).to_bytes(4, "big")
+        return bytes(out)
+
+    def subscribe(self, channel):
+        """Tell the federation that this server has members in channel."""
+        self.announce(self.SUBSCRIBE, channel, [])
+
+    def unsubscribe(self, channel):
+        """Tell the federation that this server has no members left in channel."""
+        self.announce(self.UNSUBSCRIBE, channel, None)
+
+    def announce(self, kind, channel, trunks):
+        self.seq += 1
+        if kind == self.SUBSCRIBE:
+            self.interest.setdefault(channel, {})[self.id] = [self.seq, trunks]
+        else:
+            self.forget(channel, self.id)
+        record = self.record(kind, self.id, self.seq, channel)
+        for trunk in list(self.trunks.values()):
+            self.send(trunk, record)
+
+    def publish(self, channel, frame, header=0):
+        """Forward a broadcast frame of a local member to the servers with members in channel."""
+        self.published += 1
+        self.forward(self.id, self.published, header, [self.id], channel, frame)
+
+    def forward(self, origin, mid, header, path, channel, frame):
+        """Send a broadcast through the trunks leading to interested servers not in its path."""
+        targets = []
+        for interested, (seq, trunks) in self.interest.get(channel, {}).items():
+            # Uma única rota por servidor interessado: o trunk por onde o conhecemos primeiro
+            if trunks and interested not in path and trunks[0].peer not in path and trunks[0] not in targets:
+                targets.append(trunks[0])
+        if targets:
+            record = self.record(self.PUBLISH, origin, mid, header, path, channel, payload=frame)
+            for trunk in targets:
+                self.send(trunk, record)
+
+    def forget(self, channel, origin):
+        """Remove a server from the interested in channel, and the channel once nobody is."""
+        origins = self.interest.get(channel)
+        if origins is not None:
+            origins.pop(origin, None)
+            if not origins:
+                del self.interest[channel]
+
+    def remember(self, key) -> bool:
+        """Add a message to the window of seen ones. False if it was already there."""
+        if key in self.seen:
+            return False
+        self.seen.add(key)
+        self.seen_order.append(key)
+        if len(self.seen_order) > self.SEEN:
+            self.seen.discard(self.seen_order.popleft())
+        return True
+
+    def timeout(self):
+        """Seconds until the next link should be redialed, or None."""
+        if not self.retry:
+            return None
+        return max(min(self.retry.values()) - time.monotonic(), 0)
+
+    def tick(self):
+        """Redial the peer links whose retry time has come."""
+        now = time.monotonic()
+        for address, when in list(self.retry.items()):
+            if when <= now:
+                del self.retry[address]
+                self.dial(address)
+
+    def send(self, trunk, record):
+        """Queue a record for a peer server without blocking."""
+        queue = trunk.outbound
+        if queue.size + len(record) > self.high_water:
+            if trunk.sock in self.trunks:
+                self.drop(trunk)  # Não acompanha o ritmo: volta a sincronizar-se quando se religar
+            return
+        was_idle = queue.size == 0
+        queue.append(record)
+        if was_idle and trunk.sock in self.trunks:
+            self.write(trunk)
+
+    def write(self, trunk):
+        """Flush the records queued for a peer server."""
+        queue = trunk.outbound
+        try:
+            done = queue.writev(trunk.sock)
+        except OSError:
+            self.drop(trunk)
+            return
+        if queue.writing == done:
+            queue.writing = not done
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if queue.writing else selectors.EVENT_READ
+            self.server.selector.modify(trunk.sock, events, self.service)
+
+    def service(self, sock, mask):
+        """Dispatch selector events of a trunk."""
+        trunk = self.trunks.get(sock)
+        if trunk is None:  # Descartado por um evento anterior do mesmo select
+            return
+        if mask & selectors.EVENT_WRITE:
+            self.write(trunk)
+        if mask & selectors.EVENT_READ and sock in self.trunks:
+            self.read(trunk)
+
+    def read(self, trunk):
+        """Process every record received from a peer server."""
+        try:
+            connected = trunk.decoder.read(trunk.sock)
+            for record in trunk.decoder.frames():
+                self.handle(trunk, record)
+                if trunk.sock not in self.trunks:  # Descartado, p.ex. ligação a nós próprios
+                    return
+        except (ValueError, IndexError, OSError):
+            connected = False
+        if not connected:
+            self.drop(trunk)
+
+    def handle(self, trunk, record):
+        kind = record[0]
+        origin, pos = BinaryCodec.get_str(record, 1)
+        if kind == self.HELLO:
+            trunk.peer = origin
+            if origin == self.id:  # Ligação a nós próprios
+                self.drop(trunk)
+        elif kind in (self.SUBSCRIBE, self.UNSUBSCRIBE):
+            seq, pos = BinaryCodec.get_varint(record, pos)
+            channel, pos = BinaryCodec.get_str(record, pos)
+            self.learn(trunk, kind, origin, seq, channel, record)
+        elif kind == self.PUBLISH:
+            mid, pos = BinaryCodec.get_varint(record, pos)
+            header, pos = BinaryCodec.get_varint(record, pos)
+            hops, pos = BinaryCodec.get_varint(record, pos)
+            path = []
+            for _ in range(hops):
+                server, pos = BinaryCodec.get_str(record, pos)
+                path.append(server)
+            channel, pos = BinaryCodec.get_str(record, pos)
+            if origin == self.id or not self.remember((origin, mid)):
+                return  # Já passou por aqui
+            frame = memoryview(record)[pos:]
+            self.server.deliver(channel, frame, header)
+            self.forward(origin, mid, header, path + [self.id], channel, frame)
+
+    def learn(self, trunk, kind, origin, seq, channel, record):
+        """Apply an interest announcement and flood it if it is new."""
+        if origin == self.id:
+            return
+        entry = self.interest.get(channel, {}).get(origin)
+        latest = entry[0] if entry is not None else self.left.get((channel, origin), 0)
+        if seq > latest:
+            if kind == self.SUBSCRIBE:
+                self.interest.setdefault(channel, {})[origin] = [seq, [trunk]]
+                self.left.pop((channel, origin), None)
+            else:
+                self.forget(channel, origin)
+                self.left[channel, origin] = seq
+                self.left.move_to_end((channel, origin))
+                if len(self.left) > self.SEEN:
+                    self.left.popitem(last=False)
+            framed = len(record).to_bytes(4, "big") + record
+            for other in list(self.trunks.values()):
+                if other is not trunk:
+                    self.send(other, framed)
+        elif entry is not None and seq == entry[0] and trunk not in entry[1]:
+            entry[1].append(trunk)  # Rota alternativa
+
+    def drop(self, trunk):
+        """Forget a trunk that went away, and redial it if it was ours."""
+        for channel, origins in list(self.interest.items()):
+            for origin, (seq, trunks) in list(origins.items()):
+                if trunk in trunks:
+                    trunks.remove(trunk)
+                    if not trunks:  # Sem rotas, até que volte a ser anunciado
+                        self.forget(channel, origin)
+        self.trunks.pop(trunk.sock, None)
+        try:
+            self.server.selector.unregister(trunk.sock)
+        except (KeyError, ValueError):
+            pass
+        trunk.sock.close()
+        if trunk.address is not None and trunk.peer != self.id:
+            self.retry[trunk.address] = time.monotonic() + self.RETRY
@@ -0,0 +1,116 @@
+"""Runtime metrics of the chat server."""
+import json
+
+
+class Histogram:
+    """Histogram with power of two buckets, cheap enough for the hot path."""
+
+    def __init__(self):
+        self.buckets = [0] * 65
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value: int):
+        self.buckets[min(value.bit_length(), 64)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p: float) -> int:
+        """Upper bound of the bucket holding the p-th percentile."""
+        rank = p * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min((1 << i) - 1, self.max)
+        return 0
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0,
+            "p50": self.percentile(0.50),
+            "p99": self.percentile(0.99),
+            "p999": self.percentile(0.999),
+            "max": self.max,
+        }
+
+
+class Metrics:
+    """Counters and histograms updated by the server as it runs."""
+
+    def __init__(self):
+        self.messages_in = {}  # canal com membros -> mensagens publicadas
+        self.messages_out = {}  # canal com membros -> frames entregues aos membros
+        self.total_in = 0
+        self.total_out = 0
+        self.bytes_out = 0
+        self.dropped = 0  # Frames descartadas por consumidores lentos
+        self.limited = 0  # Mensagens descartadas por excederem o limite de ritmo
+        self.reaped = 0  # Conexões fechadas por não responderem ao keepalive
+        self.fanout = Histogram()  # Duração de cada fan-out em microssegundos
+
+    def message(self, channel: str, recipients: int, duration_ns: int):
+        """Account a message published in channel and delivered to recipients.
+
+        channel is None for channels without local members, which are only
+        counted in the totals.
+        """
+        self.total_in += 1
+        self.total_out += recipients
+        if channel is not None:
+            self.messages_in[channel] = self.messages_in.get(channel, 0) + 1
+            self.messages_out[channel] = self.messages_out.get(channel, 0) + recipients
+        self.fanout.record(duration_ns // 1000)
+
+    def forget(self, channel: str):
+        """Drop the counters of a channel left without members."""
+        self.messages_in.pop(channel, None)
+        self.messages_out.pop(channel, None)
+
+    def snapshot(self, users: int, members: dict, queues, top: int = 50) -> dict:
+        """Build a report of the metrics and of the current server state.
+
+        Parameters:
+            users: registered users
+            members: channel -> number of local members
+            queues: bytes pending in the outbound buffer of each connection
+            top: number of channels reported, busiest first
+        """
+        queues = list(queues)
+        hot = sorted(self.messages_in, key=self.messages_in.get, reverse=True)[:top]
+        return {
+            "users": users,
+            "connections": len(queues),
+            "channels": len(members),
+            "messages_in": self.total_in,
+            "messages_out": self.total_out,
+            "bytes_out": self.bytes_out,
+            "dropped": self.dropped,
+            "limited": self.limited,
+            "reaped": self.reaped,
+            "fanout_us": self.fanout.snapshot(),
+            "outbound": {
+                "pending_bytes": sum(queues),
+                "max_bytes": max(queues, default=0),
+                "backlogged": sum(1 for size in queues if size),
+            },
+            "hot_channels": {
+                channel: {
+                    "members": members.get(channel, 0),
+                    "in": self.messages_in[channel],
+                    "out": self.messages_out[channel],
+                }
+                for channel in hot
+            },
+        }
+
+
+def http_response(report: dict) -> bytes:
+    """Encode a metrics report as an HTTP/1.0 JSON response."""
+    body = json.dumps(report, indent=2).encode("utf-8")
+    header = f"HTTP/1.0 200 OK\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n"
+    return header.encode("ascii") + body
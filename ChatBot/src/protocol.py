@@ -1,104 +1,535 @@
 """Protocol for chat server - Computação Distribuida Assignment 1."""
 import json
+import zlib
 from datetime import datetime
-from socket import socket
+from socket import MSG_DONTWAIT, socket
 
 
 class Message:
     """Message Type."""
+    __slots__ = ("command",)  # Sem __dict__ por instância
+
     def __init__(self,command):
         self.command = command
 
+    def __str__(self):
+        return json.dumps(self.fields(), ensure_ascii=False)
+
     
 class JoinMessage(Message):
-    """Message to join a chat channel."""
-    def __init__(self, channel):
+    """Message to join a chat channel, optionally asking for its last messages.
+
+    replay asks for the last n messages, since for every logged message with a
+    greater sequence number.
+    """
+    __slots__ = ("channel", "replay", "since")
+
+    def __init__(self, channel, replay=None, since=None):
         super().__init__(command = "join")
         self.channel = channel        
+        self.replay = replay
+        self.since = since
     
-    def __str__(self):
-        return f"{{\"command\": \"{self.command}\", \"channel\": \"{self.channel}\"}}"
+    def fields(self):
+        fields = {"command": self.command, "channel": self.channel}
+        if self.replay is not None:
+            fields["replay"] = self.replay
+        if self.since is not None:
+            fields["since"] = self.since
+        return fields
 
 
 class RegisterMessage(Message):
-    """Message to register username in the server."""
-    def __init__(self, user):
+    """Message to register username in the server, optionally negotiating the codec, framing and compression."""
+    __slots__ = ("user", "codec", "framing", "compress")
+
+    def __init__(self, user, codec=None, framing=None, compress=None):
         super().__init__(command = "register")
         self.user = user
+        self.codec = codec
+        self.framing = framing
+        self.compress = compress
     
-    def __str__(self):
-        return f"{{\"command\": \"{self.command}\", \"user\": \"{self.user}\"}}"
+    def fields(self):
+        fields = {"command": self.command, "user": self.user}
+        if self.codec is not None:
+            fields["codec"] = self.codec
+        if self.framing is not None:
+            fields["framing"] = self.framing
+        if self.compress is not None:
+            fields["compress"] = self.compress
+        return fields
     
 
     
 class TextMessage(Message):
     """Message to chat with other clients."""
-    def __init__(self,message, channel, ts=None):
+    __slots__ = ("message", "channel", "ts", "seq")
+
+    def __init__(self,message, channel, ts=None, seq=None):
         super().__init__(command="message")
         self.message = message
         self.channel = channel
         self.ts = ts if ts is not None else int(datetime.now().timestamp())
+        self.seq = seq  # Posição no log do canal, atribuída pelo servidor
 
-    def __str__(self):
-        base = f'{{"command": "{self.command}", "message": "{self.message}", "ts": {self.ts}'
+    def fields(self):
+        fields = {"command": self.command, "message": self.message, "ts": self.ts}
         if self.channel is not None:
-            return base + f', "channel": "{self.channel}"}}'
-        return base + '}'
+            fields["channel"] = self.channel
+        if self.seq is not None:
+            fields["seq"] = self.seq
+        return fields
 
 
-        
+class ChunkMessage(Message):
+    """Piece of a message too large to send in a single frame."""
+    __slots__ = ("stream", "data", "channel", "more", "ts")
+
+    def __init__(self, stream, data, channel, more, ts=None):
+        super().__init__(command="chunk")
+        self.stream = stream  # Identifica a mensagem a que o pedaço pertence
+        self.data = data
+        self.channel = channel
+        self.more = more  # False no último pedaço
+        self.ts = ts if ts is not None else int(datetime.now().timestamp())
+
+    def fields(self):
+        fields = {"command": self.command, "stream": self.stream, "data": self.data,
+                  "more": self.more, "ts": self.ts}
+        if self.channel is not None:
+            fields["channel"] = self.channel
+        return fields
+
+
+class PingMessage(Message):
+    """Keepalive probe, answered with a PongMessage carrying the same ts."""
+    __slots__ = ("ts",)
+
+    def __init__(self, ts=None, command="ping"):
+        super().__init__(command=command)
+        self.ts = ts
+
+    def fields(self):
+        fields = {"command": self.command}
+        if self.ts is not None:
+            fields["ts"] = self.ts
+        return fields
+
+
+class PongMessage(PingMessage):
+    """Answer to a PingMessage."""
+    __slots__ = ()
+
+    def __init__(self, ts=None):
+        super().__init__(ts, command="pong")
+
+
+class BinaryCodec:
+    """Compact binary encoding of messages.
+
+    A payload is a command byte followed by the fields of the message. Integers
+    are varints and strings are a varint length plus raw UTF-8; optional
+    fields store length + 1 so that 0 means absent.
+    """
+
+    JOIN = 1
+    REGISTER = 2
+    MESSAGE = 3
+    CHUNK = 4
+    PING = 5
+    PONG = 6
+
+    @staticmethod
+    def put_varint(out: bytearray, n: int):
+        while n >= 0x80:
+            out.append((n & 0x7F) | 0x80)
+            n >>= 7
+        out.append(n)
+
+    @staticmethod
+    def get_varint(buf, pos: int):
+        n = shift = 0
+        while True:
+            byte = buf[pos]
+            pos += 1
+            n |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return n, pos
+            shift += 7
+
+    @classmethod
+    def put_str(cls, out: bytearray, text: str):
+        data = text.encode("utf-8")
+        cls.put_varint(out, len(data))
+        out += data
+
+    @classmethod
+    def get_str(cls, buf, pos: int):
+        size, pos = cls.get_varint(buf, pos)
+        return str(buf[pos:pos + size], "utf-8"), pos + size
+
+    @classmethod
+    def put_optional(cls, out: bytearray, value):
+        if value is None:
+            out.append(0)
+        else:
+            data = str(value).encode("utf-8")
+            cls.put_varint(out, len(data) + 1)
+            out += data
+
+    @classmethod
+    def get_optional(cls, buf, pos: int):
+        size, pos = cls.get_varint(buf, pos)
+        if size == 0:
+            return None, pos
+        return str(buf[pos:pos + size - 1], "utf-8"), pos + size - 1
+
+    @classmethod
+    def encode(cls, msg: Message) -> bytes:
+        out = bytearray()
+        if msg.command == "join":
+            out.append(cls.JOIN)
+            cls.put_str(out, msg.channel)
+            cls.put_varint(out, 0 if msg.replay is None else msg.replay + 1)
+            cls.put_varint(out, 0 if msg.since is None else msg.since + 1)
+        elif msg.command == "register":
+            out.append(cls.REGISTER)
+            cls.put_str(out, msg.user)
+            cls.put_optional(out, msg.codec)
+            cls.put_varint(out, msg.framing or 0)
+            cls.put_optional(out, msg.compress)
+        elif msg.command == "message":
+            out.append(cls.MESSAGE)
+            cls.put_str(out, msg.message)
+            cls.put_varint(out, msg.ts)
+            cls.put_optional(out, msg.channel)
+            cls.put_varint(out, 0 if msg.seq is None else msg.seq + 1)
+        elif msg.command == "chunk":
+            out.append(cls.CHUNK)
+            cls.put_str(out, msg.stream)
+            cls.put_str(out, msg.data)
+            out.append(1 if msg.more else 0)
+            cls.put_varint(out, msg.ts)
+            cls.put_optional(out, msg.channel)
+        elif msg.command in ("ping", "pong"):
+            out.append(cls.PING if msg.command == "ping" else cls.PONG)
+            cls.put_varint(out, 0 if msg.ts is None else msg.ts + 1)
+        return bytes(out)
+
+    @classmethod
+    def decode(cls, payload) -> Message:
+        command = payload[0]
+        if command == cls.JOIN:
+            channel, pos = cls.get_str(payload, 1)
+            replay, pos = cls.get_varint(payload, pos)
+            since, pos = cls.get_varint(payload, pos) if pos < len(payload) else (0, pos)
+            return JoinMessage(channel, replay - 1 if replay else None, since - 1 if since else None)
+        elif command == cls.REGISTER:
+            user, pos = cls.get_str(payload, 1)
+            codec, pos = cls.get_optional(payload, pos)
+            framing, pos = cls.get_varint(payload, pos)
+            compress, pos = cls.get_optional(payload, pos) if pos < len(payload) else (None, pos)
+            return RegisterMessage(user, codec, framing or None, compress)
+        elif command == cls.MESSAGE:
+            message, pos = cls.get_str(payload, 1)
+            ts, pos = cls.get_varint(payload, pos)
+            channel, pos = cls.get_optional(payload, pos)
+            seq, pos = cls.get_varint(payload, pos) if pos < len(payload) else (0, pos)
+            return TextMessage(message, channel, ts, seq - 1 if seq else None)
+        elif command == cls.CHUNK:
+            stream, pos = cls.get_str(payload, 1)
+            data, pos = cls.get_str(payload, pos)
+            more = bool(payload[pos])
+            ts, pos = cls.get_varint(payload, pos + 1)
+            channel, pos = cls.get_optional(payload, pos)
+            return ChunkMessage(stream, data, channel, more, ts)
+        elif command in (cls.PING, cls.PONG):
+            ts, pos = cls.get_varint(payload, 1)
+            return (PingMessage if command == cls.PING else PongMessage)(ts - 1 if ts else None)
+        raise ValueError(f"Unknown command byte {command}")
 
 
 class CDProto:
     """Computação Distribuida Protocol."""
 
+    CODECS = ("json", "binary")
+    # Versões do framing: 1 prefixa cada frame com 2 bytes de tamanho, 2 com 4 bytes
+    HEADERS = {1: 2, 2: 4}
+    COMPRESSIONS = ("zlib",)
+    # Formato (codec, header, compressão) das frames guardadas e trocadas entre servidores
+    CANONICAL = ("json", 4, None)
+    MAX_FRAME = 1 << 24
+    COMPRESS_MIN = 64  # Payloads mais pequenos não compensam
+    # Dicionário partilhado do zlib, com o texto mais frequente no fim
+    ZDICT = (
+        b" de que para com uma os no se na por mais as dos como mas ao the and to of is in it you that for "
+        b'{"command": "register", "user": "codec": "binary", "framing": 2, "compress": "zlib"}'
+        b'{"command": "join", "channel": "#", "replay": "since": '
+        b'{"command": "chunk", "stream": "data": "more": false, "more": true, '
+        b'{"command": "message", "message": "(): ", "ts": 17, "channel": "None", "seq": '
+    )
+
     @classmethod
-    def register(cls, username: str) -> RegisterMessage:
+    def register(cls, username: str, codec: str = None, framing: int = None, compress: str = None) -> RegisterMessage:
         """Creates a RegisterMessage object."""
-        return RegisterMessage(username)
+        return RegisterMessage(username, codec, framing, compress)
 
     @classmethod
-    def join(cls, channel: str) -> JoinMessage:
+    def join(cls, channel: str, replay: int = None, since: int = None) -> JoinMessage:
         """Creates a JoinMessage object."""
-        return JoinMessage(channel)
+        return JoinMessage(channel, replay, since)
 
     @classmethod
     def message(cls, message: str,channel: str = None) -> TextMessage:
         """Creates a TextMessage object with current timestamp."""
         return TextMessage(message, channel)
 
+    @classmethod
+    def pong(cls, ts: int = None) -> PongMessage:
+        """Creates the PongMessage answering a ping."""
+        return PongMessage(ts)
+
+    @classmethod
+    def chunks(cls, stream: str, message: str, channel: str = None, size: int = 16384):
+        """Splits a message into ChunkMessage objects of at most size characters."""
+        ts = int(datetime.now().timestamp())
+        for start in range(0, len(message), size):
+            more = start + size < len(message)
+            yield ChunkMessage(stream, message[start:start + size], channel, more, ts)
+
+
+    @classmethod
+    def encode(cls, msg: Message, codec: str = "json", header: int = 2, compress: str = None) -> bytes:
+        """Serializes a Message object into a frame prefixed by a header-byte length.
+
+        Raises OverflowError if the message does not fit in the header.
+        """
+        if codec == "binary":
+            payload = BinaryCodec.encode(msg)
+        else:
+            payload = str(msg).encode("utf-8")
+        if compress is not None:
+            payload = cls.compress(payload)
+        return len(payload).to_bytes(header, "big") + payload
+
+    @classmethod
+    def compress(cls, payload: bytes) -> bytes:
+        """Compresses a payload with zlib and the shared dictionary, unless that does not make it smaller.
+
+        Every frame is compressed on its own, so the same compressed frame
+        can be sent to every connection that negotiated compression.
+        """
+        if len(payload) < cls.COMPRESS_MIN:
+            return payload
+        compressor = zlib.compressobj(zdict=cls.ZDICT)
+        compressed = compressor.compress(payload) + compressor.flush()
+        return compressed if len(compressed) < len(payload) else payload
+
+    @classmethod
+    def decompress(cls, payload: bytes) -> bytes:
+        """Inverse of compress, refusing payloads that expand beyond MAX_FRAME."""
+        decompressor = zlib.decompressobj(zdict=cls.ZDICT)
+        data = decompressor.decompress(payload, cls.MAX_FRAME)
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ValueError("Compressed payload too large or truncated")
+        return data
 
     @classmethod
-    def send_msg(cls, connection: socket, msg: Message):
+    def send_msg(cls, connection: socket, msg: Message, codec: str = "json", header: int = 2, compress: str = None):
         """Sends through a connection a Message object."""
-        json_msg = str(msg).encode("utf-8")
-        json_msg_len = len(json_msg).to_bytes(2,"big")
-        connection.sendall(json_msg_len + json_msg)
+        connection.sendall(cls.encode(msg, codec, header, compress))
+
+    @classmethod
+    def broadcast(cls, connections, msg, send=None, wire=None) -> bytes:
+        """Sends a message to several connections, encoding it only once per wire format.
+
+        msg is a Message or a FrameCache. send(connection, frame) replaces
+        connection.sendall, e.g. to queue the frame instead, and wire(connection)
+        gives the (codec, header) negotiated by each connection. Connections
+        whose framing cannot hold the message are skipped.
+        Returns the frame in the CANONICAL format.
+        """
+        frames = msg if isinstance(msg, FrameCache) else FrameCache(msg)
+        for connection in connections:
+            frame = frames.get(*(("json", 2) if wire is None else wire(connection)))
+            if frame is None:
+                continue
+            if send is None:
+                connection.sendall(frame)
+            else:
+                send(connection, frame)
+        return frames.get(*cls.CANONICAL)
         
+    @classmethod
+    def decode(cls, payload: bytes) -> Message:
+        """Parses the payload of a frame into a Message object.
+
+        JSON payloads always start with "{" and compressed ones with the zlib
+        header byte 0x78 ("x"), anything else is BinaryCodec.
+        """
+
+        try:
+            if payload[:1] == b"x":
+                payload = cls.decompress(payload)
+            if payload[:1] != b"{":
+                return BinaryCodec.decode(payload)
+
+            dic_json = json.loads(payload.decode("utf-8"))
+
+            if dic_json["command"] == "join":
+                return JoinMessage(dic_json["channel"], cls.natural(dic_json.get("replay")),
+                                   cls.natural(dic_json.get("since")))
+            elif dic_json["command"] == "register":
+                return RegisterMessage(dic_json["user"], dic_json.get("codec"), dic_json.get("framing"),
+                                       dic_json.get("compress"))
+            elif dic_json["command"] == "message":
+                # ts e seq são reenviados pelo servidor, também em varints do BinaryCodec
+                return TextMessage(dic_json["message"], dic_json.get("channel"), cls.natural(dic_json["ts"]),
+                                   cls.natural(dic_json.get("seq")))
+            elif dic_json["command"] == "chunk":
+                return ChunkMessage(dic_json["stream"], dic_json["data"], dic_json.get("channel"),
+                                    bool(dic_json["more"]), cls.natural(dic_json["ts"]))
+            elif dic_json["command"] == "ping":
+                return PingMessage(cls.natural(dic_json.get("ts")))
+            elif dic_json["command"] == "pong":
+                return PongMessage(cls.natural(dic_json.get("ts")))
+        except (ValueError, KeyError, TypeError, IndexError, zlib.error):
+            raise CDProtoBadFormat(payload)
+
+    @staticmethod
+    def natural(value):
+        """Check an optional integer field of a JSON message, which must not be negative."""
+        if value is not None and (type(value) is not int or value < 0):
+            raise ValueError(f"Invalid integer field {value!r}")
+        return value
+
     @classmethod
     def recv_msg(cls, connection: socket) -> Message:
         """Receives through a connection a Message object."""
 
+        msg_len = int.from_bytes(connection.recv(2), "big")
+        return cls.decode(connection.recv(msg_len))
+
+
+class FrameCache:
+    """Frames of one message, each wire format encoded once and shared by every connection using it."""
+
+    __slots__ = ("msg", "frames")
+
+    def __init__(self, msg: Message = None, frame: bytes = None):
+        """Build from a Message or from an already encoded frame in the CANONICAL format."""
+        self.msg = msg
+        self.frames = {}
+        if frame is not None:
+            self.frames[CDProto.CANONICAL] = frame
+
+    def get(self, codec: str = "json", header: int = 2, compress: str = None) -> memoryview:
+        """Frame for a (codec, header, compress) wire format, or None if the message does not fit its header."""
+        key = (codec, header, compress)
+        if key in self.frames:
+            return self.frames[key]
+        payload = self.payload(codec, compress)
+        if len(payload) >= 1 << (8 * header):
+            frame = None
+        else:
+            frame = memoryview(len(payload).to_bytes(header, "big") + payload)
+        self.frames[key] = frame
+        return frame
+
+    def payload(self, codec: str, compress: str = None):
+        """Payload of the message in codec, reusing a frame with another header if there is one."""
+        for (other, header, compressed), frame in self.frames.items():
+            if other == codec and compressed == compress and frame is not None:
+                return frame[header:]
+        if compress is not None:
+            return CDProto.compress(bytes(self.payload(codec)))
+        if self.msg is None:  # Só conhecemos a frame canónica, p.ex. vinda de outro worker
+            header = CDProto.CANONICAL[1]
+            self.msg = CDProto.decode(bytes(self.frames[CDProto.CANONICAL][header:]))
+        if codec == "binary":
+            return BinaryCodec.encode(self.msg)
+        return str(self.msg).encode("utf-8")
+
+
+class CDProtoDecoder:
+    """Incremental decoder of the frames received through a connection.
+
+    Reads large chunks into a reusable buffer and yields every complete
+    message it holds, so partial and coalesced TCP reads are handled.
+    Decoders used by the same thread can share the chunk buffer, so an
+    idle connection only keeps its unprocessed bytes.
+    """
+
+    __slots__ = ("header", "max_frame", "buffer", "offset", "chunk")
+
+    def __init__(self, chunk_size: int = 65536, header: int = 2, max_frame: int = CDProto.MAX_FRAME,
+                 chunk: bytearray = None):
+        self.header = header  # Bytes do tamanho de cada frame, pode mudar a meio do fluxo
+        self.max_frame = max_frame
+        self.buffer = bytearray()
+        self.offset = 0  # Início dos bytes ainda não processados
+        self.chunk = chunk if chunk is not None else bytearray(chunk_size)
+
+    def feed(self, data: bytes):
+        """Appends received bytes to the buffer."""
+        if self.offset == len(self.buffer):
+            self.buffer = bytearray()  # Liberta a memória de frames grandes já processadas
+            self.offset = 0
+        elif self.offset:
+            del self.buffer[:self.offset]  # Descarta as frames já processadas
+            self.offset = 0
+        self.buffer += data
+
+    def read(self, connection: socket) -> bool:
+        """Reads the bytes available in a connection. Returns False when the peer closed it."""
         try:
-            msg_len = int.from_bytes(connection.recv(2), "big")
-            dic_json = connection.recv(msg_len)
+            n = connection.recv_into(self.chunk)
+        except BlockingIOError:
+            return True
+        if n == 0:
+            return False
+        with memoryview(self.chunk) as view:
+            self.feed(view[:n])
+        return True
+
+    def drain(self, connection: socket) -> bool:
+        """Reads every byte already available in a connection, without blocking.
+
+        Returns False when the peer closed it.
+        """
+        while True:
+            try:
+                n = connection.recv_into(self.chunk, 0, MSG_DONTWAIT)
+            except BlockingIOError:
+                return True
+            if n == 0:
+                return False
+            with memoryview(self.chunk) as view:
+                self.feed(view[:n])
+            if n < len(self.chunk):  # O socket ficou vazio, poupa-se uma chamada
+                return True
+
+    def messages(self):
+        """Yields every complete Message held in the buffer."""
+        for payload in self.frames():
+            yield CDProto.decode(payload)
+
+    def frames(self):
+        """Yields the payload of every complete frame held in the buffer."""
+        buffer = self.buffer
+        while len(buffer) - self.offset >= self.header:
+            start = self.offset + self.header
+            size = int.from_bytes(buffer[self.offset:start], "big")
+            if size > self.max_frame:
+                raise CDProtoBadFormat(bytes(buffer[self.offset:start]))
+            end = start + size
+            if len(buffer) < end:
+                break
+            self.offset = end
+            yield bytes(buffer[start:end])
 
-            dic_json = json.loads(dic_json.decode("utf-8"))
-        except:
-            raise CDProtoBadFormat(dic_json)
-        
-        if dic_json["command"] == "join":
-            return JoinMessage(dic_json["channel"])
-        elif dic_json["command"] == "register":
-            return RegisterMessage(dic_json["user"])
-        elif dic_json["command"] == "message":
-            if "channel" not in dic_json.keys():
-                return TextMessage(dic_json["message"], None, dic_json["ts"])
-            else:
-                return TextMessage(dic_json["message"], dic_json["channel"], dic_json["ts"])
-            
 
-        
 class CDProtoBadFormat(Exception):
     """Exception when source message is not CDProto."""
 
@@ -0,0 +1,27 @@
+"""Token buckets limiting the rate of chat messages."""
+
+
+class TokenBucket:
+    """Allows rate messages per second on average and bursts of up to burst messages.
+
+    The bucket only stores its tokens and the instant they were counted, and
+    refills lazily when it is checked, so it takes constant memory and time.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst  # Começa cheio
+        self.stamp = now
+
+    def ready(self, now: float) -> bool:
+        """Refill the tokens earned since the last check. True if one message may be sent."""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return self.tokens >= 1
+
+    def take(self):
+        """Spend the token of one message."""
+        self.tokens -= 1
@@ -1,78 +1,614 @@
 """CD Chat server program."""
 import logging
+import os
 import selectors
 import socket 
+import time
+from collections import deque
+from itertools import islice
 
 
-logging.basicConfig(filename="server.log", level=logging.DEBUG)
-from .protocol import CDProto, CDProtoBadFormat
+from .channellog import MessageLog
+from .metrics import Metrics, http_response
+from .protocol import (ChunkMessage, CDProto, CDProtoBadFormat, CDProtoDecoder, FrameCache, PingMessage,
+                       PongMessage, TextMessage)
+from .ratelimit import TokenBucket
+from .timerwheel import TimerWheel
+
+
+logger = logging.getLogger("Server")
+
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+
+
+class OutboundQueue:
+    """Frames waiting to be written to a non-blocking connection."""
+
+    __slots__ = ("frames", "size", "writing")
+
+    def __init__(self):
+        self.frames = None  # memoryviews partilhadas entre os destinatários, a deque só existe com frames pendentes
+        self.size = 0  # Bytes pendentes
+        self.writing = False  # Registado para EVENT_WRITE
+
+    def append(self, frame):
+        if self.frames is None:
+            self.frames = deque()
+        self.frames.append(frame)
+        self.size += len(frame)
+
+    def write(self, conn) -> bool:
+        """Send as much as the socket accepts. Returns True once the queue is empty."""
+        while self.frames:
+            frame = self.frames[0]
+            try:
+                sent = conn.send(frame)
+            except BlockingIOError:
+                return False
+            self.size -= sent
+            if sent < len(frame):
+                self.frames[0] = frame[sent:]
+                return False
+            self.frames.popleft()
+        self.frames = None
+        return True
+
+    def writev(self, conn) -> bool:
+        """Like write, but gathers the queued frames into a single sendmsg per call."""
+        while self.frames:
+            try:
+                sent = conn.sendmsg(list(islice(self.frames, IOV_MAX)))
+            except BlockingIOError:
+                return False
+            self.size -= sent
+            while self.frames and sent >= len(self.frames[0]):
+                sent -= len(self.frames.popleft())
+            if sent:
+                self.frames[0] = self.frames[0][sent:]
+                return False
+        self.frames = None
+        return True
+
+
+class ChannelHistory:
+    """Ring buffer with the last frames broadcast in a channel, bounded by count and bytes."""
+
+    __slots__ = ("frames", "max_count", "max_bytes", "size")
+
+    def __init__(self, max_count: int, max_bytes: int):
+        self.frames = deque()
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.size = 0  # Bytes guardados
+
+    def append(self, frame):
+        self.frames.append(frame)
+        self.size += len(frame)
+        while len(self.frames) > self.max_count or self.size > self.max_bytes:
+            self.size -= len(self.frames.popleft())
+
+    def last(self, n: int, wire: tuple = CDProto.CANONICAL) -> bytes:
+        """Return the last n frames, in the (codec, header, compress) wire format, coalesced into a single buffer."""
+        start = max(len(self.frames) - n, 0)
+        frames = islice(self.frames, start, None)
+        if wire != CDProto.CANONICAL:
+            frames = (FrameCache(frame=frame).get(*wire) for frame in frames)
+        return b"".join(frame for frame in frames if frame is not None)
+
+
+class Session:
+    """A client registered in the chat server."""
+
+    __slots__ = ("user", "channels", "wire", "streams", "bucket", "limited", "cursor")
+
+    def __init__(self, user: str, wire: tuple, bucket: TokenBucket = None):
+        self.user = user
+        self.channels = []  # Ids dos canais de que é membro, poucos por cliente
+        self.wire = wire  # (codec, header, compressão) negociado
+        self.streams = None  # Mensagens longas a ser recebidas, criado no primeiro pedaço
+        self.bucket = bucket  # Limite de ritmo das mensagens publicadas
+        self.limited = False  # Já foi avisado de que excedeu o limite
+        self.cursor = None  # (canal, último seq enviado, último seq a enviar) de uma recuperação do log
+
 
 class Server:
     """Chat Server process."""
 
-    def __init__(self):
-        """Initialize the server."""
+    def __init__(self, high_water: int = 1 << 20, slow_consumer: str = "disconnect",
+                 reuse_port: bool = False, bus=None, history: tuple = (100, 1 << 16),
+                 coalesce_us: int = 1000, admin_port: int = None, log_every: int = 1000,
+                 user_limit: tuple = None, channel_limit: tuple = None, log_dir: str = None,
+                 keepalive: tuple = None, host: str = "localhost", port: int = 6666):
+        """Initialize the server.
+
+        Parameters:
+            high_water: maximum bytes queued for a connection before it is a slow consumer
+            slow_consumer: "drop" discards new frames for slow consumers, "disconnect" closes them
+            reuse_port: share the port with other worker processes (SO_REUSEPORT)
+            bus: ChannelBus connecting this worker to the others of a cluster
+            history: (messages, bytes) kept per channel for replay on join
+            coalesce_us: longest time a queued frame may wait for the end of the loop iteration
+            admin_port: localhost port serving the metrics as JSON over HTTP
+            log_every: log one in every log_every messages
+            user_limit: (messages per second, burst) each user may publish, None for no limit
+            channel_limit: (messages per second, burst) published in each channel, None for no limit
+            log_dir: directory of the persistent channel logs, None to keep no log
+            keepalive: (interval, timeout) in seconds: connections idle for interval are pinged
+                and closed if nothing arrives within timeout. None never closes idle connections
+            host, port: address to listen on
+        """
+        self.setup(high_water, slow_consumer, history, log_every, user_limit, channel_limit)
+        if log_dir is not None:
+            self.log = MessageLog(log_dir)
+        self.keepalive = keepalive
+        self.wheel = TimerWheel()  # Temporizadores das conexões
+        self.timers = {}  # Temporizador de keepalive de cada conexão
+        self.seen = {}  # Instante em que cada conexão enviou dados pela última vez
+        self.ping_frames = FrameCache(PingMessage())  # A mesma frame para todos os pings
+        self.coalesce = coalesce_us / 1e6
+        self.dirty = set()  # Conexões com frames por enviar nesta iteração
+        self.flush_deadline = None
         self.selector = selectors.DefaultSelector()  # Criar o selector
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)   # Criar o socket
         self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.s.bind(('localhost', 6666))   # Ligar o socket a um endereço
+        if reuse_port:
+            self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.s.bind((host, port))   # Ligar o socket a um endereço
 
         print("Server started")
 
-        self.s.listen(5)    # Limite de clientes
+        self.s.listen(socket.SOMAXCONN)    # Fila de ligações pendentes
         self.selector.register(self.s, selectors.EVENT_READ, self.accept)
-        self.infUsers = {}  # Dicionário para armazenar informações dos clientes conectados
+        self.outbound = {}  # Fila de saída de cada conexão
+        self.chunk = bytearray(65536)
+        self.decoders = {}  # Descodificador incremental de cada conexão
+        if bus is not None:
+            self.bus = bus
+            bus.attach(self)
+        if admin_port is not None:
+            self.admin = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.admin.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.admin.bind(('localhost', admin_port))
+            self.admin.listen()
+            self.selector.register(self.admin, selectors.EVENT_READ, self.accept_admin)
+
+    def setup(self, high_water, slow_consumer, history, log_every, user_limit=None, channel_limit=None):
+        """Initialize the chat state shared by every server engine."""
+        if slow_consumer not in ("drop", "disconnect"):
+            raise ValueError(f"Unknown slow consumer policy: {slow_consumer}")
+        self.high_water = high_water
+        self.slow_consumer = slow_consumer
+        self.infUsers = {}  # Sessão de cada cliente registado
+        self.channel_ids = {}  # Nome do canal -> id inteiro, os nomes são guardados uma única vez
+        self.channel_names = []  # Id -> nome do canal, None se o id está livre
+        self.free_ids = []  # Ids de canais que ficaram sem membros, reutilizados
+        self.channels = {}  # Índice canal -> conjunto de conexões que são membros
+        self.bus = None  # Barramento entre os processos de um cluster
+        self.history_limits = history
+        self.history = {}  # Últimas mensagens de cada canal com membros
+        self.metrics = Metrics()
+        self.log_every = log_every
+        self.published = 0  # Mensagens publicadas, para amostrar o log
+        self.streams = 0  # Mensagens longas enviadas aos pedaços
+        self.user_limit = user_limit
+        self.channel_limit = channel_limit
+        self.channel_buckets = {}  # Limite de ritmo de cada canal com membros
+        self.log = None  # Log persistente das mensagens de cada canal
 
     def accept(self, sock, mask):
         """Accept a new connection."""
         conn, addr = sock.accept()
-        self.selector.register(conn, selectors.EVENT_READ, self.read)
-        
+        conn.setblocking(False)
+        self.open(conn)
+        self.selector.register(conn, selectors.EVENT_READ, self.service)
+
+    def open(self, conn):
+        """Create the buffers of a new connection."""
+        self.outbound[conn] = OutboundQueue()
+        # Todos os descodificadores leem para o mesmo buffer, o loop só lê uma conexão de cada vez
+        self.decoders[conn] = CDProtoDecoder(chunk=self.chunk)
+        if self.keepalive is not None:
+            self.seen[conn] = time.monotonic()
+            self.timers[conn] = self.wheel.schedule(self.keepalive[0], self.ping, conn)
+
+    def ping(self, conn):
+        """Keepalive timer of a connection: ping it once it has been idle for the interval."""
+        interval, timeout = self.keepalive
+        now = time.monotonic()
+        idle = now - self.seen[conn]
+        if idle < interval:
+            # Houve atividade entretanto, basta voltar a armar o temporizador
+            self.timers[conn] = self.wheel.schedule(interval - idle, self.ping, conn)
+            return
+        self.timers[conn] = self.wheel.schedule(timeout, self.reap, conn, now)
+        self.send(conn, self.ping_frames.get(*self.wire(conn)))
+
+    def reap(self, conn, pinged: float):
+        """Close a connection that sent nothing since it was pinged at the instant pinged."""
+        interval, timeout = self.keepalive
+        if self.seen[conn] > pinged:
+            # Respondeu: o próximo ping conta a partir da última atividade
+            idle = time.monotonic() - self.seen[conn]
+            self.timers[conn] = self.wheel.schedule(interval - idle, self.ping, conn)
+            return
+        print(f">> {self.name(conn)} não responde e foi desconectado")
+        self.metrics.reaped += 1
+        self.disconnect(conn)
+
+    def accept_admin(self, sock, mask):
+        """Accept a connection on the admin port and queue it to answer with the metrics."""
+        conn, addr = sock.accept()
+        self.selector.register(conn, selectors.EVENT_READ, self.answer_admin)
+
+    def answer_admin(self, conn, mask):
+        """Reply to a request on the admin port with the metrics report."""
+        self.selector.unregister(conn)
+        try:
+            conn.recv(4096)  # O pedido HTTP é ignorado, qualquer caminho devolve o relatório
+            conn.sendall(http_response(self.stats()))
+        except OSError:
+            pass
+        conn.close()
+
+    def stats(self) -> dict:
+        """Current metrics report."""
+        return self.metrics.snapshot(
+            len(self.infUsers),
+            {channel: len(members) for channel, members in self.channels.items()},
+            self.queue_depths(),
+        )
+
+    def queue_depths(self):
+        """Bytes waiting in the outbound buffer of each connection."""
+        return (queue.size for queue in self.outbound.values())
+
+    def service(self, conn, mask):
+        """Dispatch selector events of a client connection."""
+        # O select devolve todos os eventos antes de os tratar, a conexão pode já ter sido fechada
+        if mask & selectors.EVENT_WRITE and conn in self.outbound:
+            self.write(conn)
+        if mask & selectors.EVENT_READ and conn in self.outbound:
+            self.read(conn, mask)
+
+    def send(self, conn, frame):
+        """Queue a frame for a connection and start writing it without blocking."""
+        queue = self.outbound.get(conn)
+        if queue is None:  # Conexão já fechada
+            return
+        if queue.size + len(frame) > self.high_water:
+            if self.slow_consumer == "disconnect":
+                print(f">> {self.name(conn)} não acompanha o ritmo e foi desconectado")
+                self.disconnect(conn)
+            else:
+                self.metrics.dropped += 1
+            return
+        queue.append(frame)
+        self.metrics.bytes_out += len(frame)
+        if not queue.writing:
+            # Junta as frames desta iteração do loop para as enviar numa única syscall
+            self.dirty.add(conn)
+            if self.flush_deadline is None:
+                self.flush_deadline = time.monotonic() + self.coalesce
+
+    def flush(self):
+        """Write the frames queued during this loop iteration."""
+        dirty, self.dirty = self.dirty, set()
+        self.flush_deadline = None
+        for conn in dirty:
+            if conn in self.outbound:
+                self.write(conn)
+
+    def write(self, conn):
+        """Flush the outbound queue of a connection, waiting for EVENT_WRITE if the socket is full."""
+        queue = self.outbound[conn]
+        try:
+            done = queue.writev(conn)
+        except OSError:
+            self.disconnect(conn)
+            return
+        # Só pedimos EVENT_WRITE enquanto existirem bytes pendentes
+        if queue.writing == done:
+            queue.writing = not done
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if queue.writing else selectors.EVENT_READ
+            self.selector.modify(conn, events, self.service)
+        session = self.infUsers.get(conn)
+        if done and session is not None and session.cursor is not None:
+            self.catch_up(conn)  # Próximo lote do log
+
+    def intern(self, channel: str) -> int:
+        """Small integer id of a channel name."""
+        cid = self.channel_ids.get(channel)
+        if cid is None and self.free_ids:
+            cid = self.channel_ids[channel] = self.free_ids.pop()
+            self.channel_names[cid] = channel
+        elif cid is None:
+            cid = self.channel_ids[channel] = len(self.channel_names)
+            self.channel_names.append(channel)
+        return cid
+
+    def subscribe(self, conn, channel):
+        """Add a connection to the members of a channel."""
+        channels = self.infUsers[conn].channels
+        cid = self.intern(channel)
+        if cid not in channels:
+            channels.append(cid)
+        if channel not in self.channels:
+            self.channels[channel] = set()
+            if self.bus is not None:
+                self.bus.subscribe(channel)  # Primeiro membro local do canal
+        self.channels[channel].add(conn)
+
+    def unsubscribe(self, conn):
+        """Remove a connection from every channel it is a member of."""
+        for cid in self.infUsers[conn].channels:
+            channel = self.channel_names[cid]
+            members = self.channels.get(channel)
+            if members is None:
+                continue
+            members.discard(conn)
+            if not members:
+                # Canal sem membros deixa de ser indexado e o seu estado é libertado
+                del self.channels[channel]
+                del self.channel_ids[channel]
+                self.channel_names[cid] = None
+                self.free_ids.append(cid)
+                self.channel_buckets.pop(channel, None)
+                self.history.pop(channel, None)
+                self.metrics.forget(channel)
+                if self.bus is not None:
+                    self.bus.unsubscribe(channel)
 
     def read(self, conn, mask):
-        """Read from the socket."""
+        """Read from the socket and handle every complete message received."""
 
+        if self.keepalive is not None:
+            self.seen[conn] = time.monotonic()
         try:
-            msg = CDProto.recv_msg(conn)
-        except CDProtoBadFormat:
-            msg = None
-        
-        if msg:
-            if msg.command == "register":
-                print(f'>> {msg.user} entrou no servidor')
-                # Inicializa o cliente no canal "None"
-                self.infUsers[conn] = {"user": msg.user, "channels": {"None"}}
-            
-            elif msg.command == "join":
-                # Atualiza os canais do cliente, adicionando-o ao novo canal e removendo de "None" 
-                self.infUsers[conn]["channels"].add(msg.channel)
-                print(f'>> {self.infUsers[conn]["user"]} entrou no canal {msg.channel}')
-
-            elif msg.command == "message":
-                
-                channel = msg.channel
-                broadcast_msg = f"({self.infUsers[conn]['user']}): {msg.message}" 
-                msg = CDProto.message(broadcast_msg, channel)
-
-                print(f'>> {self.infUsers[conn]["user"]} enviou mensagem para o canal {channel}')
-                # Envia a mensagem para todos os usuários no mesmo canal
-                for client_conn, info in self.infUsers.items():
-                    if channel in info["channels"] and client_conn != conn:  # Não envia de volta ao remetente
-                        CDProto.send_msg(client_conn, msg)
+            connected = self.decoders[conn].read(conn)
+            for msg in self.decoders[conn].messages():
+                if msg:
+                    self.handle(conn, msg)
+        except (CDProtoBadFormat, OSError):
+            connected = False
+
+        if not connected:
+            if conn in self.infUsers:
+                print(f">> {self.infUsers[conn].user} desconectou-se")
+            self.disconnect(conn)
+
+    def handle(self, conn, msg):
+        """Process a message received from a client."""
+
+        if msg.command == "register":
+            print(f'>> {msg.user} entrou no servidor')
+            # Inicializa o cliente no canal "None"
+            codec = msg.codec if msg.codec in CDProto.CODECS else "json"
+            header = CDProto.HEADERS.get(msg.framing, 2)
+            compress = msg.compress if msg.compress in CDProto.COMPRESSIONS else None
+            bucket = TokenBucket(*self.user_limit, time.monotonic()) if self.user_limit else None
+            self.infUsers[conn] = Session(msg.user, (codec, header, compress), bucket)
+            # As frames seguintes do cliente já usam o framing negociado
+            self.decoder(conn).header = header
+            self.subscribe(conn, "None")
+
+        elif msg.command == "join":
+            # Atualiza os canais do cliente, adicionando-o ao novo canal
+            self.subscribe(conn, msg.channel)
+            print(f'>> {self.infUsers[conn].user} entrou no canal {msg.channel}')
+            if msg.replay and msg.channel in self.history:
+                # Reenvia as últimas mensagens do canal numa única escrita
+                self.send(conn, self.history[msg.channel].last(msg.replay, self.wire(conn)))
+            if msg.since is not None and self.log is not None:
+                # As mensagens seguintes já chegam em direto, recupera apenas até à última do log
+                self.infUsers[conn].cursor = (msg.channel, msg.since, self.log.next(msg.channel) - 1)
+                self.catch_up(conn)
+
+        elif msg.command == "message":
+
+            channel = msg.channel
+            if not self.allow(conn, channel):
+                return
+            broadcast_msg = f"({self.infUsers[conn].user}): {msg.message}"
+            # Só os canais com membros são guardados no log, cada nome novo abriria ficheiros
+            logged = self.log is not None and channel in self.channels
+            seq = self.log.next(channel) if logged else None
+            msg = TextMessage(broadcast_msg, channel, msg.ts, seq)  # Mantém o instante de envio original
+
+            self.published += 1
+            if self.published % self.log_every == 0:  # Log amostrado, fora do caminho crítico
+                logger.info("message user=%s channel=%s published=%d",
+                            self.infUsers[conn].user, channel, self.published)
+            # Envia a mensagem apenas aos membros do canal, serializada uma única vez por formato
+            start = time.perf_counter_ns()
+            members = [c for c in self.channels.get(channel, ()) if c != conn]  # Não envia de volta ao remetente
+            frame = CDProto.broadcast(members, msg, self.send, self.wire)
+            self.metrics.message(channel if channel in self.channels else None, len(members),
+                                 time.perf_counter_ns() - start)
+            self.record(channel, frame)
+            if self.bus is not None:
+                self.bus.publish(channel, frame)  # Membros ligados a outros workers
+
+        elif msg.command == "chunk":
+            self.stream(conn, msg)
+
+        elif msg.command == "ping":
+            self.send(conn, FrameCache(PongMessage(msg.ts)).get(*self.wire(conn)))
+
+    def allow(self, conn, channel) -> bool:
+        """Take a token from the buckets of the sender and of the channel before a fan-out.
+
+        Messages over a limit are dropped. The sender is notified of the first
+        one and again only after it was allowed to publish in between.
+        """
+        session = self.infUsers[conn]
+        now = time.monotonic()
+        buckets = [session.bucket] if session.bucket is not None else []
+        if self.channel_limit and channel in self.channels:
+            bucket = self.channel_buckets.get(channel)
+            if bucket is None:
+                bucket = self.channel_buckets[channel] = TokenBucket(*self.channel_limit, now)
+            buckets.append(bucket)
+        if all(bucket.ready(now) for bucket in buckets):
+            for bucket in buckets:
+                bucket.take()
+            session.limited = False
+            return True
+
+        self.metrics.limited += 1
+        if not session.limited:
+            session.limited = True
+            notice = TextMessage("[limite de mensagens excedido, mensagem descartada]", channel)
+            CDProto.broadcast([conn], notice, self.send, self.wire)
+        return False
+
+    def stream(self, conn, chunk):
+        """Relay a piece of a long message as soon as it arrives, without reassembling it.
+
+        Pieces only reach members that negotiated 4 byte framing. Members with
+        the legacy framing, which cannot hold the whole message, get a notice.
+        """
+        session = self.infUsers[conn]
+        user = session.user
+        if session.streams is None:
+            session.streams = {}
+        streams = session.streams
+        channel = chunk.channel
+        data = chunk.data
+        stream = streams.get(chunk.stream)
+        members = [c for c in self.channels.get(channel, ()) if c != conn]
+        if stream is None and not self.allow(conn, channel):
+            stream = ""  # Mensagem descartada pelo limite de ritmo, tal como os pedaços seguintes
+        elif stream is None:
+            # Identificador único no servidor (e entre workers) para esta mensagem
+            self.streams += 1
+            stream = f"{os.getpid()}.{self.streams}"
+            data = f"({user}): {data}"
+            notice = TextMessage(f"({user}): [mensagem longa omitida, atualize o cliente]", channel, chunk.ts)
+            legacy = [c for c in members if self.wire(c)[1] == 2]
+            frame = CDProto.broadcast(legacy, notice, self.send, self.wire)
+            if self.bus is not None:
+                self.bus.publish(channel, frame, 2)
+        if chunk.more:
+            streams[chunk.stream] = stream
         else:
-            
-            print(f">> {self.infUsers[conn]['user']} desconectou-se")
+            streams.pop(chunk.stream, None)
+            if not streams:
+                session.streams = None
+        if not stream:
+            return
+
+        start = time.perf_counter_ns()
+        members = [c for c in members if self.wire(c)[1] == 4]
+        frame = CDProto.broadcast(members, ChunkMessage(stream, data, channel, chunk.more, chunk.ts), self.send, self.wire)
+        self.metrics.message(channel if channel in self.channels else None, len(members),
+                             time.perf_counter_ns() - start)
+        if self.bus is not None:
+            self.bus.publish(channel, frame, 4)
+
+    def catch_up(self, conn):
+        """Send the next batch of the logged messages a client asked for with since.
+
+        Batches of about half high_water bytes are queued each time the
+        previous one is written, so a long catch-up is not taken for a slow
+        consumer. Clients using the CANONICAL format get the bytes mapped
+        from the log as they are, the others every frame in their format.
+        """
+        session = self.infUsers[conn]
+        channel, since, until = session.cursor
+        canonical = session.wire == CDProto.CANONICAL
+        frames, last = self.log.read(channel, since, until, self.high_water // 2, split=not canonical)
+        session.cursor = (channel, last, until) if frames and last < until else None
+        for frame in frames:
+            if not canonical:
+                frame = FrameCache(frame=frame).get(*session.wire)
+            if frame is not None:
+                self.send(conn, frame)
+
+    def deliver(self, channel, frame, header=0):
+        """Send an already encoded CANONICAL frame to the local members of a channel.
+
+        header limits the delivery to members using that framing, 0 means everyone.
+        """
+        members = [c for c in self.channels.get(channel, ()) if not header or self.wire(c)[1] == header]
+        CDProto.broadcast(members, FrameCache(frame=frame), self.send, self.wire)
+        if not header:
+            self.record(channel, frame)
+
+    def wire(self, conn) -> tuple:
+        """(codec, header, compress) negotiated by a connection, the original format before it registers."""
+        session = self.infUsers.get(conn)
+        return session.wire if session is not None else ("json", 2, None)
+
+    def name(self, conn) -> str:
+        """User of a connection, for the server messages, also before it registers."""
+        session = self.infUsers.get(conn)
+        return session.user if session is not None else "Cliente não registado"
+
+    def decoder(self, conn) -> CDProtoDecoder:
+        """Decoder of the frames received from a connection."""
+        return self.decoders[conn]
+
+    def record(self, channel, frame):
+        """Keep a broadcast frame in the history and in the log of its channel.
+
+        Only channels with local members keep a history, released with the channel, and a log.
+        """
+        history = self.history.get(channel)
+        if history is None and channel in self.channels:
+            history = self.history[channel] = ChannelHistory(*self.history_limits)
+        if history is not None:
+            history.append(frame)
+        if self.log is not None and channel in self.channels:
+            self.log.append(channel, frame)
+
+    def forget(self, conn):
+        """Remove a connection from the chat state."""
+        if conn in self.infUsers:
+            self.unsubscribe(conn)
+        self.infUsers.pop(conn, None)  # Remove o usuário das informações do servidor
+
+    def disconnect(self, conn):
+        """Forget a connection and close it."""
+        self.forget(conn)
+        self.outbound.pop(conn, None)
+        self.decoders.pop(conn, None)
+        timer = self.timers.pop(conn, None)
+        if timer is not None:
+            self.wheel.cancel(timer)
+        self.seen.pop(conn, None)
+        self.selector.unregister(conn)  # Remove do seletor
+        conn.close()  # Fecha a conexão
+
 
-            self.infUsers.pop(conn, None)  # Remove o usuário das informações do servidor
-            self.selector.unregister(conn)  # Remove do seletor
-            conn.close()  # Fecha a conexão
+    def timeout(self):
+        """Seconds the loop may wait for events, None to wait indefinitely."""
+        if self.dirty:
+            return 0  # Frames por enviar
+        # Prazos do fsync do log e das ligações a outros servidores
+        timeouts = []
+        for timer in (self.log, self.bus, self.wheel):
+            timeout = timer.timeout() if timer is not None else None
+            if timeout is not None:
+                timeouts.append(timeout)
+        return min(timeouts, default=None)
 
+    def poll(self, timeout=None):
+        """Run one iteration of the loop: dispatch the events ready within timeout and flush."""
+        events = self.selector.select(timeout)
+        for key, mask in events:
+            callback = key.data
+            callback(key.fileobj, mask)
+            if self.flush_deadline is not None and time.monotonic() >= self.flush_deadline:
+                self.flush()
+        self.wheel.advance()  # Temporizadores expirados, p.ex. keepalive
+        self.flush()
+        if self.log is not None:
+            self.log.tick()
+        if self.bus is not None:
+            self.bus.tick()
 
     def loop(self):
         """Loop indefinetely."""
 
         while True:
-            events = self.selector.select()
-            for key, mask in events:
-                callback = key.data
-                callback(key.fileobj, mask)
+            self.poll(self.timeout())
@@ -0,0 +1,102 @@
+"""Hierarchical timing wheel for the per-connection timers of the chat server."""
+import time
+
+
+class Timer:
+    """A callback scheduled in a TimerWheel."""
+
+    __slots__ = ("expires", "callback", "args", "slot")
+
+    def __init__(self, expires: int, callback, args: tuple):
+        self.expires = expires  # Tick em que dispara
+        self.callback = callback
+        self.args = args
+        self.slot = None  # Posição da roda onde está, None depois de disparar ou ser cancelado
+
+
+class TimerWheel:
+    """Timers with O(1) schedule and cancel, grouped in wheels of growing granularity.
+
+    Level 0 has one slot per tick, and every slot of level n spans a whole
+    turn of level n - 1. A timer goes in the coarsest level it fits; when a
+    lower level completes a turn, the next slot of the level above is
+    cascaded into it. Advancing one tick only touches the timers that expire
+    or cascade, never the whole set.
+    """
+
+    def __init__(self, resolution: float = 0.1, bits: int = 6, levels: int = 4, now: float = None):
+        """Initialize the wheel.
+
+        Parameters:
+            resolution: seconds per tick
+            bits: log2 of the slots per level
+            levels: number of levels, the wheel spans 2 ** (bits * levels) ticks
+        """
+        self.resolution = resolution
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.levels = levels
+        self.wheels = [[{} for _ in range(1 << bits)] for _ in range(levels)]  # Dicionários como conjuntos ordenados
+        self.tick = int((time.monotonic() if now is None else now) / resolution)  # Último tick processado
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, delay: float, callback, *args) -> Timer:
+        """Call callback(*args) after delay seconds, rounded up to the next tick."""
+        expires = -int(-(time.monotonic() + delay) // self.resolution)
+        timer = Timer(max(expires, self.tick + 1), callback, args)
+        self.place(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer: Timer):
+        """Remove a timer that did not fire yet."""
+        if timer.slot is not None:
+            del timer.slot[timer]
+            timer.slot = None
+            self.count -= 1
+
+    def place(self, timer: Timer):
+        delta = timer.expires - self.tick
+        level = 0
+        while level < self.levels - 1 and delta >> (self.bits * (level + 1)):
+            level += 1
+        expires = min(timer.expires, self.tick + (1 << (self.bits * self.levels)) - 1)  # Além do alcance: volta a descer
+        slot = self.wheels[level][(expires >> (self.bits * level)) & self.mask]
+        slot[timer] = None
+        timer.slot = slot
+
+    def timeout(self, now: float = None):
+        """Seconds until the wheel has work to do, or None if it holds no timers."""
+        if not self.count:
+            return None
+        now = time.monotonic() if now is None else now
+        for ticks in range(1, self.mask + 2):
+            index = (self.tick + ticks) & self.mask
+            if self.wheels[0][index] or index == 0:  # Um timer ou uma cascata
+                break
+        return max((self.tick + ticks) * self.resolution - now, 0)
+
+    def advance(self, now: float = None):
+        """Fire every timer that expired up to now."""
+        target = int((time.monotonic() if now is None else now) / self.resolution)
+        while self.tick < target:
+            if not self.count:
+                self.tick = target
+                break
+            self.tick += 1
+            for level in range(1, self.levels):
+                if self.tick & ((1 << (self.bits * level)) - 1):
+                    break
+                index = (self.tick >> (self.bits * level)) & self.mask
+                slot, self.wheels[level][index] = self.wheels[level][index], {}
+                for timer in slot:
+                    self.place(timer)
+            index = self.tick & self.mask
+            slot, self.wheels[0][index] = self.wheels[0][index], {}
+            for timer in slot:
+                timer.slot = None
+                self.count -= 1
+                timer.callback(*timer.args)
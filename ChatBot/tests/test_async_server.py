@@ -0,0 +1,56 @@
+"""Tests for the asyncio server engine."""
+import asyncio
+from unittest.mock import Mock
+
+from src.async_server import AsyncServer, ChatProtocol
+from src.protocol import CDProto, CDProtoDecoder
+
+
+async def read_message(reader, decoder):
+    while True:
+        for msg in decoder.messages():
+            return msg
+        decoder.feed(await reader.read(4096))
+
+
+def test_async_server():
+    async def scenario():
+        s = AsyncServer(port=0)
+        server = await s.start()
+        port = server.sockets[0].getsockname()[1]
+
+        foo_r, foo_w = await asyncio.open_connection("localhost", port)
+        bar_r, bar_w = await asyncio.open_connection("localhost", port)
+        foo_w.write(CDProto.encode(CDProto.register("foo")) + CDProto.encode(CDProto.join("#cd")))
+        bar_w.write(CDProto.encode(CDProto.register("bar")))
+        bar_w.write(CDProto.encode(CDProto.join("#cd")))
+        await bar_w.drain()
+        await asyncio.sleep(0.1)
+
+        assert len(s.channels["#cd"]) == 2
+
+        foo_w.write(CDProto.encode(CDProto.message("Hello World", "#cd")))
+        msg = await asyncio.wait_for(read_message(bar_r, CDProtoDecoder()), 2)
+        assert msg.message == "(foo): Hello World"
+
+        foo_w.close()
+        await asyncio.sleep(0.1)
+        assert s.channels == {"None": set(s.infUsers), "#cd": set(s.infUsers)}
+        assert len(s.infUsers) == 1
+
+        bar_w.close()
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(scenario())
+
+
+def test_slow_unregistered():
+    s = AsyncServer(high_water=100, slow_consumer="disconnect")
+    conn = ChatProtocol(s)
+    conn.connection_made(Mock(**{"is_closing.return_value": False, "get_write_buffer_size.return_value": 0}))
+
+    # Ainda sem registo, mas já atrás do ritmo do servidor
+    s.send(conn, b"x" * 101)
+    conn.transport.abort.assert_called_once()
+    conn.transport.write.assert_not_called()
@@ -0,0 +1,92 @@
+"""Tests for the persistent channel log."""
+import os
+
+from src.channellog import ChannelLog, MessageLog
+from src.protocol import CDProto, CDProtoDecoder, TextMessage
+
+
+def frame(seq):
+    return CDProto.encode(TextMessage(f"msg {seq}", "#cd", 1, seq), *CDProto.CANONICAL)
+
+
+def seqs(frames):
+    decoder = CDProtoDecoder(header=CDProto.CANONICAL[1])
+    for view in frames:
+        decoder.feed(view)
+    return [msg.seq for msg in decoder.messages()]
+
+
+def test_channel_log(tmp_path):
+    log = ChannelLog(str(tmp_path), segment_bytes=200)
+    for seq in range(1, 11):
+        assert log.next == seq
+        log.append(frame(seq))
+    assert len(log.segments) > 1
+
+    frames, last = log.read(0, 10, 1 << 20)
+    assert seqs(frames) == list(range(1, 11)) and last == 10
+    assert len(frames) == len(log.segments)  # Uma vista contígua por segmento
+
+    frames, last = log.read(3, 6, 1 << 20, split=True)
+    assert seqs(frames) == [4, 5, 6] and last == 6
+    assert len(frames) == 3
+
+    frames, last = log.read(3, 10, 1)  # Pelo menos uma frame
+    assert seqs(frames) == [4] and last == 4
+
+    assert log.read(10, 10, 1 << 20) == ([], 10)
+
+
+def test_channel_log_recovery(tmp_path):
+    log = ChannelLog(str(tmp_path), segment_bytes=200)
+    for seq in range(1, 8):
+        log.append(frame(seq))
+    log.close()
+    with open(os.path.join(tmp_path, sorted(os.listdir(tmp_path))[-1]), "ab") as f:
+        f.write(frame(8)[:10])  # Escrita interrompida a meio
+
+    log = ChannelLog(str(tmp_path), segment_bytes=200)
+    assert log.next == 8
+    log.append(frame(8))
+    assert seqs(log.read(0, 8, 1 << 20)[0]) == list(range(1, 9))
+
+
+def test_message_log_batches(tmp_path):
+    log = MessageLog(str(tmp_path), sync_every=3, sync_interval=60)
+    log.append("#cd", frame(1))
+    log.append("a/b", frame(1))
+    assert log.pending == 2 and log.timeout() > 0
+    log.append("#cd", frame(2))
+    assert log.pending == 0 and log.timeout() is None  # fsync do lote
+    assert sorted(os.listdir(tmp_path)) == ["c%23cd", "ca%2Fb"]
+    log.close()
+
+    assert MessageLog(str(tmp_path)).next("#cd") == 3
+
+
+def test_message_log_names(tmp_path):
+    log = MessageLog(str(tmp_path / "logs"))
+    for channel in (".", "..", ""):
+        log.append(channel, frame(1))
+    log.close()
+    # Cada canal tem a sua própria diretoria, dentro da diretoria dos logs
+    assert sorted(os.listdir(tmp_path)) == ["logs"]
+    assert sorted(os.listdir(tmp_path / "logs")) == ["c", "c.", "c.."]
+    assert MessageLog(str(tmp_path / "logs")).next("..") == 2
+
+
+def test_message_log_max_open(tmp_path):
+    log = MessageLog(str(tmp_path), sync_every=100, max_open=2)
+    fds = len(os.listdir("/proc/self/fd"))
+    for i in range(50):
+        log.append(f"#{i}", frame(1))
+        log.append(f"#{i}", frame(2))
+    assert list(log.logs) == ["#48", "#49"]
+    assert len(os.listdir("/proc/self/fd")) <= fds + 2  # Um segmento ativo por canal aberto
+
+    # Um canal fechado é recuperado do disco, sem perder mensagens nem a numeração
+    assert seqs(log.read("#0", 0, 2, 1 << 20)[0]) == [1, 2]
+    log.append("#0", frame(3))
+    assert list(log.logs) == ["#49", "#0"]
+    log.close()
+    assert MessageLog(str(tmp_path)).next("#0") == 4
@@ -0,0 +1,100 @@
+"""Tests for the channel bus of the multi-process server."""
+import selectors
+import socket
+from unittest.mock import MagicMock
+
+from src.cluster import ChannelBus
+
+
+def make_buses():
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    bus_a, bus_b = ChannelBus([a]), ChannelBus([b])
+    bus_a.attach(MagicMock())
+    bus_b.attach(MagicMock())
+    return (bus_a, a), (bus_b, b)
+
+
+def test_bus_interest():
+    (bus_a, a), (bus_b, b) = make_buses()
+
+    bus_a.publish("#cd", b"frame")  # Ninguém tem membros em #cd
+    bus_b.subscribe("#cd")
+    bus_a.read(a)
+    assert bus_a.interest == {"#cd": {a}}
+
+    bus_a.publish("#cd", b"frame")
+    bus_a.publish("#other", b"ignored")
+    bus_b.read(b)
+    bus_b.server.deliver.assert_called_once()
+    channel, frame, header = bus_b.server.deliver.call_args[0]
+    assert channel == "#cd"
+    assert bytes(frame) == b"frame"
+    assert header == 0
+
+    bus_b.unsubscribe("#cd")
+    bus_a.read(a)
+    assert bus_a.interest == {}
+
+
+def test_bus_peer_gone():
+    (bus_a, a), (bus_b, b) = make_buses()
+
+    bus_b.subscribe("#cd")
+    b.close()
+    bus_a.read(a)
+    assert bus_a.interest == {}
+    assert bus_a.peers == []
+
+
+def test_bus_large_frame():
+    (bus_a, a), (bus_b, b) = make_buses()
+    bus_b.subscribe("#cd")
+    bus_a.read(a)
+
+    frame = bytes(range(256)) * 4096  # 1 MiB, mais do que o buffer do socket
+    bus_a.publish("#cd", frame)
+    while not bus_b.server.deliver.called:
+        bus_b.read(b)
+        bus_a.service(a, selectors.EVENT_WRITE)
+    channel, received, header = bus_b.server.deliver.call_args[0]
+    assert channel == "#cd"
+    assert bytes(received) == frame
+    assert bus_a.peers == [a]
+
+    bus_a.publish("#cd", b"small")
+    bus_b.read(b)
+    assert bytes(bus_b.server.deliver.call_args[0][1]) == b"small"
+
+
+def test_bus_record_too_large():
+    (bus_a, a), (bus_b, b) = make_buses()
+    bus_b.subscribe("#cd")
+    bus_a.read(a)
+
+    a.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    bus_a.publish("#cd", b"x" * 60000)  # EMSGSIZE: descartado, o worker continua ligado
+    assert bus_a.peers == [a]
+    assert bus_a.outbound[a].size == 0
+
+    bus_a.publish("#cd", b"small")
+    bus_b.read(b)
+    assert bytes(bus_b.server.deliver.call_args[0][1]) == b"small"
+
+
+def test_bus_high_water():
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    bus_a, bus_b = ChannelBus([a], high_water=1 << 16), ChannelBus([b])
+    bus_a.attach(MagicMock())
+    bus_b.attach(MagicMock())
+    bus_a.server.metrics.dropped = 0
+    bus_b.subscribe("#cd")
+    bus_a.read(a)
+
+    # b não lê: as mensagens acumulam-se no buffer do socket e depois na fila
+    while not bus_a.server.metrics.dropped:
+        bus_a.publish("#cd", b"x" * 4096)
+    assert bus_a.outbound[a].size <= 1 << 16
+    assert bus_a.peers == [a]
+
+    bus_a.unsubscribe("#other")  # Os anúncios de interesse nunca são descartados
+    assert bus_a.outbound[a].frames[-1] == ChannelBus.record(ChannelBus.UNSUBSCRIBE, "#other")
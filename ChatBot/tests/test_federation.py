@@ -0,0 +1,166 @@
+"""Tests for the federation of chat servers."""
+import selectors
+import socket
+from unittest.mock import MagicMock
+
+from src.federation import Federation, Trunk
+from src.protocol import CDProto, CDProtoDecoder
+from src.server import Server
+
+
+def federated(*peers):
+    fed = Federation(("localhost", 0), [p.bus.sock.getsockname() for p in peers])
+    return Server(port=0, bus=fed)
+
+
+def pump(servers, rounds=20):
+    for _ in range(rounds):
+        for s in servers:
+            s.poll(0.005)
+
+
+def client(server, name, *channels):
+    sock = socket.create_connection(server.s.getsockname())
+    sock.sendall(b"".join(CDProto.encode(msg) for msg in
+                          [CDProto.register(name)] + [CDProto.join(channel) for channel in channels]))
+    return sock
+
+
+def received(sock):
+    decoder = CDProtoDecoder()
+    sock.setblocking(False)
+    while True:
+        try:
+            data = sock.recv(65536)
+        except BlockingIOError:
+            break
+        if not data:
+            break
+        decoder.feed(data)
+    sock.setblocking(True)
+    return [msg.message for msg in decoder.messages()]
+
+
+def test_federation():
+    c = federated()
+    b = federated(c)
+    a = federated(b, c)  # Triângulo: existem dois caminhos entre quaisquer dois servidores
+    servers = (a, b, c)
+    pump(servers)
+    assert all(len(s.bus.trunks) == 2 for s in servers)
+
+    foo = client(a, "foo", "#cd")
+    bar = client(b, "bar")
+    baz = client(c, "baz", "#cd")
+    pump(servers)
+    assert c.bus.id in a.bus.interest["#cd"]
+    assert b.bus.id not in a.bus.interest["#cd"]
+
+    foo.sendall(CDProto.encode(CDProto.message("Hello", "#cd")))
+    pump(servers)
+    assert received(baz) == ["(foo): Hello"]  # Uma única vez, apesar do ciclo
+    assert received(bar) == []
+
+    baz.sendall(CDProto.encode(CDProto.message("Olá", "#cd")))
+    pump(servers)
+    assert received(foo) == ["(baz): Olá"]
+
+    bar.sendall(CDProto.encode(CDProto.message("None", "None")))
+    pump(servers)
+    assert received(foo) == ["(bar): None"] and received(baz) == ["(bar): None"]
+
+    baz.close()
+    pump(servers)
+    assert c.bus.id not in a.bus.interest["#cd"]  # C deixou de ter membros em #cd
+
+    foo.close()
+    pump(servers)
+    assert "#cd" not in a.bus.interest and "#cd" not in c.bus.interest
+
+    for s in servers:
+        s.s.close()
+        s.bus.sock.close()
+
+
+def test_federation_dropped_trunk():
+    """Test that a trunk dropped while processing a batch of events or records is left alone."""
+    fed = Federation(server_id="a")
+    fed.server = MagicMock()
+    ours, theirs = socket.socketpair()
+    trunk = Trunk(ours)
+    fed.trunks = {ours: trunk}
+
+    # HELLO de nós próprios seguido de um anúncio, lidos de uma só vez
+    theirs.sendall(Federation.record(Federation.HELLO, "a") + Federation.record(Federation.SUBSCRIBE, "c", 1, "#cd"))
+    fed.read(trunk)
+    assert fed.trunks == {}
+    assert "#cd" not in fed.interest  # O trunk fechado não ficou como rota
+
+    fed.service(ours, selectors.EVENT_READ | selectors.EVENT_WRITE)  # Evento do mesmo select
+    fed.connected(ours, selectors.EVENT_WRITE)
+    theirs.close()
+
+
+def test_federation_loops():
+    """Test that repeated broadcasts are dropped and never sent back along their path."""
+    fed = Federation(server_id="a")
+    fed.server = MagicMock()
+    fed.send = MagicMock()
+    b, c = Trunk(MagicMock()), Trunk(MagicMock())
+    b.peer, c.peer = "b", "c"
+    fed.trunks = {b.sock: b, c.sock: c}
+
+    fed.handle(c, Federation.record(Federation.SUBSCRIBE, "c", 1, "#cd")[4:])
+    assert fed.send.call_args[0][0] is b  # Anúncio propagado aos outros servidores
+    fed.handle(b, Federation.record(Federation.SUBSCRIBE, "c", 1, "#cd")[4:])
+    assert fed.interest["#cd"]["c"] == [1, [c, b]]  # Repetido: apenas uma rota alternativa
+    fed.send.reset_mock()
+
+    publish = Federation.record(Federation.PUBLISH, "b", 7, 0, ["b"], "#cd", payload=b"frame")[4:]
+    fed.handle(b, publish)
+    fed.handle(c, publish)
+    assert fed.server.deliver.call_count == 1
+    assert fed.send.call_count == 1 and fed.send.call_args[0][0] is c
+
+    fed.handle(b, Federation.record(Federation.PUBLISH, "b", 8, 0, ["b", "c"], "#cd", payload=b"frame")[4:])
+    assert fed.server.deliver.call_count == 2
+    assert fed.send.call_count == 1  # c já a recebeu
+
+
+def test_federation_forgets():
+    """Test that servers without members or routes are forgotten, and their stale announcements ignored."""
+    fed = Federation(server_id="a")
+    fed.server = MagicMock()
+    fed.send = MagicMock()
+    b, c = Trunk(MagicMock()), Trunk(MagicMock())
+    fed.trunks = {b.sock: b, c.sock: c}
+
+    fed.handle(b, Federation.record(Federation.SUBSCRIBE, "d", 1, "#cd")[4:])
+    fed.handle(b, Federation.record(Federation.UNSUBSCRIBE, "d", 2, "#cd")[4:])
+    assert fed.interest == {}
+    fed.handle(c, Federation.record(Federation.SUBSCRIBE, "d", 1, "#cd")[4:])  # Atrasado, por outro caminho
+    assert fed.interest == {}
+    fed.handle(c, Federation.record(Federation.SUBSCRIBE, "d", 3, "#cd")[4:])
+    assert fed.interest == {"#cd": {"d": [3, [c]]}}
+
+    fed.drop(c)
+    assert fed.interest == {}  # Sem rota até ser anunciado de novo
+
+    fed.subscribe("#cd")
+    fed.unsubscribe("#cd")
+    assert fed.interest == {}
+
+
+def test_federation_high_water():
+    """Test that a trunk that does not keep up is dropped and redialed."""
+    fed = Federation(server_id="a", high_water=100)
+    fed.server = MagicMock()
+    trunk = Trunk(MagicMock(**{"sendmsg.side_effect": BlockingIOError}), ("localhost", 1))
+    fed.trunks = {trunk.sock: trunk}
+
+    fed.send(trunk, b"x" * 60)
+    assert trunk.outbound.size == 60 and fed.trunks == {trunk.sock: trunk}
+    fed.send(trunk, b"x" * 60)
+    assert fed.trunks == {}
+    trunk.sock.close.assert_called_once()
+    assert ("localhost", 1) in fed.retry
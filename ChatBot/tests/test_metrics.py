@@ -0,0 +1,31 @@
+"""Tests for the server metrics."""
+from src.metrics import Histogram, Metrics
+
+
+def test_histogram():
+    h = Histogram()
+    for value in range(1, 101):
+        h.record(value)
+
+    assert h.count == 100
+    assert h.max == 100
+    assert h.percentile(0.5) == 63  # Balde [32, 64)
+    assert h.percentile(0.99) == 100
+    assert h.snapshot()["mean"] == 50.5
+
+
+def test_snapshot():
+    m = Metrics()
+    m.message("#cd", 3, 5000)
+    m.message("#cd", 3, 7000)
+    m.message("#quiet", 1, 1000)
+    m.bytes_out = 900
+
+    report = m.snapshot(4, {"#cd": 4, "#quiet": 2}, [0, 100, 0, 50], top=1)
+
+    assert report["users"] == 4
+    assert report["messages_in"] == 3
+    assert report["messages_out"] == 7
+    assert report["outbound"] == {"pending_bytes": 150, "max_bytes": 100, "backlogged": 2}
+    assert report["hot_channels"] == {"#cd": {"members": 4, "in": 2, "out": 6}}
+    assert report["fanout_us"]["count"] == 3
@@ -1,11 +1,18 @@
 """Tests for the chat protocol."""
+import socket
+
 import pytest
+from unittest.mock import MagicMock
 from src.protocol import (
     CDProto,
     TextMessage,
     JoinMessage,
     RegisterMessage,
     CDProtoBadFormat,
+    CDProtoDecoder,
+    FrameCache,
+    PingMessage,
+    PongMessage,
 )
 
 from freezegun import freeze_time
@@ -19,6 +26,8 @@ def test_protocol():
 
     assert str(p.join("#cd")) == '{"command": "join", "channel": "#cd"}'
 
+    assert str(p.join("#cd", 10)) == '{"command": "join", "channel": "#cd", "replay": 10}'
+
     assert (
         str(p.message("Hello World"))
         == '{"command": "message", "message": "Hello World", "ts": 1615852800}'
@@ -59,3 +68,176 @@ def test_recv():
 
     with pytest.raises(CDProtoBadFormat):
         CDProto.recv_msg(mock_socket(b"Hello World"))
+
+
+@pytest.mark.parametrize("payload", [
+    b'{"command": "join", "channel": "#cd", "replay": "5"}',
+    b'{"command": "join", "channel": "#cd", "replay": -1}',
+    b'{"command": "join", "channel": "#cd", "since": 1.5}',
+    b'{"command": "join", "channel": "#cd", "since": true}',
+    b'{"command": "message", "message": "Hi", "ts": 1700000000.5}',
+    b'{"command": "message", "message": "Hi", "ts": -1}',
+    b'{"command": "message", "message": "Hi", "ts": "now"}',
+    b'{"command": "message", "message": "Hi", "ts": 1, "seq": "2"}',
+    b'{"command": "chunk", "stream": "1", "data": "x", "more": false, "ts": -5}',
+    b'{"command": "ping", "ts": "x"}',
+])
+def test_invalid_integers(payload):
+    with pytest.raises(CDProtoBadFormat):
+        CDProto.decode(payload)
+
+
+def test_broadcast():
+    a, b = MagicMock(), MagicMock()
+    msg = CDProto.message("Hello World", "#cd")
+
+    frame = CDProto.broadcast([a, b], msg)
+
+    assert bytes(frame) == CDProto.encode(msg, *CDProto.CANONICAL)
+    assert bytes(a.sendall.call_args[0][0]) == CDProto.encode(msg)
+    assert a.sendall.call_args[0][0] is b.sendall.call_args[0][0]
+
+
+class chunked_socket:
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, buffer):
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        buffer[: len(chunk)] = chunk
+        return len(chunk)
+
+
+def test_decoder():
+    stream = b"".join(
+        CDProto.encode(m)
+        for m in [CDProto.register("student"), CDProto.join("#cd"), CDProto.message("Hi", "#cd")]
+    )
+    conn = chunked_socket([stream[:3], stream[3:50], stream[50:]])
+    decoder = CDProtoDecoder()
+
+    assert decoder.read(conn)
+    assert list(decoder.messages()) == []
+
+    assert decoder.read(conn)
+    msgs = list(decoder.messages())
+    assert [type(m) for m in msgs] == [RegisterMessage]
+
+    assert decoder.read(conn)
+    msgs = list(decoder.messages())
+    assert [type(m) for m in msgs] == [JoinMessage, TextMessage]
+    assert msgs[1].message == "Hi"
+
+    assert not decoder.read(conn)
+
+
+def test_json_escaping():
+    msg = CDProto.decode(str(CDProto.message('He said "hi" \\o/', "#cd")).encode("utf-8"))
+    assert msg.message == 'He said "hi" \\o/'
+
+
+@pytest.mark.parametrize(
+    "msg",
+    [
+        CDProto.register("student", "binary"),
+        CDProto.register("estudante"),
+        CDProto.join("#cd"),
+        CDProto.join("#cd", 0),
+        CDProto.join("#cd", 300),
+        CDProto.join("#cd", since=0),
+        CDProto.join("#cd", 5, 1 << 40),
+        CDProto.message('Olá "Mundo"', "#cd"),
+        CDProto.message("Hello World"),
+        TextMessage("Olá", "#cd", 1700000000, 0),
+        PingMessage(),
+        PongMessage(1700000000),
+    ],
+)
+def test_binary_codec(msg):
+    frame = CDProto.encode(msg, "binary")
+    assert len(frame) < len(CDProto.encode(msg))
+
+    decoded = CDProto.decode(frame[2:])
+    assert type(decoded) is type(msg)
+    assert decoded.fields() == msg.fields()
+
+
+def test_frame_cache():
+    msg = CDProto.message("Hello World", "#cd")
+    frames = FrameCache(frame=CDProto.encode(msg, *CDProto.CANONICAL))
+
+    assert bytes(frames.get("binary")) == CDProto.encode(msg, "binary")
+    assert frames.get("binary") is frames.get("binary")
+    assert bytes(frames.get("json", 2)) == CDProto.encode(msg)
+
+
+def test_compression():
+    msg = CDProto.message("Olá a todos, hoje falamos de sistemas distribuídos e de sistemas de mensagens", "#cd")
+    frame = CDProto.encode(msg, compress="zlib")
+    assert frame[2:3] == b"x"
+    assert len(frame) < len(CDProto.encode(msg))
+    assert CDProto.decode(frame[2:]).fields() == msg.fields()
+
+    small = CDProto.message("Olá", "#cd")
+    assert CDProto.encode(small, "binary", compress="zlib") == CDProto.encode(small, "binary")  # Não compensa
+    assert len(CDProto.encode(small, compress="zlib")) < len(CDProto.encode(small))  # Graças ao dicionário
+
+    frames = FrameCache(msg)
+    compressed = frames.get("json", 2, "zlib")
+    assert bytes(frames.get("json", 4, "zlib")[4:]) == bytes(compressed[2:])  # O mesmo payload comprimido
+
+    bomb = CDProto.compress(b"{" + b" " * (CDProto.MAX_FRAME + 1))
+    with pytest.raises(CDProtoBadFormat):
+        CDProto.decode(bomb)
+
+
+def test_large_messages():
+    msg = CDProto.message("x" * 100000, "#cd")
+    frames = FrameCache(msg)
+
+    assert frames.get("json", 2) is None  # Não cabe em 2 bytes
+    assert len(frames.get("json", 4)) > 100000
+
+    chunks = list(CDProto.chunks("1", msg.message, "#cd", 40000))
+    assert [len(c.data) for c in chunks] == [40000, 40000, 20000]
+    assert [c.more for c in chunks] == [True, True, False]
+
+    stream = b"".join(CDProto.encode(c, "binary", 4) for c in chunks)
+    decoder = CDProtoDecoder(header=4)
+    decoder.feed(stream)
+    decoded = list(decoder.messages())
+    assert "".join(c.data for c in decoded) == msg.message
+    assert decoded[-1].fields() == chunks[-1].fields()
+
+
+def test_decoder_framing_switch():
+    decoder = CDProtoDecoder()
+    decoder.feed(CDProto.encode(CDProto.register("student", framing=2)))
+    decoder.feed(CDProto.encode(CDProto.join("#cd"), header=4))
+
+    msgs = decoder.messages()
+    assert next(msgs).framing == 2
+    decoder.header = 4
+    assert next(msgs).channel == "#cd"
+
+
+def test_decoder_max_frame():
+    decoder = CDProtoDecoder(header=4, max_frame=1000)
+    decoder.feed((5000).to_bytes(4, "big"))
+    with pytest.raises(CDProtoBadFormat):
+        list(decoder.messages())
+
+
+def test_decoder_drain():
+    a, b = socket.socketpair()
+    a.sendall(b"".join(CDProto.encode(CDProto.message(f"m{i}", "#cd")) for i in range(1000)))
+    decoder = CDProtoDecoder(chunk_size=4096)
+    # Um único drain lê mais do que um chunk, sem bloquear quando o socket fica vazio
+    assert decoder.drain(b)
+    assert [msg.message for msg in decoder.messages()] == [f"m{i}" for i in range(1000)]
+    assert decoder.drain(b)
+    a.close()
+    assert not decoder.drain(b)
+    b.close()
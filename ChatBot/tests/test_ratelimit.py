@@ -0,0 +1,18 @@
+"""Tests for the token buckets."""
+from src.ratelimit import TokenBucket
+
+
+def test_token_bucket():
+    bucket = TokenBucket(2, 3, now=0)
+
+    for _ in range(3):  # Rajada inicial
+        assert bucket.ready(0)
+        bucket.take()
+    assert not bucket.ready(0)
+
+    assert bucket.ready(0.5)  # 2 mensagens por segundo
+    bucket.take()
+    assert not bucket.ready(0.5)
+
+    assert bucket.ready(100)
+    assert bucket.tokens == 3  # Nunca acumula mais do que a rajada
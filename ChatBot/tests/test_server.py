@@ -1,8 +1,11 @@
+import os
 import pytest
+import selectors
 from unittest.mock import patch
 from mock import MagicMock
 
-from src.server import Server
+from src.server import ChannelHistory, OutboundQueue, Server
+from src.protocol import CDProto, CDProtoDecoder, PingMessage
 
 
 class CDProtoException(Exception):
@@ -26,3 +29,406 @@ def test_server():
         assert mock_socket.call_count == 1
         assert mock_selector.call_count == 1
         assert mock_register.call_count == 1
+
+
+def connect(server):
+    """Accept a mocked client connection whose socket takes every byte."""
+    conn = MagicMock()
+    conn.sendmsg.side_effect = lambda buffers: sum(map(len, buffers))
+    server.s.accept.return_value = (conn, None)
+    server.accept(server.s, None)
+    return conn
+
+
+def deliver(server, conn, *msgs, header=2):
+    """Make the server read the frames of msgs from a mocked connection in one recv."""
+    data = b"".join(CDProto.encode(msg, header=header) for msg in msgs)
+
+    def recv_into(buffer):
+        buffer[:len(data)] = data
+        return len(data)
+
+    conn.recv_into.side_effect = recv_into
+    server.read(conn, selectors.EVENT_READ)
+    server.flush()  # Fim da iteração do loop
+
+
+def test_channel_index():
+    """Test that broadcasts only reach members of the channel."""
+
+    with patch("socket.socket"), patch("selectors.DefaultSelector.register"):
+        s = Server()
+        s.selector = MagicMock()
+        foo, bar, baz = connect(s), connect(s), connect(s)
+
+        for conn, user in ((foo, "foo"), (bar, "bar"), (baz, "baz")):
+            deliver(s, conn, CDProto.register(user))
+
+        deliver(s, bar, CDProto.join("#cd"))
+
+        assert s.channels == {"None": {foo, bar, baz}, "#cd": {bar}}
+
+        deliver(s, foo, CDProto.message("Hello", "#cd"))
+        assert bar.sendmsg.call_count == 1
+        assert foo.sendmsg.call_count == 0
+        assert baz.sendmsg.call_count == 0
+
+        deliver(s, bar)  # EOF
+        assert s.channels == {"None": {foo, baz}}
+        assert bar not in s.infUsers
+
+
+def test_compact_sessions():
+    """Test that sessions keep interned channel ids and share the read buffer."""
+
+    with patch("socket.socket"), patch("selectors.DefaultSelector.register"):
+        s = Server()
+        s.selector = MagicMock()
+        foo, bar = connect(s), connect(s)
+
+        deliver(s, foo, CDProto.register("foo"), CDProto.join("#cd"), CDProto.join("#cd"))
+        deliver(s, bar, CDProto.register("bar"), CDProto.join("#cd"))
+
+        assert s.infUsers[foo].channels == s.infUsers[bar].channels == [0, 1]
+        assert s.channel_names == ["None", "#cd"]
+        assert not hasattr(s.infUsers[foo], "__dict__")
+        assert not hasattr(CDProto.message("Hello", "#cd"), "__dict__")
+        assert s.decoders[foo].chunk is s.decoders[bar].chunk
+        assert s.outbound[foo].frames is None  # Tudo enviado
+
+        deliver(s, foo)  # EOF
+        assert s.channels == {"None": {bar}, "#cd": {bar}}
+
+
+def test_rate_limit():
+    """Test that messages over the user and channel limits are dropped before the fan-out."""
+
+    with patch("socket.socket"), patch("selectors.DefaultSelector.register"), \
+            patch("time.monotonic", return_value=100.0) as clock:
+        s = Server(user_limit=(1, 2), channel_limit=(10, 3))
+        s.selector = MagicMock()
+        foo, bar, baz = connect(s), connect(s), connect(s)
+        for conn, user in ((foo, "foo"), (bar, "bar"), (baz, "baz")):
+            deliver(s, conn, CDProto.register(user))
+
+        deliver(s, foo, *(CDProto.message(str(i), "None") for i in range(4)))
+        received = CDProtoDecoder()
+        for call in bar.sendmsg.call_args_list:
+            received.feed(b"".join(call[0][0]))
+        assert [msg.message for msg in received.messages()] == ["(foo): 0", "(foo): 1"]
+        assert foo.sendmsg.call_count == 1  # Um único aviso
+        assert s.metrics.limited == 2
+
+        deliver(s, baz, CDProto.message("a", "None"), CDProto.message("b", "None"))
+        assert s.metrics.limited == 3  # Limite do canal
+        assert baz.sendmsg.call_count == 2  # A mensagem de foo e o aviso
+
+        clock.return_value = 101.0
+        deliver(s, foo, CDProto.message("later", "None"))
+        assert s.metrics.limited == 3
+
+
+def test_keepalive():
+    """Test that idle connections are pinged and closed if they do not answer."""
+
+    with patch("socket.socket"), patch("selectors.DefaultSelector.register"), \
+            patch("time.monotonic", return_value=100.0) as clock:
+        s = Server(keepalive=(30, 10))
+        s.selector = MagicMock()
+        foo, bar = connect(s), connect(s)
+        deliver(s, foo, CDProto.register("foo"))
+        deliver(s, bar, CDProto.register("bar"))
+
+        clock.return_value = 131.0
+        s.poll(0)
+        for conn in (foo, bar):
+            assert CDProto.decode(bytes(conn.sendmsg.call_args[0][0][0][2:])).command == "ping"
+
+        clock.return_value = 135.0
+        deliver(s, foo, CDProto.pong())
+        clock.return_value = 142.0
+        s.poll(0)
+        assert foo in s.infUsers
+        assert bar not in s.infUsers and bar.close.called
+        assert s.metrics.reaped == 1
+
+        deliver(s, foo, CDProto.message("Olá", "None"), CDProto.join("#cd"))
+        clock.return_value = 160.0
+        s.poll(0)
+        assert foo.sendmsg.call_count == 1  # Ativo há pouco tempo, sem novo ping
+        assert len(s.wheel) == 1
+
+        deliver(s, foo, PingMessage(7))
+        assert CDProto.decode(bytes(foo.sendmsg.call_args[0][0][0][2:])).fields() == {"command": "pong", "ts": 7}
+
+
+def test_keepalive_prompt_pong():
+    """Test that a connection answering the ping at once is kept past the reap timer."""
+
+    with patch("socket.socket"), patch("selectors.DefaultSelector.register"), \
+            patch("time.monotonic", return_value=100.0) as clock:
+        s = Server(keepalive=(30, 10))
+        s.selector = MagicMock()
+        foo = connect(s)
+        deliver(s, foo, CDProto.register("foo"))
+
+        clock.return_value = 131.0
+        s.poll(0)
+        clock.return_value = 131.01
+        deliver(s, foo, CDProto.pong())
+        clock.return_value = 141.1  # timeout e mais um tick depois do ping
+        s.poll(0)
+        assert foo in s.infUsers and not foo.close.called
+        assert s.metrics.reaped == 0
+
+        clock.return_value = 162.0  # Sem responder ao ping seguinte
+        s.poll(0)
+        clock.return_value = 173.0
+        s.poll(0)
+        assert foo not in s.infUsers and s.metrics.reaped == 1
+
+
+def test_slow_consumer():
+    """Test that a full socket queues frames and slow consumers are cut off."""
+
+    with patch("socket.socket"), patch("selectors.DefaultSelector.register"):
+        s = Server(high_water=100)
+        s.selector = MagicMock()
+        foo, bar = connect(s), connect(s)
+        bar.sendmsg.side_effect = BlockingIOError
+
+        for conn, user in ((foo, "foo"), (bar, "bar")):
+            deliver(s, conn, CDProto.register(user))
+
+        deliver(s, foo, CDProto.message("Hello", "None"))
+        assert s.outbound[bar].size > 0
+        assert s.outbound[bar].writing
+        assert s.selector.modify.call_args[0][1] == selectors.EVENT_READ | selectors.EVENT_WRITE
+
+        bar.sendmsg.side_effect = lambda buffers: sum(map(len, buffers))
+        s.service(bar, selectors.EVENT_WRITE)
+        assert s.outbound[bar].size == 0
+        assert s.selector.modify.call_args[0][1] == selectors.EVENT_READ
+
+        bar.sendmsg.side_effect = BlockingIOError
+        deliver(s, foo, *[CDProto.message("Hello", "None")] * 5)
+        assert bar not in s.outbound
+        assert bar.close.called
+        assert s.channels == {"None": {foo}}
+        # EVENT_WRITE of the same select, returned before bar was disconnected
+        s.service(bar, selectors.EVENT_WRITE | selectors.EVENT_READ)
+
+        # Uma conexão ainda sem registo também pode ser um consumidor lento
+        baz = connect(s)
+        baz.sendmsg.side_effect = BlockingIOError
+        s.send(baz, b"x" * 101)
+        assert baz not in s.outbound
+
+
+def test_history_replay():
+    """Test that a late joiner receives the last messages of the channel in one write."""
+
+    with patch("socket.socket"), patch("selectors.DefaultSelector.register"):
+        s = Server(history=(2, 1 << 16))
+        s.selector = MagicMock()
+        foo, bar = connect(s), connect(s)
+
+        deliver(s, foo, CDProto.register("foo"), CDProto.join("#cd"))
+        deliver(s, foo, *[CDProto.message(f"msg {i}", "#cd") for i in range(3)])
+        assert len(s.history["#cd"].frames) == 2
+
+        deliver(s, bar, CDProto.register("bar"), CDProto.join("#cd", replay=5))
+        assert bar.sendmsg.call_count == 1
+        replayed = CDProtoDecoder()
+        replayed.feed(b"".join(bar.sendmsg.call_args[0][0]))
+        assert [m.message for m in replayed.messages()] == ["(foo): msg 1", "(foo): msg 2"]
+
+
+def test_log_catch_up(tmp_path):
+    """Test that messages are numbered in the log and replayed from an offset in batches."""
+
+    with patch("socket.socket"), patch("selectors.DefaultSelector.register"):
+        s = Server(high_water=400, log_dir=str(tmp_path))
+        s.selector = MagicMock()
+        foo = connect(s)
+        deliver(s, foo, CDProto.register("foo"), CDProto.join("#cd"))
+        deliver(s, foo, *[CDProto.message(f"msg {i}", "#cd") for i in range(10)])
+        deliver(s, foo, CDProto.message("nobody", "#empty"))  # Canal sem membros, sem log
+        assert sorted(os.listdir(tmp_path)) == ["c%23cd"]
+        s.log.close()
+
+    with patch("socket.socket"), patch("selectors.DefaultSelector.register"):
+        s = Server(high_water=400, log_dir=str(tmp_path))  # Reinício
+        s.selector = MagicMock()
+        bar, baz = connect(s), connect(s)
+        deliver(s, bar, CDProto.register("bar", framing=2))
+        deliver(s, bar, CDProto.join("#cd", since=3), header=4)
+        while s.dirty:  # Iterações seguintes do loop
+            s.flush()
+        deliver(s, baz, CDProto.register("baz", "binary"), CDProto.join("#cd", since=8))
+
+        assert bar.sendmsg.call_count > 1  # Vários lotes
+        replayed = CDProtoDecoder(header=4)
+        for call in bar.sendmsg.call_args_list:
+            replayed.feed(b"".join(call[0][0]))
+        assert [(m.seq, m.message) for m in replayed.messages()] == [(i + 1, f"(foo): msg {i}") for i in range(3, 10)]
+        assert s.infUsers[bar].cursor is None
+
+        replayed = CDProtoDecoder()
+        replayed.feed(b"".join(baz.sendmsg.call_args[0][0]))
+        assert [m.seq for m in replayed.messages()] == [9, 10]
+
+        deliver(s, bar, CDProto.message("new", "#cd"), header=4)
+        assert CDProto.decode(bytes(baz.sendmsg.call_args[0][0][0][2:])).seq == 11
+
+
+def test_channel_state_released():
+    """Test that channels without local members keep no history, limits nor counters."""
+
+    with patch("socket.socket"), patch("selectors.DefaultSelector.register"):
+        s = Server(channel_limit=(10, 3))
+        s.selector = MagicMock()
+        foo, bar = connect(s), connect(s)
+        deliver(s, foo, CDProto.register("foo"))
+        deliver(s, bar, CDProto.register("bar"))
+
+        deliver(s, foo, *[CDProto.message("Hello", f"#empty{i}") for i in range(3)])
+        assert list(s.history) == []
+        assert list(s.channel_buckets) == []
+        assert list(s.metrics.messages_in) == []
+        assert s.stats()["messages_in"] == 3
+
+        deliver(s, bar, CDProto.join("#cd"))
+        deliver(s, foo, CDProto.message("Hello", "#cd"))
+        assert "#cd" in s.history and "#cd" in s.channel_buckets and "#cd" in s.metrics.messages_in
+
+        deliver(s, bar)  # EOF
+        assert "#cd" not in s.history and "#cd" not in s.channel_buckets and "#cd" not in s.metrics.messages_in
+        assert "#cd" not in s.channel_ids
+        assert s.stats()["messages_in"] == 4
+
+        deliver(s, foo, CDProto.join("#other"))
+        assert s.channel_ids["#other"] == 1  # Id de #cd reutilizado
+
+
+def test_history_bounds():
+    h = ChannelHistory(10, 10)
+    for frame in (b"aaaa", b"bbbb", b"cccc"):
+        h.append(frame)
+    assert h.size == 8
+    assert h.last(5) == b"bbbbcccc"
+    assert h.last(1) == b"cccc"
+
+
+def test_codec_translation():
+    """Test that members receive broadcasts in the codec they negotiated."""
+
+    with patch("socket.socket"), patch("selectors.DefaultSelector.register"):
+        s = Server()
+        s.selector = MagicMock()
+        foo, bar, baz = connect(s), connect(s), connect(s)
+
+        deliver(s, foo, CDProto.register("foo"))
+        deliver(s, bar, CDProto.register("bar", "binary"))
+        deliver(s, baz, CDProto.register("baz", "binary"))
+        deliver(s, bar, CDProto.message("Olá", "None"))
+
+        sent = foo.sendmsg.call_args[0][0][0]
+        assert sent[2:3] == b"{"  # JSON
+        assert baz.sendmsg.call_args[0][0][0][2] == 3  # BinaryCodec.MESSAGE
+        assert CDProto.decode(bytes(sent[2:])).message == "(bar): Olá"
+
+        # O ts é reenviado em varint aos membros binários, um ts inválido fecha apenas o remetente
+        data = b'{"command": "message", "message": "Hi", "ts": 1700000000.5}'
+        data = len(data).to_bytes(2, "big") + data
+        foo.recv_into.side_effect = lambda buffer: buffer.__setitem__(slice(0, len(data)), data) or len(data)
+        s.read(foo, selectors.EVENT_READ)
+        assert foo not in s.infUsers
+        assert s.channels == {"None": {bar, baz}}
+
+
+def test_compression():
+    """Test that a broadcast is compressed once for every member that negotiated compression."""
+
+    with patch("socket.socket"), patch("selectors.DefaultSelector.register"):
+        s = Server()
+        s.selector = MagicMock()
+        foo, bar, baz = connect(s), connect(s), connect(s)
+
+        deliver(s, foo, CDProto.register("foo"))
+        deliver(s, bar, CDProto.register("bar", compress="zlib"))
+        deliver(s, baz, CDProto.register("baz", compress="zlib"))
+        text = "uma mensagem comprida o suficiente para que a compressão compense " * 2
+        deliver(s, foo, CDProto.message(text, "None"))
+
+        compressed = bar.sendmsg.call_args[0][0][0]
+        assert compressed is baz.sendmsg.call_args[0][0][0]  # Comprimida uma única vez
+        assert compressed[2:3] == b"x"
+        assert CDProto.decode(bytes(compressed[2:])).message == "(foo): " + text
+
+
+def test_write_coalescing():
+    """Test that the frames of one loop iteration are written with a single sendmsg."""
+
+    with patch("socket.socket"), patch("selectors.DefaultSelector.register"):
+        s = Server()
+        s.selector = MagicMock()
+        foo, bar = connect(s), connect(s)
+
+        deliver(s, foo, CDProto.register("foo"))
+        deliver(s, bar, CDProto.register("bar"))
+        deliver(s, foo, *[CDProto.message(f"msg {i}", "None") for i in range(10)])
+
+        assert bar.sendmsg.call_count == 1
+        assert len(bar.sendmsg.call_args[0][0]) == 10
+        assert s.outbound[bar].size == 0
+
+        stats = s.stats()
+        assert stats["users"] == 2
+        assert stats["messages_in"] == 10
+        assert stats["messages_out"] == 10
+        assert stats["hot_channels"]["None"]["members"] == 2
+
+
+def test_partial_writev():
+    queue = OutboundQueue()
+    for frame in (b"aaaa", b"bbbb", b"cccc"):
+        queue.append(memoryview(frame))
+    conn = MagicMock()
+    conn.sendmsg.return_value = 6
+
+    assert not queue.writev(conn)
+    assert queue.size == 6
+    assert [bytes(f) for f in queue.frames] == [b"bb", b"cccc"]
+
+
+def test_streaming():
+    """Test that long messages are relayed piece by piece to members with 4 byte framing."""
+
+    with patch("socket.socket"), patch("selectors.DefaultSelector.register"):
+        s = Server()
+        s.selector = MagicMock()
+        foo, bar, old = connect(s), connect(s), connect(s)
+
+        deliver(s, foo, CDProto.register("foo", framing=2))
+        deliver(s, bar, CDProto.register("bar", "binary", 2))
+        deliver(s, old, CDProto.register("old"))
+        assert s.decoders[bar].header == 4
+        assert s.wire(old) == ("json", 2, None)
+
+        chunks = list(CDProto.chunks("1", "x" * 50000, "None", 20000))
+        for chunk in chunks:
+            deliver(s, foo, chunk, header=4)
+
+        assert bar.sendmsg.call_count == 3
+        received = CDProtoDecoder(header=4)
+        for call in bar.sendmsg.call_args_list:
+            received.feed(b"".join(call[0][0]))
+        pieces = list(received.messages())
+        assert len({p.stream for p in pieces}) == 1
+        assert "".join(p.data for p in pieces) == "(foo): " + "x" * 50000
+        assert not s.infUsers[foo].streams
+
+        assert old.sendmsg.call_count == 1  # Apenas o aviso
+        notice = CDProto.decode(bytes(old.sendmsg.call_args[0][0][0][2:]))
+        assert notice.message.startswith("(foo): [mensagem longa omitida")
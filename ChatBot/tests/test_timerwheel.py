@@ -0,0 +1,43 @@
+"""Tests for the hierarchical timer wheel."""
+import random
+from unittest.mock import patch
+
+from src.timerwheel import TimerWheel
+
+
+def test_timer_wheel():
+    clock = [0.0]
+    with patch("time.monotonic", side_effect=lambda: clock[0]):
+        wheel = TimerWheel(resolution=1, bits=2, levels=3, now=0)  # 4 slots por nível, alcance de 64 ticks
+        fired = []
+        delays = [1, 2, 3, 4, 5, 15, 16, 17, 40, 63, 64, 100, 250]
+        timers = {delay: wheel.schedule(delay, lambda d: fired.append((d, clock[0])), delay) for delay in delays}
+        wheel.cancel(timers.pop(17))
+        assert len(wheel) == len(delays) - 1
+
+        while clock[0] < 300:
+            timeout = wheel.timeout()
+            if timeout is None:
+                break
+            clock[0] += max(timeout, 1)
+            wheel.advance()
+
+        assert [d for d, _ in fired] == sorted(timers)
+        assert all(at == d for d, at in fired)  # Nem antes nem depois do tick certo
+        assert wheel.timeout() is None
+
+
+def test_timer_wheel_random():
+    clock = [0.0]
+    with patch("time.monotonic", side_effect=lambda: clock[0]):
+        wheel = TimerWheel(resolution=0.1, now=0)
+        rng = random.Random(1)
+        fired = []
+        for _ in range(2000):
+            delay = rng.uniform(0, 1000)
+            wheel.schedule(delay, lambda due: fired.append(clock[0] - due), delay)
+        while len(wheel):
+            clock[0] += rng.uniform(0, 3)
+            wheel.advance()
+        assert len(fired) == 2000
+        assert all(0 <= late < 3.2 for late in fired)
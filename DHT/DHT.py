@@ -3,9 +3,23 @@ import time
 import sys
 import argparse
 from DHTNode import DHTNode
+from storage import MemoryStore, log_store
 
 
-def main(number_nodes, timeout):
+def report(dht):
+    """ Share of the ring and of the stored keys of each node, counting all its virtual positions. """
+    total = sum(len(node.keystore) for node in dht)
+    lines = []
+    for node in dht:
+        shares = [position.share for position in node.positions.values()]
+        keys = len(node.keystore)
+        lines.append("{}:{} {:3d} positions {:6.1%} of the ring {:8d} keys {:6.1%}".format(
+            *node.addr, len(shares), sum(share for share in shares if share is not None),
+            keys, keys / total if total else 0))
+    return "\n".join(lines)
+
+
+def main(number_nodes, timeout, replication=1, store=MemoryStore, vnodes=1, interval=None):
     """ Script to launch several DHT nodes. """
 
     # logger for the main
@@ -13,7 +27,7 @@ def main(number_nodes, timeout):
     # list with all the nodes
     dht = []
     # initial node on DHT
-    node = DHTNode(("localhost", 5000))
+    node = DHTNode(("localhost", 5000), replication=replication, store=store, vnodes=vnodes)
     node.start()
     dht.append(node)
     logger.info(node)
@@ -21,13 +35,17 @@ def main(number_nodes, timeout):
     for i in range(number_nodes - 1):
         time.sleep(0.2)
         # Create DHT_Node threads on ports 5001++ and with initial DHT_Node on port 5000
-        node = DHTNode(("localhost", 5001 + i), ("localhost", 5000), timeout)
+        node = DHTNode(("localhost", 5001 + i), ("localhost", 5000), timeout, replication, store, vnodes)
         node.start()
         dht.append(node)
         logger.info(node)
 
     # Await for DHT to get stable
     time.sleep(10)
+    print(report(dht))
+    while interval and any(node.is_alive() for node in dht):
+        time.sleep(interval)
+        print(report(dht))
 
     # Await for all nodes to stop
     for node in dht:
@@ -41,6 +59,10 @@ if __name__ == "__main__":
     parser.add_argument("--savelog", default=False, action="store_true")
     parser.add_argument("--nodes", type=int, default=5)
     parser.add_argument("--timeout", type=int, default=3)
+    parser.add_argument("--replication", type=int, default=1, help="copies of every key")
+    parser.add_argument("--data-dir", help="keep the keys of every node in a log under this directory")
+    parser.add_argument("--vnodes", type=int, default=1, help="positions of every node in the ring")
+    parser.add_argument("--report", type=float, help="seconds between reports of the share of every node")
     args = parser.parse_args()
 
     logfile = {}
@@ -55,4 +77,6 @@ if __name__ == "__main__":
         )
 
 
-    main(args.nodes, timeout=args.timeout)
+    store = MemoryStore if args.data_dir is None else log_store(args.data_dir)
+    main(args.nodes, timeout=args.timeout, replication=args.replication, store=store, vnodes=args.vnodes,
+         interval=args.report)
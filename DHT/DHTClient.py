@@ -1,23 +1,246 @@
 import socket
-import pickle
 import logging
+import select
+import time
+from bisect import bisect_left, insort
+from collections import deque
+from utils import dht_hash, contains, DATAGRAM, RECV_BUFFER
+from codec import encode, Reassembler, DHTProtoBadFormat
+
+
+class RoutingCache:
+    """Ranges of the ring learned from the nodes that answered the client."""
+
+    def __init__(self):
+        """Initialize an empty cache."""
+        self.ids = []  # sorted ids of the known nodes
+        self.nodes = {}  # node id -> (predecessor id, address, addresses of the replicas)
+
+    def learn(self, node_id, node_addr, predecessor_id, replicas=()):
+        """Record that the node at node_addr owns the keys in (predecessor_id, node_id], replicated in replicas."""
+        if predecessor_id is None:  # the node does not know its range yet
+            return
+        for other in list(self.ids):
+            if other != node_id and contains(predecessor_id, node_id, other):
+                self.forget(other)  # nodes inside the range are no longer in the ring
+        if node_id not in self.nodes:
+            insort(self.ids, node_id)
+        self.nodes[node_id] = (predecessor_id, node_addr, list(replicas))
+
+    def lookup(self, key_hash):
+        """Return the address of the node known to own key_hash, or None."""
+        nodes = self.replicas(key_hash)
+        return nodes[0] if nodes else None
+
+    def replicas(self, key_hash):
+        """Return the addresses of the owner of key_hash and of its replicas, or [] if unknown."""
+        if not self.ids:
+            return []
+        node_id = self.ids[bisect_left(self.ids, key_hash) % len(self.ids)]
+        predecessor_id, node_addr, replicas = self.nodes[node_id]
+        if predecessor_id == node_id or contains(predecessor_id, node_id, key_hash):
+            return [node_addr] + replicas
+        return []
+
+    def invalidate(self, key_hash):
+        """Forget the node that was believed to own key_hash."""
+        if self.lookup(key_hash) is not None:
+            self.forget(self.ids[bisect_left(self.ids, key_hash) % len(self.ids)])
+
+    def forget(self, node_id):
+        """Remove a node from the cache."""
+        if self.nodes.pop(node_id, None) is not None:
+            self.ids.remove(node_id)
+
+    def __len__(self):
+        return len(self.ids)
 
 
 class DHTClient:
-    def __init__(self, address):
-        """ Initialize client."""
+    def __init__(self, address, timeout=3, replica_reads=False):
+        """ Initialize client.
+
+        Parameters:
+            address: address of a node in the DHT, used when the owner of a key is unknown
+            timeout: seconds to wait for an answer before giving up on a node
+            replica_reads: read from the owner or replica of a key that answers fastest,
+                instead of always from its owner
+        """
         self.dht_addr = address
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.settimeout(timeout)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
+        self.timeout = timeout
+        self.rid = 0  # id of the last request, echoed by the nodes in their answers
+        self.cache = RoutingCache()
+        self.replica_reads = replica_reads
+        self.rtt = {}  # address -> smoothed response time of the node
+        self.reassembler = Reassembler()
         self.logger = logging.getLogger("DHTClient")
 
+    def request(self, key, msg, replica=False):
+        """ Send msg about key to its owner and return the answer, or None on timeout.
+
+        The owner learned from previous answers is tried first, and the
+        bootstrap node if it is unknown or does not answer. With replica, the
+        replicas of the key are tried too, starting with the fastest one.
+        """
+        key_hash = dht_hash(key)
+        if replica:
+            targets = sorted(self.cache.replicas(key_hash), key=lambda addr: self.rtt.get(addr, 0))
+            msg["args"]["replica"] = True
+        else:
+            owner = self.cache.lookup(key_hash)
+            targets = [] if owner is None else [owner]
+        targets += [self.dht_addr] if self.dht_addr not in targets else []
+        for target in targets:
+            self.rid += 1
+            msg["args"]["rid"] = self.rid
+            start = time.monotonic()
+            self.send(target, msg)
+            out = self.receive(self.rid)
+            if out is None:
+                self.logger.debug("Timeout from %s", target)
+                self.rtt[target] = self.timeout  # tried last until it answers again
+                self.cache.invalidate(key_hash)
+                continue
+            elapsed = time.monotonic() - start
+            self.rtt[target] = elapsed if target not in self.rtt else 0.8 * self.rtt[target] + 0.2 * elapsed
+            node = out.get("node")
+            if out["method"] == "ACK" and node is not None:
+                self.cache.learn(node["id"], node["addr"], node["predecessor"], node["replicas"])
+            else:
+                self.cache.invalidate(key_hash)
+            return out
+        return None
+
+    def send(self, address, msg):
+        """ Send msg to address, in several datagrams if it is too large for one.
+
+        A node address with a third item is a virtual node of the process at (host, port).
+        """
+        for payload in encode(msg, *address[2:]):
+            self.socket.sendto(payload, address[:2])
+
+    def recv(self):
+        """ Read a datagram and return the message it completes, or None."""
+        payload, addr = self.socket.recvfrom(DATAGRAM)
+        try:
+            return self.reassembler.decode(payload, addr)
+        except DHTProtoBadFormat as e:
+            self.logger.warning("Invalid datagram from %s: %s", addr, e)
+            return None
+
+    def receive(self, rid):
+        """ Wait for the answer to request rid, dropping late answers to older ones."""
+        while True:
+            try:
+                out = self.recv()
+            except socket.timeout:
+                return None
+            if out is not None and out.get("rid") == rid:
+                return out
+
+    def pipeline(self, method, entries, window, batch):
+        """ Send many keys in multi-key requests, keeping up to window of them in flight.
+
+        Keys are grouped by the owner known in the cache, batch keys per
+        datagram, and the nodes split each request among the owners of its
+        keys, which answer directly. A request whose keys are not all answered
+        before the timeout is retried once through the bootstrap node.
+
+        Parameters:
+            method: MPUT, with entries (key, value), or MGET, with entries key
+            entries: dict key -> entry
+            window: requests in flight
+            batch: keys per request
+
+        Returns dict key -> answer of the owner, None for the keys that got no answer.
+        """
+        replica = method == "MGET" and self.replica_reads
+        groups = {}
+        for key, entry in entries.items():
+            nodes = self.cache.replicas(dht_hash(key))[:None if replica else 1]
+            owner = min(nodes, key=lambda addr: self.rtt.get(addr, 0), default=self.dht_addr)
+            groups.setdefault(owner, []).append(key)
+        queue = deque()
+        for owner, keys in groups.items():
+            for i in range(0, len(keys), batch):
+                queue.append((owner, keys[i:i + batch], False))
+
+        field = "items" if method == "MPUT" else "keys"
+        results = dict.fromkeys(entries)
+        inflight = {}  # rid -> [pending keys, deadline, retried]
+        while queue or inflight:
+            while queue and len(inflight) < window:
+                target, keys, retried = queue.popleft()
+                self.rid += 1
+                inflight[self.rid] = [set(keys), time.monotonic() + self.timeout, retried]
+                args = {field: [entries[key] for key in keys], "rid": self.rid, "replica": replica}
+                self.send(target, {"method": method, "args": args})
+
+            wait = min(deadline for _, deadline, _ in inflight.values()) - time.monotonic()
+            readable, _, _ = select.select([self.socket], [], [], max(wait, 0))
+            if readable:
+                out = self.recv()
+                request = inflight.get(out.get("rid")) if out is not None else None
+                if request is None:  # incomplete, or a late answer to a request already given up
+                    continue
+                node = out.get("node")
+                if node is not None:
+                    self.cache.learn(node["id"], node["addr"], node["predecessor"], node["replicas"])
+                if out["method"] == "MPUT_REP":
+                    answers = dict.fromkeys(out["args"]["stored"], True)
+                    answers.update(dict.fromkeys(out["args"]["exists"], False))
+                else:
+                    answers = dict.fromkeys(out["args"]["missing"], (False, None))
+                    answers.update((key, (True, value)) for key, value in out["args"]["found"].items())
+                for key, answer in answers.items():
+                    if key in request[0]:
+                        request[0].discard(key)
+                        results[key] = answer
+                if not request[0]:
+                    del inflight[out["rid"]]
+                continue
+
+            now = time.monotonic()
+            for rid, (pending, deadline, retried) in list(inflight.items()):
+                if deadline <= now:
+                    del inflight[rid]
+                    for key in pending:
+                        self.cache.invalidate(dht_hash(key))
+                    if not retried:
+                        queue.append((self.dht_addr, list(pending), True))
+        return results
+
+    def put_many(self, items, window=32, batch=64):
+        """ Store many values in the DHT.
+
+        Parameters:
+            items: dict key -> value, or iterable of (key, value)
+            window: requests in flight
+            batch: keys per request
+
+        Returns dict key -> True if the value was stored.
+        """
+        entries = {key: (key, value) for key, value in dict(items).items()}
+        results = self.pipeline("MPUT", entries, window, batch)
+        return {key: bool(stored) for key, stored in results.items()}
+
+    def get_many(self, keys, window=32, batch=64):
+        """ Retrieve many keys from the DHT.
+
+        Returns dict key -> value, None for the keys that are not stored.
+        """
+        entries = {key: key for key in keys}
+        results = self.pipeline("MGET", entries, window, batch)
+        return {key: answer[1] if answer else None for key, answer in results.items()}
+
     def put(self, key, value):
         """ Store value to key in the DHT."""
         msg = {"method": "PUT", "args": {"key": key, "value": value}}
-        pickled_msg = pickle.dumps(msg)
-        self.socket.sendto(pickled_msg, self.dht_addr)
-        pickled_msg, addr = self.socket.recvfrom(1024)
-        out = pickle.loads(pickled_msg)
-        if out["method"] != "ACK":
+        out = self.request(key, msg)
+        if out is None or out["method"] != "ACK":
             self.logger.error("Invalid msg: %s", out)
             return False
         return True
@@ -25,11 +248,8 @@ class DHTClient:
     def get(self, key):
         """ Retrieve key from DHT."""
         msg = {"method": "GET", "args": {"key": key}}
-        pickled_msg = pickle.dumps(msg)
-        self.socket.sendto(pickled_msg, self.dht_addr)
-        pickled_msg, addr = self.socket.recvfrom(1024)
-        out = pickle.loads(pickled_msg)
-        if out["method"] != "ACK":
+        out = self.request(key, msg, self.replica_reads)
+        if out is None or out["method"] != "ACK":
             self.logger.error("Invalid msg: %s", out)
             return None
         return out["args"]
@@ -2,8 +2,10 @@
 import socket
 import threading
 import logging
-import pickle
-from utils import dht_hash, contains
+import time
+from utils import dht_hash, contains, DATAGRAM, RECV_BUFFER
+from codec import encode, Reassembler, DHTProtoBadFormat
+from storage import MemoryStore
 
 
 class FingerTable:
@@ -31,6 +33,10 @@ class FingerTable:
                 return self.finger_table[i][1]
         return self.finger_table[0][1]
 
+    def replace(self, old_id, node_id, node_addr):
+        """Replace every entry pointing to the node old_id with a specific node ID and address."""
+        self.finger_table = [(node_id, node_addr) if entry[0] == old_id else entry for entry in self.finger_table]
+
     def refresh(self):
         """Refresh the finger table based on current node ID and network size."""
         return [(i + 1, (self.node_id + 2**i) % (2**self.m_bits), self.finger_table[i][1]) for i in range(len(self.finger_table))]
@@ -56,15 +62,24 @@ class FingerTable:
 class DHTNode(threading.Thread):
     """ DHT Node Agent. """
 
-    def __init__(self, address, dht_address=None, timeout=3):
+    FAILURES = 3  # Stabilize rounds without an answer before a neighbour is considered dead
+
+    def __init__(self, address, dht_address=None, timeout=3, replication=1, store=MemoryStore, vnodes=1,
+                 primary=None):
         """Constructor
 
         Parameters:
             address: self's address
             dht_address: address of a node in the DHT
             timeout: impacts how often stabilize algorithm is carried out
+            replication: copies of every key, kept by the owner and its next replication - 1 successors
+            store: opens the storage engine of a name, e.g. storage.log_store(directory) to keep the keys on disk
+            vnodes: positions of this process in the ring, the others at the virtual addresses (host, port, vid)
+            primary: node of the process serving this virtual position, None for the primary node itself
         """
         threading.Thread.__init__(self)
+        if not 0 < vnodes <= 256:
+            raise ValueError("vnodes must be between 1 and 256")
         self.done = False
         self.identification = dht_hash(address.__str__())
         self.addr = address  # My address
@@ -86,20 +101,112 @@ class DHTNode(threading.Thread):
         #TODO create finger_table
         self.finger_table = FingerTable(self.identification, self.addr)
 
-        self.keystore = {}  # Where all data is stored
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.settimeout(timeout)
+        self.replication = replication
+        self.successor_list = []  # (id, addr) of the next replication nodes, refreshed while stabilizing
+        self.unanswered = 0  # Stabilize rounds since the successor last answered
+        self.predecessor_silent = 0  # Stabilize rounds since the predecessor last notified us
+
         self.logger = logging.getLogger("Node {}".format(self.identification))
+        if primary is not None:
+            # Virtual positions are served by the socket of their process and share its keys
+            self.primary = primary
+            self.keystore = primary.keystore
+            self.replicas = primary.replicas
+            self.socket = primary.socket
+            return
+
+        self.primary = self
+        self.timeout = timeout
+        name = "{}-{}".format(*address)
+        self.keystore = store(name + "-keystore")  # Where all data is stored
+        self.replicas = store(name + "-replicas")  # Copies of the keys owned by our predecessors
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
+        self.reassembler = Reassembler()  # Rebuilds the messages split in several datagrams
+        self.positions = {0: self}  # vid -> node of each position of this process in the ring
+        for vid in range(1, vnodes):
+            node = DHTNode((*address, vid), dht_address or address, timeout, replication, primary=self)
+            if all(node.identification != other.identification for other in self.positions.values()):
+                self.positions[vid] = node
 
     def send(self, address, msg):
-        """ Send msg to address. """
-        payload = pickle.dumps(msg)
-        self.socket.sendto(payload, address)
+        """ Send msg to address, the virtual node of a process when it has a third item. """
+        for payload in encode(msg, *address[2:]):
+            self.socket.sendto(payload, address[:2])
+
+    @property
+    def route(self):
+        """Range of the ring owned by this node, sent to clients so they can reach it directly."""
+        return {"id": self.identification, "addr": self.addr, "predecessor": self.predecessor_id,
+                "replicas": self.replica_addrs}
+
+    @property
+    def replica_addrs(self):
+        """Addresses of the successors keeping the replicas of the keys of this node, one per process."""
+        own = {node.identification for node in self.primary.positions.values()}
+        hosts, addrs = {self.addr[:2]}, []
+        for node_id, addr in [(self.successor_id, self.successor_addr)] + self.successor_list[1:]:
+            if addr is not None and node_id not in own and addr[:2] not in hosts:
+                hosts.add(addr[:2])
+                addrs.append(addr)
+        return addrs[:self.replication - 1]
+
+    def replicate(self, items):
+        """Send copies of (key, value) items owned by this node to its replicas."""
+        for addr in self.replica_addrs:
+            self.send(addr, {"method": "REPLICATE", "args": {"items": items}})
+
+    def successors(self, args):
+        """Process SUCCESSORS_REP message.
+            Rebuilds the successor list from the one of our successor, long enough
+            to reach replication processes other than ours.
 
-    def recv(self):
-        """ Retrieve msg payload and from address."""
+        Parameters:
+            args (dict): successor list of our successor
+        """
+        nodes = [(self.successor_id, self.successor_addr)]
+        hosts = {self.successor_addr[:2]} - {self.addr[:2]}
+        for node_id, node_addr in args["successors"]:
+            if len(hosts) >= self.replication:
+                break
+            if node_id != self.identification and all(node_id != other for other, _ in nodes):
+                nodes.append((node_id, node_addr))
+                hosts.add(node_addr[:2])
+                hosts.discard(self.addr[:2])
+        self.successor_list = nodes
+
+    def successor_failed(self):
+        """Replace a successor that stopped answering by the next node of the successor list.
+
+        The other positions of its process are dropped too, they failed with it.
+        """
+        self.unanswered = 0
+        host = self.successor_addr[:2]
+        dead = [node for node in self.successor_list if node[0] == self.successor_id or node[1][:2] == host]
+        alive = [node for node in self.successor_list if node not in dead]
+        if not alive:
+            return
+        self.logger.info("Successor %s failed, now %s", self.successor_id, alive[0][0])
+        self.successor_id, self.successor_addr = alive[0]
+        self.successor_list = alive
+        for node_id, _ in dead:
+            self.finger_table.replace(node_id, self.successor_id, self.successor_addr)
+
+    def promote(self):
+        """Take over the replicas of the keys that are now in our range, after a predecessor failed."""
+        items = [(key, value) for key, value in self.replicas.items()
+                 if contains(self.predecessor_id, self.identification, dht_hash(key))]
+        for key, value in items:
+            del self.replicas[key]
+            self.keystore[key] = value
+        if items:
+            self.replicate(items)
+
+    def recv(self, timeout):
+        """ Retrieve msg payload and from address, waiting at most timeout seconds."""
+        self.socket.settimeout(max(timeout, 0.001))
         try:
-            payload, addr = self.socket.recvfrom(1024)
+            payload, addr = self.socket.recvfrom(DATAGRAM)
         except socket.timeout:
             return None, None
 
@@ -107,6 +214,14 @@ class DHTNode(threading.Thread):
             return None, addr
         return payload, addr
 
+    def decode(self, payload, addr):
+        """ Decode a datagram, None while a fragmented message is incomplete or if it is not valid."""
+        try:
+            return self.reassembler.decode(payload, addr)
+        except DHTProtoBadFormat as e:
+            self.logger.warning("Invalid datagram from %s: %s", addr, e)
+            return None
+
     def node_join(self, args):
         """Process JOIN_REQ message.
 
@@ -117,7 +232,9 @@ class DHTNode(threading.Thread):
         self.logger.debug("Node join: %s", args)
         addr = args["addr"]
         identification = args["id"]
-        if self.identification == self.successor_id:  # I'm the only node in the DHT
+        if identification == self.successor_id and addr != self.successor_addr:
+            self.logger.warning("Node %s at %s has the id of %s, not joined", identification, addr, self.successor_addr)
+        elif self.identification == self.successor_id:  # I'm the only node in the DHT
             self.successor_id = identification
             self.successor_addr = addr
             #TODO update finger table
@@ -163,9 +280,12 @@ class DHTNode(threading.Thread):
         self.logger.debug("Notify: %s", args)
         if self.predecessor_id is None or contains(
             self.predecessor_id, self.identification, args["predecessor_id"]
-        ):
+        ) or self.predecessor_silent > self.FAILURES:
             self.predecessor_id = args["predecessor_id"]
             self.predecessor_addr = args["predecessor_addr"]
+            self.promote()
+        if args["predecessor_id"] == self.predecessor_id:
+            self.predecessor_silent = 0
         self.logger.info(self)
 
     def stabilize(self, from_id, addr):
@@ -173,8 +293,8 @@ class DHTNode(threading.Thread):
             Updates all successor pointers.
 
         Parameters:
-            from_id: id of the predecessor of node with address addr
-            addr: address of the node sending stabilize message
+            from_id: id of the predecessor of our successor
+            addr: address of the predecessor of our successor
         """
 
         self.logger.debug("Stabilize: %s %s", from_id, addr)
@@ -194,110 +314,252 @@ class DHTNode(threading.Thread):
         for i in range(len(finger_table2)):
             self.send(self.finger_table.find(finger_table2[i][1]), {"method": "SUCCESSOR", "args": {"id": finger_table2[i][1], "from": self.addr}})
 
-    def put(self, key, value, address):
+        if self.replication > 1:
+            # The successor list of our successor gives the nodes keeping our replicas
+            self.send(self.successor_addr, {"method": "SUCCESSORS", "args": {"from": self.addr}})
+
+    def next_hop(self, key_hash):
+        """Address where a request for key_hash must be forwarded, or None if this node owns it."""
+        if self.successor_id == self.identification:  # alone in the ring
+            return None
+        if contains(self.identification, self.successor_id, key_hash):
+            return self.successor_addr
+        if self.predecessor_id is not None and contains(self.predecessor_id, self.identification, key_hash):
+            return None
+        return self.finger_table.find(key_hash)
+
+    def put(self, key, value, address, rid=None):
         """Store value in DHT.
 
         Parameters:
         key: key of the data
         value: data to be stored
         address: address where to send ack/nack
+        rid: id of the client request, echoed in the answer
         """
 
         key_hash = dht_hash(key) # node atual
         self.logger.debug("Put: %s %s", key, key_hash)
 
-        if contains(self.identification, self.successor_id, key_hash):
-            self.send(self.successor_addr, {"method": "PUT", "args": {"key": key, "value": value, "from": address}})
-        elif contains(self.predecessor_id, self.identification, key_hash):
-            if key not in self.keystore:
-                self.keystore[key] = value
-                self.send(address, {"method": "ACK"})
-            else:
-                self.send(address, {"method": "NACK"})
+        hop = self.next_hop(key_hash)
+        if hop is not None:
+            self.send(hop, {"method": "PUT", "args": {"key": key, "value": value, "from": address, "rid": rid}})
+        elif key not in self.keystore:
+            self.keystore[key] = value
+            self.replicate([(key, value)])
+            self.send(address, {"method": "ACK", "rid": rid, "node": self.route})
         else:
-            self.send(self.finger_table.find(key_hash), {"method": "PUT", "args": {"key": key, "value": value, "from": address}})
-    
+            self.send(address, {"method": "NACK", "rid": rid, "node": self.route})
+
 
-    def get(self, key, address):
+    def get(self, key, address, rid=None, replica=False):
         """Retrieve value from DHT.
 
         Parameters:
         key: key of the data
         address: address where to send ack/nack
+        rid: id of the client request, echoed in the answer
+        replica: answer from the replicas kept by this node, if it has the key
         """
         key_hash = dht_hash(key)
         self.logger.debug("Get: %s %s", key, key_hash)
 
-        if contains(self.identification, self.successor_id, key_hash):
-            self.send(self.successor_addr, {"method": "GET", "args": {"key": key, "from": address}})
-        elif contains(self.predecessor_id, self.identification, key_hash):
-            if key in self.keystore:
-                self.send(address, {"method": "ACK", "args": self.keystore[key]})
-            else:
-                self.send(address, {"method": "NACK"})
+        hop = self.next_hop(key_hash)
+        if hop is not None and replica and key in self.replicas:
+            self.send(address, {"method": "ACK", "args": self.replicas[key], "rid": rid, "node": self.route})
+        elif hop is not None:
+            self.send(hop, {"method": "GET", "args": {"key": key, "from": address, "rid": rid}})
+        elif key in self.keystore:
+            self.send(address, {"method": "ACK", "args": self.keystore[key], "rid": rid, "node": self.route})
         else:
-            self.send(self.finger_table.find(key_hash), {"method": "GET", "args": {"key": key, "from": address}})
+            self.send(address, {"method": "NACK", "rid": rid, "node": self.route})
+
+    def put_many(self, items, address, rid):
+        """Store several values in DHT.
 
+        The keys owned by this node are stored and answered in one MPUT_REP,
+        the others are forwarded in one MPUT per next hop.
+
+        Parameters:
+        items: list of (key, value)
+        address: address where to send the answers
+        rid: id of the client request, echoed in the answers
+        """
+        self.logger.debug("Put many: %d keys", len(items))
+        stored, exists, hops = [], [], {}
+        for key, value in items:
+            hop = self.next_hop(dht_hash(key))
+            if hop is not None:
+                hops.setdefault(hop, []).append((key, value))
+            elif key not in self.keystore:
+                self.keystore[key] = value
+                stored.append((key, value))
+            else:
+                exists.append(key)
+        for hop, group in hops.items():
+            self.send(hop, {"method": "MPUT", "args": {"items": group, "from": address, "rid": rid}})
+        if stored:
+            self.replicate(stored)
+        if stored or exists:
+            args = {"stored": [key for key, _ in stored], "exists": exists}
+            self.send(address, {"method": "MPUT_REP", "args": args, "rid": rid, "node": self.route})
+
+    def get_many(self, keys, address, rid, replica=False):
+        """Retrieve several values from DHT.
+
+        The keys owned by this node, or replicated in it if replica is set,
+        are answered in one MGET_REP, the others are forwarded in one MGET
+        per next hop.
+
+        Parameters:
+        keys: list of keys
+        address: address where to send the answers
+        rid: id of the client request, echoed in the answers
+        replica: answer from the replicas kept by this node
+        """
+        self.logger.debug("Get many: %d keys", len(keys))
+        found, missing, hops = {}, [], {}
+        for key in keys:
+            hop = self.next_hop(dht_hash(key))
+            if hop is not None and replica and key in self.replicas:
+                found[key] = self.replicas[key]
+            elif hop is not None:
+                hops.setdefault(hop, []).append(key)
+            elif key in self.keystore:
+                found[key] = self.keystore[key]
+            else:
+                missing.append(key)
+        for hop, group in hops.items():
+            self.send(hop, {"method": "MGET", "args": {"keys": group, "from": address, "rid": rid}})
+        if found or missing:
+            args = {"found": found, "missing": missing}
+            self.send(address, {"method": "MGET_REP", "args": args, "rid": rid, "node": self.route})
+
+    def joined(self, args):
+        """Process JOIN_REP message.
+
+        Parameters:
+            args (dict): id and addr of our successor
+        """
+        self.successor_id = args["successor_id"]
+        self.successor_addr = args["successor_addr"]
+        #TODO fill finger table
+        self.finger_table.fill(self.successor_id, self.successor_addr)
+        self.inside_dht = True
+        self.logger.info(self)
+
+    def join_next(self):
+        """Ask to join the DHT for the next position of this process outside of it, one at a time."""
+        for node in self.positions.values():
+            if not node.inside_dht:
+                args = {"addr": node.addr, "id": node.identification}
+                node.send(node.dht_address, {"method": "JOIN_REQ", "args": args})
+                return
+
+    def tick(self):
+        """Run a round of the stabilize algorithm."""
+        self.unanswered += 1
+        self.predecessor_silent += 1
+        if self.unanswered > self.FAILURES:
+            self.successor_failed()
+        # Ask successor for predecessor, to start the stabilize process
+        self.send(self.successor_addr, {"method": "PREDECESSOR", "args": {"from": self.addr}})
+
+    def handle(self, output, addr):
+        """Process a message received by this position of the ring.
+
+        Parameters:
+            output (dict): the message
+            addr: address of the socket that sent it
+        """
+        if output["method"] == "JOIN_REQ":
+            self.node_join(output["args"])
+        elif output["method"] == "NOTIFY":
+            self.notify(output["args"])
+        elif output["method"] == "PUT":
+            self.put(
+                output["args"]["key"],
+                output["args"]["value"],
+                output["args"].get("from", addr),
+                output["args"].get("rid"),
+            )
+        elif output["method"] == "GET":
+            self.get(output["args"]["key"], output["args"].get("from", addr), output["args"].get("rid"),
+                     output["args"].get("replica", False))
+        elif output["method"] == "MPUT":
+            self.put_many(output["args"]["items"], output["args"].get("from", addr), output["args"].get("rid"))
+        elif output["method"] == "MGET":
+            self.get_many(output["args"]["keys"], output["args"].get("from", addr), output["args"].get("rid"),
+                          output["args"].get("replica", False))
+        elif output["method"] == "REPLICATE":
+            self.replicas.update(output["args"]["items"])
+        elif output["method"] == "SUCCESSORS":
+            # Reply with our successor list
+            successors = self.successor_list or [(self.successor_id, self.successor_addr)]
+            self.send(output.get("args", {}).get("from", addr),
+                      {"method": "SUCCESSORS_REP", "args": {"successors": successors}})
+        elif output["method"] == "SUCCESSORS_REP":
+            self.successors(output["args"])
+        elif output["method"] == "PREDECESSOR":
+            # Reply with predecessor id and address
+            args = {"predecessor_id": self.predecessor_id, "predecessor_addr": self.predecessor_addr}
+            if self.predecessor_silent > self.FAILURES:
+                # Our predecessor seems dead: the node asking keeps us as successor and notifies us
+                args = {"predecessor_id": None}
+            self.send(output.get("args", {}).get("from", addr), {"method": "STABILIZE", "args": args})
+        elif output["method"] == "SUCCESSOR":
+            # Reply with successor of id
+            self.get_successor(output["args"])
+        elif output["method"] == "STABILIZE":
+            # Initiate stabilize protocol, the successor is alive
+            self.unanswered = 0
+            self.stabilize(output["args"]["predecessor_id"], output["args"].get("predecessor_addr"))
+        elif output["method"] == "SUCCESSOR_REP":
+            #TODO Implement processing of SUCCESSOR_REP
+            idx = self.finger_table.getIdxFromId(output["args"]["req_id"])
+            if idx is not None:
+                self.finger_table.update(idx, output["args"]["id"], output["args"]["addr"])
 
     def run(self):
         self.socket.bind(self.addr)
 
-        # Loop untiln joining the DHT
-        while not self.inside_dht:
-            join_msg = {
-                "method": "JOIN_REQ",
-                "args": {"addr": self.addr, "id": self.identification},
-            }
-            self.send(self.dht_address, join_msg)
-            payload, addr = self.recv()
-            if payload is not None:
-                output = pickle.loads(payload)
-                self.logger.debug("O: %s", output)
-                if output["method"] == "JOIN_REP":
-                    args = output["args"]
-                    self.successor_id = args["successor_id"]
-                    self.successor_addr = args["successor_addr"]
-                    #TODO fill finger table
-                    self.finger_table.fill(self.successor_id, self.successor_addr)
-                    self.inside_dht = True
-                    self.logger.info(self)
-
+        # Every position of this process reads from its socket, so a single loop serves them all
+        self.join_next()
+        deadline = time.monotonic() + self.timeout
         while not self.done:
-            payload, addr = self.recv()
+            payload, addr = self.recv(deadline - time.monotonic())
             if payload is not None:
-                output = pickle.loads(payload)
+                output = self.decode(payload, addr)
                 self.logger.info("O: %s", output)
-                if output["method"] == "JOIN_REQ":
-                    self.node_join(output["args"])
-                elif output["method"] == "NOTIFY":
-                    self.notify(output["args"])
-                elif output["method"] == "PUT":
-                    self.put(
-                        output["args"]["key"],
-                        output["args"]["value"],
-                        output["args"].get("from", addr),
-                    )
-                elif output["method"] == "GET":
-                    self.get(output["args"]["key"], output["args"].get("from", addr))
-                elif output["method"] == "PREDECESSOR":
-                    # Reply with predecessor id
-                    self.send(
-                        addr, {"method": "STABILIZE", "args": self.predecessor_id}
-                    )
-                elif output["method"] == "SUCCESSOR":
-                    # Reply with successor of id
-                    self.get_successor(output["args"])
-                elif output["method"] == "STABILIZE":
-                    # Initiate stabilize protocol
-                    self.stabilize(output["args"], addr)
-                elif output["method"] == "SUCCESSOR_REP":
-                    #TODO Implement processing of SUCCESSOR_REP
-                    idx = self.finger_table.getIdxFromId(output["args"]["req_id"])
-                    if idx is not None:
-                        self.finger_table.update(idx, output["args"]["id"], output["args"]["addr"])
-            else:  # timeout occurred, lets run the stabilize algorithm
-                # Ask successor for predecessor, to start the stabilize process
-                self.send(self.successor_addr, {"method": "PREDECESSOR"})
+                node = None if output is None else self.positions.get(output.get("vnode", 0))
+                try:
+                    if node is None:
+                        pass
+                    elif node.inside_dht:
+                        node.handle(output, addr)
+                    elif output["method"] == "JOIN_REP":
+                        node.joined(output["args"])
+                        self.join_next()
+                except Exception:  # a well formed message with unusable args must not stop the node
+                    self.logger.exception("Failed to process %s from %s", output["method"], addr)
+            if time.monotonic() >= deadline:  # the stabilize algorithm runs every timeout seconds
+                deadline = time.monotonic() + self.timeout
+                self.keystore.sync()
+                self.replicas.sync()
+                for node in self.positions.values():
+                    if node.inside_dht:
+                        node.tick()
+                self.join_next()
+        self.keystore.close()
+        self.replicas.close()
+
+    @property
+    def share(self):
+        """Fraction of the ring owned by this position, None while its predecessor is unknown."""
+        if self.predecessor_id is None:
+            return None
+        size = 2 ** self.finger_table.m_bits
+        return ((self.identification - self.predecessor_id) % size or size) / size
 
     def __str__(self):
         return "Node ID: {}; DHT: {}; Successor: {}; Predecessor: {}; FingerTable: {}".format(
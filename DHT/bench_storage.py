@@ -0,0 +1,78 @@
+"""Restart benchmark of the log storage engine of the nodes.
+
+Writes many keys to a LogStore, closes it and measures how long reopening
+takes, which is what a restarted node pays to rebuild its index from the
+log instead of fetching its keys again from its peers. Reads, overwrites
+and a compaction of the log are timed too.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from storage import LogStore
+
+
+def timed(function):
+    """Seconds taken by function() and its result."""
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def fill(store, keys, value):
+    for i in range(keys):
+        store[f"key{i}"] = value
+
+
+def read(store, keys):
+    for i in range(keys):
+        store[f"key{i}"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--keys", type=int, default=100000)
+    parser.add_argument("--value-size", type=int, default=100, help="bytes of every value")
+    parser.add_argument("--sync-every", type=int, default=1000, help="writes between fsyncs")
+    parser.add_argument("--dir", help="directory of the log, a temporary one by default")
+    parser.add_argument("--json", default=False, action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        path = os.path.join(directory, "bench.log")
+        value = "x" * args.value_size
+        # compaction is triggered by hand below, so that the writes are timed alone
+        store = LogStore(path, sync_every=args.sync_every, compact_min=1 << 62)
+        write_time, _ = timed(lambda: fill(store, args.keys, value))
+        store.close()
+        size = os.path.getsize(path)
+
+        reopen_time, store = timed(lambda: LogStore(path, sync_every=args.sync_every, compact_min=1 << 62))
+        read_time, _ = timed(lambda: read(store, args.keys))
+        fill(store, args.keys, value)  # every key overwritten once, half of the log is garbage
+        compact_time, _ = timed(store.compact)
+        store.close()
+
+    report = {
+        "keys": args.keys,
+        "log_mb": size / 2**20,
+        "writes_per_s": args.keys / write_time,
+        "restart_s": reopen_time,
+        "restart_keys_per_s": args.keys / reopen_time,
+        "reads_per_s": args.keys / read_time,
+        "compact_s": compact_time,
+    }
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print(f"keys            {report['keys']} of {args.value_size} bytes, log of {report['log_mb']:.1f} MiB")
+        print(f"writes          {report['writes_per_s']:.0f} keys/s")
+        print(f"restart         {report['restart_s'] * 1000:.0f} ms ({report['restart_keys_per_s']:.0f} keys/s)")
+        print(f"reads           {report['reads_per_s']:.0f} keys/s")
+        print(f"compaction      {report['compact_s'] * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,505 @@
+""" Binary codec of the messages exchanged by DHT nodes and clients.
+
+Every datagram starts with the codec version, a one byte opcode and a byte of
+flags telling which of the virtual node it is for, request id, routing info and
+args follow. Node ids are fixed-width 16 bit integers, addresses a
+length-prefixed host, a 16 bit port and the byte of a virtual node, 0 for the
+primary node of a process, and stored values are tagged so that None, bool, int, float, str, bytes,
+list, tuple and dict round-trip. Messages that do not fit in a datagram are
+split in FRAGMENT datagrams and rebuilt by a Reassembler.
+"""
+import itertools
+import struct
+import time
+from collections import namedtuple
+from utils import DATAGRAM
+
+
+VERSION = 3
+
+METHODS = (
+    "JOIN_REQ", "JOIN_REP", "NOTIFY", "PUT", "GET", "MPUT", "MGET", "PREDECESSOR", "STABILIZE",
+    "SUCCESSOR", "SUCCESSOR_REP", "ACK", "NACK", "MPUT_REP", "MGET_REP", "REPLICATE", "SUCCESSORS",
+    "SUCCESSORS_REP",
+)
+OPCODES = {method: opcode for opcode, method in enumerate(METHODS, 1)}
+FRAGMENT = 0xFF
+MAX_DEPTH = 32  # nesting of the lists, tuples and dicts of a stored value
+
+# flags
+RID = 1
+NODE = 2
+ARGS = 4
+VNODE = 8
+
+NO_ID = 0xFFFF  # id of an unknown node, e.g. a missing predecessor
+
+HEADER = struct.Struct(">BBB")  # version, opcode, flags
+FRAGMENT_HEADER = struct.Struct(">BBIHH")  # version, FRAGMENT, message id, index, count
+FRAGMENT_SIZE = DATAGRAM - FRAGMENT_HEADER.size
+U16 = struct.Struct(">H")
+U32 = struct.Struct(">I")
+I32 = struct.Struct(">i")
+I64 = struct.Struct(">q")
+F64 = struct.Struct(">d")
+
+Codec = namedtuple("Codec", "put get")
+Field = namedtuple("Field", "name codec optional")
+
+
+class DHTProtoBadFormat(ValueError):
+    """ Datagram that is not a valid DHT message."""
+
+
+def put_id(out, value):
+    out += U16.pack(NO_ID if value is None else value)
+
+
+def get_id(data, pos):
+    value = U16.unpack_from(data, pos)[0]
+    return (None if value == NO_ID else value), pos + 2
+
+
+def put_u32(out, value):
+    out += U32.pack(value)
+
+
+def get_u32(data, pos):
+    return U32.unpack_from(data, pos)[0], pos + 4
+
+
+# a ring has few nodes, so their encoded addresses are kept instead of being rebuilt for every message
+encoded_addrs = {}
+decoded_addrs = {}
+
+
+def put_addr(out, addr):
+    raw = encoded_addrs.get(addr)
+    if raw is None:
+        host = addr[0].encode("utf-8")
+        raw = bytes([len(host)]) + host + U16.pack(addr[1]) + bytes([addr[2] if len(addr) > 2 else 0])
+        if len(encoded_addrs) < 4096:
+            encoded_addrs[addr] = raw
+    out += raw
+
+
+def get_addr(data, pos):
+    end = pos + 4 + data[pos]
+    raw = data[pos:end]
+    addr = decoded_addrs.get(raw)
+    if addr is None:
+        if end > len(data):
+            raise DHTProtoBadFormat("truncated address")
+        addr = (raw[1:-3].decode("utf-8"), U16.unpack_from(raw, len(raw) - 3)[0])
+        if raw[-1]:
+            addr += (raw[-1],)
+        if len(decoded_addrs) < 4096:
+            decoded_addrs[raw] = addr
+    return addr, end
+
+
+def put_str(out, text):
+    raw = text.encode("utf-8")
+    out += U16.pack(len(raw))
+    out += raw
+
+
+def get_str(data, pos):
+    end = pos + 2 + U16.unpack_from(data, pos)[0]
+    if end > len(data):
+        raise DHTProtoBadFormat("truncated string")
+    return data[pos + 2:end].decode("utf-8"), end
+
+
+def put_value(out, value):
+    """ Append a tagged value."""
+    kind = type(value)
+    if kind is str:
+        raw = value.encode("utf-8")
+        out += b"s"
+        out += U32.pack(len(raw))
+        out += raw
+    elif value is None:
+        out += b"N"
+    elif kind is bool:
+        out += b"T" if value else b"F"
+    elif kind is int:
+        if -2**31 <= value < 2**31:
+            out += b"i"
+            out += I32.pack(value)
+        elif -2**63 <= value < 2**63:
+            out += b"q"
+            out += I64.pack(value)
+        else:
+            raw = value.to_bytes(value.bit_length() // 8 + 1, "big", signed=True)
+            out += b"I"
+            out += U32.pack(len(raw))
+            out += raw
+    elif kind is float:
+        out += b"d"
+        out += F64.pack(value)
+    elif kind is bytes or kind is bytearray:
+        out += b"b"
+        out += U32.pack(len(value))
+        out += value
+    elif kind is list or kind is tuple:
+        out += b"l" if kind is list else b"t"
+        out += U32.pack(len(value))
+        for item in value:
+            put_value(out, item)
+    elif kind is dict:
+        out += b"m"
+        out += U32.pack(len(value))
+        for key, item in value.items():
+            put_value(out, key)
+            put_value(out, item)
+    else:
+        raise TypeError(f"cannot encode values of type {kind.__name__}")
+
+
+def get_value(data, pos, depth=0):
+    """ Read a tagged value."""
+    tag = data[pos]
+    pos += 1
+    if tag == 0x73:  # s
+        end = pos + 4 + U32.unpack_from(data, pos)[0]
+        if end > len(data):
+            raise DHTProtoBadFormat("truncated value")
+        return str(data[pos + 4:end], "utf-8"), end
+    if tag == 0x4E:  # N
+        return None, pos
+    if tag == 0x54:  # T
+        return True, pos
+    if tag == 0x46:  # F
+        return False, pos
+    if tag == 0x69:  # i
+        return I32.unpack_from(data, pos)[0], pos + 4
+    if tag == 0x71:  # q
+        return I64.unpack_from(data, pos)[0], pos + 8
+    if tag == 0x49:  # I
+        end = pos + 4 + U32.unpack_from(data, pos)[0]
+        if end > len(data):
+            raise DHTProtoBadFormat("truncated value")
+        return int.from_bytes(data[pos + 4:end], "big", signed=True), end
+    if tag == 0x64:  # d
+        return F64.unpack_from(data, pos)[0], pos + 8
+    if tag == 0x62:  # b
+        end = pos + 4 + U32.unpack_from(data, pos)[0]
+        if end > len(data):
+            raise DHTProtoBadFormat("truncated value")
+        return bytes(data[pos + 4:end]), end
+    if (tag == 0x6C or tag == 0x74 or tag == 0x6D) and depth >= MAX_DEPTH:
+        raise DHTProtoBadFormat("value nested too deep")
+    if tag == 0x6C or tag == 0x74:  # l, t
+        count, pos = get_u32(data, pos)
+        items = []
+        for _ in range(count):
+            item, pos = get_value(data, pos, depth + 1)
+            items.append(item)
+        return (items if tag == 0x6C else tuple(items)), pos
+    if tag == 0x6D:  # m
+        count, pos = get_u32(data, pos)
+        mapping = {}
+        for _ in range(count):
+            key, pos = get_value(data, pos, depth + 1)
+            mapping[key], pos = get_value(data, pos, depth + 1)  # TypeError if key is a list or a dict
+        return mapping, pos
+    raise DHTProtoBadFormat(f"unknown value tag {tag}")
+
+
+def put_keys(out, keys):
+    out += U32.pack(len(keys))
+    for key in keys:
+        put_str(out, key)
+
+
+def get_keys(data, pos):
+    count, pos = get_u32(data, pos)
+    keys = []
+    for _ in range(count):
+        key, pos = get_str(data, pos)
+        keys.append(key)
+    return keys, pos
+
+
+def put_items(out, items):
+    out += U32.pack(len(items))
+    for key, value in items:
+        raw = key.encode("utf-8")
+        out += U16.pack(len(raw))
+        out += raw
+        put_value(out, value)
+
+
+def get_items(data, pos):
+    count, pos = get_u32(data, pos)
+    items = []
+    for _ in range(count):
+        end = pos + 2 + U16.unpack_from(data, pos)[0]
+        key = data[pos + 2:end].decode("utf-8")
+        value, pos = get_value(data, end)
+        items.append((key, value))
+    return items, pos
+
+
+def put_flag(out, value):
+    pass  # an optional field that is present is set
+
+
+def get_flag(data, pos):
+    return True, pos
+
+
+def put_addrs(out, addrs):
+    out.append(len(addrs))
+    for addr in addrs:
+        put_addr(out, addr)
+
+
+def get_addrs(data, pos):
+    count = data[pos]
+    pos += 1
+    addrs = []
+    for _ in range(count):
+        addr, pos = get_addr(data, pos)
+        addrs.append(addr)
+    return addrs, pos
+
+
+def put_nodes(out, nodes):
+    out.append(len(nodes))
+    for node_id, node_addr in nodes:
+        put_id(out, node_id)
+        put_addr(out, node_addr)
+
+
+def get_nodes(data, pos):
+    count = data[pos]
+    pos += 1
+    nodes = []
+    for _ in range(count):
+        node_id, pos = get_id(data, pos)
+        node_addr, pos = get_addr(data, pos)
+        nodes.append((node_id, node_addr))
+    return nodes, pos
+
+
+def put_found(out, found):
+    put_items(out, found.items())
+
+
+def get_found(data, pos):
+    items, pos = get_items(data, pos)
+    return dict(items), pos
+
+
+ID = Codec(put_id, get_id)
+U32_CODEC = Codec(put_u32, get_u32)
+ADDR = Codec(put_addr, get_addr)
+STR = Codec(put_str, get_str)
+VALUE = Codec(put_value, get_value)
+KEYS = Codec(put_keys, get_keys)
+ITEMS = Codec(put_items, get_items)
+FOUND = Codec(put_found, get_found)
+FLAG = Codec(put_flag, get_flag)
+NODES = Codec(put_nodes, get_nodes)
+
+# args of each method: a tuple of fields when they are a dict, a single codec otherwise
+SCHEMAS = {
+    "JOIN_REQ": (Field("addr", ADDR, False), Field("id", ID, False)),
+    "JOIN_REP": (Field("successor_id", ID, False), Field("successor_addr", ADDR, False)),
+    "NOTIFY": (Field("predecessor_id", ID, False), Field("predecessor_addr", ADDR, False)),
+    "PUT": (Field("key", STR, False), Field("value", VALUE, False),
+            Field("from", ADDR, True), Field("rid", U32_CODEC, True)),
+    "GET": (Field("key", STR, False), Field("from", ADDR, True), Field("rid", U32_CODEC, True),
+            Field("replica", FLAG, True)),
+    "MPUT": (Field("items", ITEMS, False), Field("from", ADDR, True), Field("rid", U32_CODEC, True)),
+    "MGET": (Field("keys", KEYS, False), Field("from", ADDR, True), Field("rid", U32_CODEC, True),
+             Field("replica", FLAG, True)),
+    "STABILIZE": (Field("predecessor_id", ID, False), Field("predecessor_addr", ADDR, True)),
+    "PREDECESSOR": (Field("from", ADDR, True),),
+    "SUCCESSOR": (Field("id", ID, False), Field("from", ADDR, False)),
+    "SUCCESSOR_REP": (Field("req_id", ID, False), Field("id", ID, False), Field("addr", ADDR, False)),
+    "ACK": VALUE,
+    "MPUT_REP": (Field("stored", KEYS, False), Field("exists", KEYS, False)),
+    "MGET_REP": (Field("found", FOUND, False), Field("missing", KEYS, False)),
+    "REPLICATE": (Field("items", ITEMS, False),),
+    "SUCCESSORS": (Field("from", ADDR, True),),
+    "SUCCESSORS_REP": (Field("successors", NODES, False),),
+}
+
+# methods that cannot be sent without args
+REQUIRED = {method for method, schema in SCHEMAS.items()
+            if not isinstance(schema, Codec) and not all(field.optional for field in schema)}
+
+message_ids = itertools.count(1)  # ids of the fragmented messages sent by this process
+
+
+def encode(msg, vnode=0):
+    """ Serialize a message dict into the datagrams that carry it to a virtual node of a process."""
+    method = msg["method"]
+    flags = 0
+    out = bytearray(HEADER.size)
+    if vnode:
+        flags |= VNODE
+        out.append(vnode)
+    rid = msg.get("rid")
+    if rid is not None:
+        flags |= RID
+        out += U32.pack(rid)
+    node = msg.get("node")
+    if node is not None:
+        flags |= NODE
+        put_id(out, node["id"])
+        put_addr(out, node["addr"])
+        put_id(out, node["predecessor"])
+        put_addrs(out, node.get("replicas", ()))
+    if "args" in msg:
+        flags |= ARGS
+        schema = SCHEMAS[method]
+        args = msg["args"]
+        if isinstance(schema, Codec):
+            schema.put(out, args)
+        else:
+            for name, (put, _), optional in schema:
+                if optional:
+                    value = args.get(name)
+                    if value is None or value is False:
+                        out.append(0)
+                        continue
+                    out.append(1)
+                    put(out, value)
+                else:
+                    put(out, args[name])
+    HEADER.pack_into(out, 0, VERSION, OPCODES[method], flags)
+    if len(out) <= DATAGRAM:
+        return [bytes(out)]
+
+    # the message is split in fragments, rebuilt by the receiver
+    message_id = next(message_ids) & 0xFFFFFFFF
+    count = -(-len(out) // FRAGMENT_SIZE)
+    if count > 0xFFFF:
+        raise ValueError("message too large")
+    return [
+        FRAGMENT_HEADER.pack(VERSION, FRAGMENT, message_id, index, count)
+        + out[index * FRAGMENT_SIZE:(index + 1) * FRAGMENT_SIZE]
+        for index in range(count)
+    ]
+
+
+def decode(data):
+    """ Deserialize a complete message into a message dict.
+
+    Raises DHTProtoBadFormat if data is not a valid message.
+    """
+    try:
+        version, opcode, flags = HEADER.unpack_from(data, 0)
+        if version != VERSION:
+            raise DHTProtoBadFormat(f"unsupported version {version}")
+        method = METHODS[opcode - 1] if 0 < opcode <= len(METHODS) else None
+        if method is None:
+            raise DHTProtoBadFormat(f"unknown opcode {opcode}")
+        msg = {"method": method}
+        pos = HEADER.size
+        if flags & VNODE:
+            msg["vnode"] = data[pos]
+            pos += 1
+        if flags & RID:
+            msg["rid"], pos = get_u32(data, pos)
+        if flags & NODE:
+            node_id, pos = get_id(data, pos)
+            node_addr, pos = get_addr(data, pos)
+            predecessor, pos = get_id(data, pos)
+            replicas, pos = get_addrs(data, pos)
+            msg["node"] = {"id": node_id, "addr": node_addr, "predecessor": predecessor, "replicas": replicas}
+        if flags & ARGS:
+            schema = SCHEMAS[method]
+            if isinstance(schema, Codec):
+                msg["args"], pos = schema.get(data, pos)
+            else:
+                args = msg["args"] = {}
+                for name, (_, get), optional in schema:
+                    if optional:
+                        present = data[pos]
+                        pos += 1
+                        if not present:
+                            continue
+                    args[name], pos = get(data, pos)
+        elif method in REQUIRED:
+            raise DHTProtoBadFormat(f"{method} without args")
+    except (struct.error, IndexError, KeyError, TypeError, UnicodeDecodeError) as e:
+        raise DHTProtoBadFormat(str(e)) from e
+    if pos != len(data):
+        raise DHTProtoBadFormat("trailing bytes")
+    return msg
+
+
+class Reassembler:
+    """ Decoder of the datagrams received by a socket, rebuilding fragmented messages."""
+
+    def __init__(self, timeout=10, max_messages=16, max_bytes=1 << 26):
+        """ Initialize the reassembler.
+
+        Parameters:
+            timeout: seconds to keep the fragments of an incomplete message
+            max_messages: incomplete messages kept for each sender
+            max_bytes: bytes of the incomplete messages kept for each sender
+        """
+        self.timeout = timeout
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.partial = {}  # (address, message id) -> [deadline, fragments, bytes]
+        self.senders = {}  # address -> [incomplete messages, their bytes]
+
+    def decode(self, payload, addr):
+        """ Message carried by a datagram, or None while the fragments of its message are missing.
+
+        Raises DHTProtoBadFormat if the datagram is not valid, or if its sender
+        has too many incomplete messages or bytes in them.
+        """
+        if len(payload) < 2 or payload[1] != FRAGMENT:
+            return decode(payload)
+        try:
+            version, _, message_id, index, count = FRAGMENT_HEADER.unpack_from(payload, 0)
+        except struct.error as e:
+            raise DHTProtoBadFormat(str(e)) from e
+        if version != VERSION or index >= count:
+            raise DHTProtoBadFormat("invalid fragment")
+        now = time.monotonic()
+        key = (addr, message_id)
+        entry = self.partial.get(key)
+        if entry is None:
+            for other, (deadline, _, _) in list(self.partial.items()):
+                if deadline < now:
+                    self.discard(other)  # the other fragments were lost
+            usage = self.senders.setdefault(addr, [0, 0])
+            if usage[0] >= self.max_messages:
+                raise DHTProtoBadFormat("too many incomplete messages")
+            entry = self.partial[key] = [now + self.timeout, [None] * count, 0]
+            usage[0] += 1
+        fragments = entry[1]
+        if len(fragments) != count:
+            raise DHTProtoBadFormat("inconsistent fragment")
+        if fragments[index] is not None:
+            return None  # repeated datagram
+        fragment = payload[FRAGMENT_HEADER.size:]
+        usage = self.senders[addr]
+        if usage[1] + len(fragment) > self.max_bytes:
+            self.discard(key)
+            raise DHTProtoBadFormat("incomplete messages too large")
+        usage[1] += len(fragment)
+        entry[2] += len(fragment)
+        fragments[index] = fragment
+        if any(fragment is None for fragment in fragments):
+            return None
+        self.discard(key)
+        return decode(b"".join(fragments))
+
+    def discard(self, key):
+        """ Forget the fragments of an incomplete message."""
+        _, _, size = self.partial.pop(key)
+        usage = self.senders[key[0]]
+        usage[0] -= 1
+        usage[1] -= size
+        if not usage[0]:
+            del self.senders[key[0]]
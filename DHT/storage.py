@@ -0,0 +1,177 @@
+""" Storage engines for the keys kept by a DHT node."""
+import mmap
+import os
+import struct
+import zlib
+from collections.abc import MutableMapping
+from codec import put_value, get_value
+
+
+class MemoryStore(dict):
+    """ Keys kept in memory only, lost when the node stops."""
+
+    def __init__(self, name=None):
+        """ Initialize an empty store. name is ignored."""
+        super().__init__()
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class LogStore(MutableMapping):
+    """ Keys kept in an append-only log file, indexed in memory.
+
+    Every write appends a record, checksummed so that a record torn by a
+    crash is cut when the log is reopened. The index maps each key to the
+    position of its latest value, which is read back through a memory map.
+    Reopening reads the whole log once to check the crc of every record,
+    values included, but only decodes the keys to rebuild the index.
+    Overwritten and deleted records are garbage, and the log is rewritten
+    with just the live records once garbage outgrows them.
+    """
+
+    HEADER = struct.Struct(">IBHI")  # crc32 of the rest of the record, kind, key length, value length
+    PUT = 1
+    DELETE = 2
+
+    def __init__(self, path, sync_every=1000, compact_min=1 << 20):
+        """ Open the log at path, creating it if needed.
+
+        Parameters:
+            path: file of the log
+            sync_every: writes between fsyncs, the OS flushes the others on its own
+            compact_min: garbage bytes below which the log is never compacted
+        """
+        self.path = path
+        self.sync_every = sync_every
+        self.compact_min = compact_min
+        self.open()
+
+    def open(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = os.fstat(self.fd).st_size
+        self.map = None
+        self.index = {}  # key -> (offset of the value, length of the value)
+        self.live = 0  # bytes of the records in the index
+        self.pending = 0  # writes since the last fsync
+        self.recover()
+
+    def recover(self):
+        """ Rebuild the index from the log, cutting a partially written record at its end."""
+        pos = 0
+        if self.size:
+            with mmap.mmap(self.fd, self.size, prot=mmap.PROT_READ) as data, memoryview(data) as view:
+                while pos + self.HEADER.size <= self.size:
+                    crc, kind, key_length, value_length = self.HEADER.unpack_from(view, pos)
+                    start = pos + self.HEADER.size
+                    end = start + key_length + value_length
+                    if end > self.size or zlib.crc32(view[pos + 4:end]) != crc:
+                        break
+                    self.index_record(kind, str(view[start:start + key_length], "utf-8"),
+                                      start + key_length, value_length, end - pos)
+                    pos = end
+        if pos < self.size:
+            os.ftruncate(self.fd, pos)
+            self.size = pos
+
+    def index_record(self, kind, key, offset, length, size):
+        old = self.index.pop(key, None)
+        if old is not None:
+            self.live -= self.HEADER.size + len(key.encode("utf-8")) + old[1]
+        if kind == self.PUT:
+            self.index[key] = (offset, length)
+            self.live += size
+
+    @classmethod
+    def record(cls, kind, raw_key, value):
+        record = bytearray(cls.HEADER.size)
+        record += raw_key
+        record += value
+        cls.HEADER.pack_into(record, 0, 0, kind, len(raw_key), len(value))
+        struct.pack_into(">I", record, 0, zlib.crc32(memoryview(record)[4:]))
+        return record
+
+    def append(self, kind, key, value=b""):
+        raw_key = key.encode("utf-8")
+        record = self.record(kind, raw_key, value)
+        view = memoryview(record)
+        while view:
+            view = view[os.write(self.fd, view):]
+        self.index_record(kind, key, self.size + self.HEADER.size + len(raw_key), len(value), len(record))
+        self.size += len(record)
+        self.pending += 1
+        if self.pending >= self.sync_every:
+            self.sync()
+        if self.size - self.live > max(self.compact_min, self.live):
+            self.compact()
+
+    def read(self, offset, length):
+        """ Bytes [offset, offset + length) of the log, through its memory map."""
+        if self.map is None or len(self.map) < offset + length:
+            self.map = mmap.mmap(self.fd, self.size, prot=mmap.PROT_READ)
+        return memoryview(self.map)[offset:offset + length]
+
+    def __getitem__(self, key):
+        offset, length = self.index[key]
+        with self.read(offset, length) as data:
+            return get_value(data, 0)[0]
+
+    def __setitem__(self, key, value):
+        encoded = bytearray()
+        put_value(encoded, value)
+        self.append(self.PUT, key, encoded)
+
+    def __delitem__(self, key):
+        if key not in self.index:
+            raise KeyError(key)
+        self.append(self.DELETE, key)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(list(self.index))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __repr__(self):
+        return f"LogStore({self.path!r}, {len(self)} keys)"
+
+    def compact(self):
+        """ Rewrite the log with only the live records."""
+        tmp = self.path + ".compact"
+        with open(tmp, "wb") as out:
+            for key, (offset, length) in self.index.items():
+                with self.read(offset, length) as value:
+                    out.write(self.record(self.PUT, key.encode("utf-8"), value))
+            out.flush()
+            os.fsync(out.fileno())
+        self.close()
+        os.replace(tmp, self.path)
+        self.open()
+
+    def sync(self):
+        """ fsync the writes not synced yet."""
+        if self.pending:
+            os.fsync(self.fd)
+            self.pending = 0
+
+    def close(self):
+        if self.fd is not None:
+            self.sync()
+            os.close(self.fd)
+            self.fd = None
+        self.map = None
+
+
+def log_store(directory, **options):
+    """ Store factory for DHTNode keeping every store in a LogStore under directory."""
+    os.makedirs(directory, exist_ok=True)
+
+    def open_store(name):
+        return LogStore(os.path.join(directory, name + ".log"), **options)
+    return open_store
@@ -1,6 +1,7 @@
 """Tests two clients."""
 import pytest
 from DHTClient import DHTClient
+from utils import dht_hash
 
 
 @pytest.fixture()
@@ -26,3 +27,37 @@ def test_put_remote(client):
 def test_get_remote(client):
     """ retrieve from DHT (this key is not on the first node -> remote search) """
     assert client.get("2") == "xpto"
+
+
+def test_direct_routing(client):
+    """ after the first answer the client sends straight to the owner of a key """
+    assert client.put("routed", "direct")
+    assert len(client.cache) == 1
+    owner = client.cache.lookup(dht_hash("routed"))
+    assert owner is not None
+
+    client.dht_addr = ("localhost", 1)  # the bootstrap node is no longer needed
+    assert client.get("routed") == "direct"
+
+
+def test_put_many(client):
+    """ store many keys with pipelined multi-key requests """
+    items = {f"bulk{i}": i for i in range(500)}
+    assert client.put_many(items, window=8, batch=32) == dict.fromkeys(items, True)
+    # the keys already exist
+    assert client.put_many({"bulk0": 0, "bulk1": 1}) == {"bulk0": False, "bulk1": False}
+
+
+def test_get_many(client):
+    """ retrieve many keys with pipelined multi-key requests """
+    keys = [f"bulk{i}" for i in range(500)] + ["missing"]
+    values = client.get_many(keys, window=8, batch=32)
+    assert values == {**{f"bulk{i}": i for i in range(500)}, "missing": None}
+    assert len(client.cache) > 1
+
+
+def test_large_value(client):
+    """ values larger than a datagram are split in fragments """
+    value = "Aveiro" * 50000
+    assert client.put("large", value)
+    assert client.get("large") == value
@@ -0,0 +1,130 @@
+"""Tests the binary message codec."""
+import pytest
+from codec import encode, decode, Reassembler, DHTProtoBadFormat, FRAGMENT_SIZE, VERSION
+from utils import DATAGRAM
+
+
+NODE = {"id": 581, "addr": ("localhost", 4000), "predecessor": 260, "replicas": [("localhost", 5004), ("127.0.0.1", 3000)]}
+
+
+@pytest.mark.parametrize("msg", [
+    {"method": "JOIN_REQ", "args": {"addr": ("localhost", 5001), "id": 959}},
+    {"method": "JOIN_REP", "args": {"successor_id": 770, "successor_addr": ("localhost", 5000)}},
+    {"method": "NOTIFY", "args": {"predecessor_id": 0, "predecessor_addr": ("127.0.0.1", 5002)}},
+    {"method": "PUT", "args": {"key": "A", "value": [0, 1, 2]}},
+    {"method": "PUT", "args": {"key": "2", "value": "xpto", "from": ("localhost", 40000), "rid": 7}},
+    {"method": "GET", "args": {"key": "d", "rid": 2**32 - 1}},
+    {"method": "MPUT", "args": {"items": [("a", 1), ("b", None)], "from": ("localhost", 1), "rid": 3}},
+    {"method": "MGET", "args": {"keys": ["a", "b", "ção"], "rid": 4}},
+    {"method": "GET", "args": {"key": "d", "rid": 5, "replica": True}},
+    {"method": "MGET", "args": {"keys": ["a"], "from": ("localhost", 2), "rid": 6, "replica": True}},
+    {"method": "REPLICATE", "args": {"items": [("a", [1, 2]), ("b", "xpto")]}},
+    {"method": "SUCCESSORS"},
+    {"method": "SUCCESSORS_REP", "args": {"successors": [(654, ("localhost", 5004)), (752, ("localhost", 3000))]}},
+    {"method": "PREDECESSOR"},
+    {"method": "PREDECESSOR", "args": {"from": ("localhost", 5003, 2)}},
+    {"method": "STABILIZE", "args": {"predecessor_id": None}},
+    {"method": "STABILIZE", "args": {"predecessor_id": 1023, "predecessor_addr": ("localhost", 5003)}},
+    {"method": "SUCCESSOR", "args": {"id": 2, "from": ("localhost", 5003)}},
+    {"method": "SUCCESSOR_REP", "args": {"req_id": 2, "id": 257, "addr": ("localhost", 5003)}},
+    {"method": "ACK", "rid": 1, "node": NODE},
+    {"method": "ACK", "args": None, "rid": 1, "node": {**NODE, "predecessor": None, "replicas": []}},
+    {"method": "NACK", "node": NODE},
+    {"method": "MPUT_REP", "args": {"stored": ["a"], "exists": []}, "rid": 3, "node": NODE},
+    {"method": "MGET_REP", "args": {"found": {"a": 1}, "missing": ["b"]}, "rid": 4, "node": NODE},
+])
+def test_round_trip(msg):
+    datagrams = encode(msg)
+    assert len(datagrams) == 1
+    assert decode(datagrams[0]) == msg
+
+
+def test_virtual_nodes():
+    msg = {"method": "JOIN_REQ", "args": {"addr": ("localhost", 5001, 3), "id": 12}}
+    assert decode(encode(msg)[0]) == msg
+    assert decode(encode(msg, 255)[0]) == {**msg, "vnode": 255}
+    node = {**NODE, "addr": ("localhost", 4000, 1), "replicas": [("localhost", 5004, 7)]}
+    assert decode(encode({"method": "NACK", "node": node}, 1)[0]) == {"method": "NACK", "node": node, "vnode": 1}
+
+
+def test_values():
+    value = [None, True, False, 0, -1, 2**40, -2**40, 2**70, -2**70, 1.5, "Olá", b"\x00\xff", (1, (2,)), {"k": [1], 3: "v"}, []]
+    msg = {"method": "ACK", "args": value}
+    assert decode(encode(msg)[0]) == msg
+
+    with pytest.raises(TypeError):
+        encode({"method": "ACK", "args": {1, 2}})
+
+
+def test_fragments():
+    msg = {"method": "PUT", "args": {"key": "big", "value": "x" * (3 * DATAGRAM), "rid": 1}}
+    datagrams = encode(msg)
+    assert len(datagrams) == 4
+    assert all(len(datagram) <= DATAGRAM for datagram in datagrams)
+
+    reassembler = Reassembler()
+    other = encode({"method": "ACK", "args": b"y" * (2 * DATAGRAM)})
+    # fragments of different messages and senders arrive interleaved and out of order
+    assert reassembler.decode(datagrams[3], ("localhost", 1)) is None
+    assert reassembler.decode(other[1], ("localhost", 1)) is None
+    assert reassembler.decode(datagrams[0], ("localhost", 1)) is None
+    assert reassembler.decode(datagrams[1], ("localhost", 2)) is None
+    assert reassembler.decode(datagrams[2], ("localhost", 1)) is None
+    assert reassembler.decode(datagrams[1], ("localhost", 1)) == msg
+    assert len(other) == 3
+    assert reassembler.decode(other[0], ("localhost", 1)) is None
+    assert reassembler.decode(other[2], ("localhost", 1))["args"] == b"y" * (2 * DATAGRAM)
+    # only the stray fragment from another sender is left, until it expires
+    assert len(reassembler.partial) == 1
+
+
+def test_bad_format():
+    datagram = encode({"method": "GET", "args": {"key": "d", "rid": 1}})[0]
+    with pytest.raises(DHTProtoBadFormat):
+        decode(datagram[:-1])
+    with pytest.raises(DHTProtoBadFormat):
+        decode(datagram + b"\x00")
+    with pytest.raises(DHTProtoBadFormat):
+        decode(bytes([VERSION + 1]) + datagram[1:])  # unknown version
+    with pytest.raises(DHTProtoBadFormat):
+        decode(bytes([VERSION, 0x50, 0]))  # unknown opcode
+    with pytest.raises(DHTProtoBadFormat):
+        decode(b"\x80\x04}q\x00.")  # a pickle
+
+
+def test_hostile_values():
+    deep = b"l\x00\x00\x00\x01" * 10000 + b"N"
+    with pytest.raises(DHTProtoBadFormat):
+        decode(bytes([VERSION, 12, 4]) + deep)  # an ACK nested too deep
+    nested = [[[[[[[[1]]]]]]]]
+    assert decode(encode({"method": "ACK", "args": nested})[0])["args"] == nested
+
+    unhashable = b"m\x00\x00\x00\x01" + b"l\x00\x00\x00\x00" + b"N"
+    with pytest.raises(DHTProtoBadFormat):
+        decode(bytes([VERSION, 12, 4]) + unhashable)  # a list as a dict key
+
+    with pytest.raises(DHTProtoBadFormat):
+        decode(bytes([VERSION, 4, 0]))  # PUT without args
+    assert decode(bytes([VERSION, 8, 0])) == {"method": "PREDECESSOR"}  # only optional args
+
+
+def test_fragment_limits():
+    msg = {"method": "PUT", "args": {"key": "big", "value": "x" * (3 * DATAGRAM), "rid": 1}}
+    reassembler = Reassembler(max_messages=2)
+    for _ in range(2):
+        assert reassembler.decode(encode(msg)[0], ("localhost", 1)) is None
+    with pytest.raises(DHTProtoBadFormat):
+        reassembler.decode(encode(msg)[0], ("localhost", 1))
+    # other senders are not affected
+    datagrams = encode(msg)
+    assert [reassembler.decode(datagram, ("localhost", 2)) for datagram in datagrams][-1] == msg
+    assert reassembler.senders == {("localhost", 1): [2, 2 * FRAGMENT_SIZE]}
+
+    reassembler = Reassembler(max_bytes=2 * DATAGRAM)
+    datagrams = encode(msg)
+    assert reassembler.decode(datagrams[0], ("localhost", 1)) is None
+    assert reassembler.decode(datagrams[0], ("localhost", 1)) is None  # repeated
+    assert reassembler.decode(datagrams[1], ("localhost", 1)) is None
+    with pytest.raises(DHTProtoBadFormat):
+        reassembler.decode(datagrams[2], ("localhost", 1))
+    assert reassembler.partial == {} and reassembler.senders == {}
@@ -0,0 +1,79 @@
+"""Tests replication in a ring of its own."""
+import pytest
+import time
+from DHTClient import DHTClient
+from DHTNode import DHTNode
+
+PORTS = [8000, 8001, 8002, 8004]  # ids 849, 660, 335, 621
+KEYS = [f"r{i}" for i in range(40)]
+
+
+@pytest.fixture(scope="module")
+def ring():
+    nodes = [DHTNode(("localhost", PORTS[0]), timeout=1, replication=3)]
+    nodes[0].start()
+    for port in PORTS[1:]:
+        time.sleep(0.2)
+        node = DHTNode(("localhost", port), ("localhost", PORTS[0]), 1, 3)
+        node.start()
+        nodes.append(node)
+    time.sleep(8)
+    yield nodes
+    for node in nodes:
+        node.done = True
+    for node in nodes:
+        node.join()
+
+
+def owner(ring, key):
+    return next(node for node in ring if key in node.keystore)
+
+
+def test_successor_list(ring):
+    by_id = sorted(ring, key=lambda node: node.identification)
+    for i, node in enumerate(by_id):
+        assert [node_id for node_id, _ in node.successor_list] == [
+            by_id[(i + 1) % 4].identification, by_id[(i + 2) % 4].identification, by_id[(i + 3) % 4].identification
+        ]
+        assert len(node.replica_addrs) == 2
+
+
+def test_writes_replicated(ring):
+    client = DHTClient(("localhost", PORTS[0]))
+    assert all(client.put_many({key: key.upper() for key in KEYS[:20]}).values())
+    assert all(client.put(key, key.upper()) for key in KEYS[20:])
+    time.sleep(0.5)
+
+    for key in KEYS:
+        holders = [node for node in ring if node.replicas.get(key) == key.upper()]
+        assert len(holders) == 2
+        assert owner(ring, key) not in holders
+
+
+def test_replica_reads(ring):
+    client = DHTClient(("localhost", PORTS[0]), replica_reads=True)
+    assert client.get_many(KEYS) == {key: key.upper() for key in KEYS}
+    assert all(client.get(key) == key.upper() for key in KEYS)
+    # the replicas were tried, not only the owners
+    assert len(client.rtt) == 4
+
+
+def test_owner_failure(ring):
+    client = DHTClient(("localhost", PORTS[0]), timeout=0.5, replica_reads=True)
+    key = next(key for key in KEYS if owner(ring, key).addr[1] != PORTS[0])
+    assert client.get(key) == key.upper()
+
+    dead = owner(ring, key)
+    dead.done = True
+    dead.join()
+
+    # the replicas answer right away, without waiting for the ring to stabilize
+    assert client.get(key) == key.upper()
+
+    # once the failure is detected the successor of the dead node owns its keys
+    successor = next(node for node in ring if node.identification == dead.successor_id)
+    deadline = time.time() + 15
+    while key not in successor.keystore and time.time() < deadline:
+        time.sleep(0.5)
+    assert successor.keystore[key] == key.upper()
+    assert all(node.successor_id != dead.identification for node in ring if node is not dead)
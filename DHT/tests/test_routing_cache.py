@@ -0,0 +1,42 @@
+"""Tests the routing cache of the client."""
+from DHTClient import RoutingCache
+
+
+def test_routing_cache():
+    cache = RoutingCache()
+    assert cache.lookup(100) is None
+
+    cache.learn(257, ("localhost", 5003), 959)
+    assert cache.lookup(115) == ("localhost", 5003)
+    assert cache.lookup(1000) == ("localhost", 5003)
+    assert cache.lookup(257) == ("localhost", 5003)
+    assert cache.lookup(921) is None
+
+    cache.learn(959, ("localhost", 5001), 895)
+    assert cache.lookup(921) == ("localhost", 5001)
+    assert cache.lookup(895) is None
+
+    # a node joined between 959 and 257: the old range of 257 is replaced
+    cache.learn(100, ("localhost", 5005), 959)
+    assert cache.lookup(50) == ("localhost", 5005)
+    cache.learn(257, ("localhost", 5003), 100)
+    assert cache.lookup(115) == ("localhost", 5003)
+    assert len(cache) == 3
+
+    # a node left: its successor now owns its range
+    cache.learn(257, ("localhost", 5003), 959)
+    assert len(cache) == 2
+    assert cache.lookup(50) == ("localhost", 5003)
+
+    cache.invalidate(50)
+    assert cache.lookup(50) is None
+    assert cache.lookup(921) == ("localhost", 5001)
+
+
+def test_routing_cache_single_node():
+    cache = RoutingCache()
+    cache.learn(770, ("localhost", 5000), None)
+    assert cache.lookup(770) is None
+
+    cache.learn(770, ("localhost", 5000), 770)
+    assert cache.lookup(3) == ("localhost", 5000)
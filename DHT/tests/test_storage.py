@@ -0,0 +1,100 @@
+"""Tests the storage engines of the nodes."""
+import os
+import pytest
+from DHTNode import DHTNode
+from storage import MemoryStore, LogStore, log_store
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "keys.log")
+
+
+def test_memory_store():
+    store = MemoryStore("ignored")
+    store["A"] = [0, 1, 2]
+    store.sync()
+    store.close()
+    assert store == {"A": [0, 1, 2]}
+
+
+def test_log_store(path):
+    store = LogStore(path)
+    values = {"A": [0, 1, 2], "2": "xpto", "ç": {"x": (1, None)}, "big": 2 ** 80, "raw": b"\x00\xff"}
+    for key, value in values.items():
+        store[key] = value
+    assert dict(store) == values
+    assert "A" in store and "B" not in store
+    with pytest.raises(KeyError):
+        store["B"]
+
+    store["A"] = "new"
+    del store["2"]
+    with pytest.raises(KeyError):
+        del store["2"]
+    assert store["A"] == "new"
+    assert len(store) == 4
+    store.close()
+
+    store = LogStore(path)
+    assert store["A"] == "new"
+    assert "2" not in store
+    assert len(store) == 4
+    store.close()
+
+
+def test_log_store_torn_tail(path):
+    store = LogStore(path)
+    store["A"] = "complete"
+    store["B"] = "torn"
+    store.close()
+    size = os.path.getsize(path)
+    with open(path, "r+b") as f:
+        f.truncate(size - 2)  # the last write was cut by a crash
+
+    store = LogStore(path)
+    assert dict(store) == {"A": "complete"}
+    store["C"] = "after"  # appended right after the last complete record
+    store.close()
+    assert dict(LogStore(path)) == {"A": "complete", "C": "after"}
+
+
+def test_log_store_compaction(path):
+    store = LogStore(path, compact_min=0)
+    for i in range(100):
+        store["key"] = "x" * 1000 + str(i)
+        store[str(i)] = i
+    # overwritten values are garbage, compacted once they outgrow the live records
+    assert os.path.getsize(path) < 2 * (1000 + 100 * 20 + 200)
+    assert store["key"] == "x" * 1000 + "99"
+    assert len(store) == 101
+    store.close()
+    assert LogStore(path)["key"] == "x" * 1000 + "99"
+    assert not os.path.exists(path + ".compact")
+
+
+def test_log_store_large_value(path):
+    store = LogStore(path)
+    value = os.urandom(1 << 20)
+    store["large"] = value
+    store["small"] = 1
+    assert store["large"] == value
+    store.close()
+    assert LogStore(path)["large"] == value
+
+
+def test_node_restart(tmp_path):
+    store = log_store(str(tmp_path))
+    node = DHTNode(("localhost", 8100), store=store)
+    node.keystore["A"] = [0, 1, 2]
+    node.replicas["B"] = "copy"
+    node.keystore.close()
+    node.replicas.close()
+    node.socket.close()
+
+    # same address, same log: the keys are back without asking any other node
+    node = DHTNode(("localhost", 8100), store=store)
+    assert node.keystore["A"] == [0, 1, 2]
+    assert dict(node.replicas) == {"B": "copy"}
+    node.socket.close()
+    assert sorted(os.listdir(tmp_path)) == ["localhost-8100-keystore.log", "localhost-8100-replicas.log"]
@@ -0,0 +1,77 @@
+"""Tests virtual nodes in a ring of their own."""
+import pytest
+import time
+from bisect import bisect_left
+from DHT import report
+from DHTClient import DHTClient
+from DHTNode import DHTNode
+from utils import dht_hash
+
+PORTS = [8200, 8201, 8202]
+KEYS = [f"v{i}" for i in range(60)]
+
+
+@pytest.fixture(scope="module")
+def ring():
+    nodes = [DHTNode(("localhost", PORTS[0]), timeout=1, replication=2, vnodes=4)]
+    nodes[0].start()
+    for port in PORTS[1:]:
+        time.sleep(0.2)
+        node = DHTNode(("localhost", port), ("localhost", PORTS[0]), 1, 2, vnodes=4)
+        node.start()
+        nodes.append(node)
+    time.sleep(10)
+    yield nodes
+    for node in nodes:
+        node.done = True
+    for node in nodes:
+        node.join()
+
+
+def positions(ring):
+    return sorted((position for node in ring for position in node.positions.values()),
+                  key=lambda position: position.identification)
+
+
+def test_positions(ring):
+    assert [len(node.positions) for node in ring] == [4, 4, 4]
+    assert ring[0].positions[0] is ring[0]
+    assert ring[0].positions[2].addr == ("localhost", PORTS[0], 2)
+    assert ring[0].positions[2].identification == dht_hash(str(("localhost", PORTS[0], 2)))
+    assert ring[0].positions[2].keystore is ring[0].keystore
+
+    ordered = positions(ring)
+    for i, position in enumerate(ordered):
+        assert position.inside_dht
+        assert position.successor_id == ordered[(i + 1) % len(ordered)].identification
+        assert position.predecessor_id == ordered[i - 1].identification
+        # replicas are kept by another process
+        assert len(position.replica_addrs) == 1
+        assert position.replica_addrs[0][:2] != position.addr[:2]
+
+
+def test_shares(ring):
+    shares = [sum(position.share for position in node.positions.values()) for node in ring]
+    assert sum(shares) == pytest.approx(1)
+    assert max(shares) < 0.5  # 0.50 with a single position each
+    assert len(report(ring).splitlines()) == 3
+
+
+def test_keys(ring):
+    client = DHTClient(("localhost", PORTS[0]))
+    assert all(client.put_many({key: key.upper() for key in KEYS[:30]}).values())
+    assert all(client.put(key, key.upper()) for key in KEYS[30:])
+    assert client.get_many(KEYS) == {key: key.upper() for key in KEYS}
+    assert all(client.get(key) == key.upper() for key in KEYS)
+    # the client learned the virtual positions and reached them directly
+    assert any(len(addr) == 3 for _, addr, _ in client.cache.nodes.values())
+
+    ordered = positions(ring)
+    ids = [position.identification for position in ordered]
+    for key in KEYS:
+        owner = ordered[bisect_left(ids, dht_hash(key)) % len(ordered)]
+        assert owner.primary.keystore[key] == key.upper()
+    assert sum(len(node.keystore) for node in ring) == len(KEYS)
+
+    time.sleep(0.5)
+    assert sum(len(node.replicas) for node in ring) == len(KEYS)
@@ -1,3 +1,7 @@
+DATAGRAM = 65507  # largest UDP payload, multi-key requests carry many keys per datagram
+RECV_BUFFER = 1 << 22  # socket receive buffer, holds the fragments of large values arriving in a burst
+
+
 def dht_hash(text, seed=0, maximum=2**10):
     """ FNV-1a Hash Function. """
     fnv_prime = 16777619